@@ -0,0 +1,50 @@
+"""
+Throughput of reading every member of an archive from a pool of threads
+sharing one ZipFileExtended, with reads serialised by the archive's lock
+(pread=False) and with os.pread() (pread=True).
+
+    python -m benchmarks.bench_concurrent_reads [members [member KiB [threads ...]]]
+"""
+import os
+import sys
+import time
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from rolib.packages.zipextended.zipfileextended import ZipFileExtended
+
+
+def build(filename, members, size):
+    data = os.urandom(size)
+    with ZipFileExtended(filename, mode="w") as zip:
+        for i in range(members):
+            zip.writestr("data/file{:05d}".format(i), data)
+
+
+def read_all(filename, threads, pread):
+    with ZipFileExtended(filename, mode="r", pread=pread) as zip:
+        names = zip.namelist()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(threads) as pool:
+            total = sum(len(data) for data in pool.map(zip.read, names))
+        return total, time.perf_counter() - start
+
+
+def main(members=200, kilobytes=1024, threads=(1, 2, 4, 8)):
+    fd, filename = tempfile.mkstemp(suffix=".zip")
+    os.close(fd)
+    try:
+        build(filename, members, kilobytes * 1024)
+        print("{} members of {} KiB, {} CPUs".format(members, kilobytes, os.cpu_count()))
+        print("{:<8}{:>10}{:>12}".format("threads", "pread", "MB/s"))
+        for count in threads:
+            for pread in (False, True):
+                total, elapsed = read_all(filename, count, pread)
+                print("{:<8}{:>10}{:>12.1f}".format(count, str(pread), total / 1e6 / elapsed))
+    finally:
+        os.unlink(filename)
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*args[:2], **({"threads": args[2:]} if args[2:] else {}))
@@ -0,0 +1,60 @@
+"""
+Throughput of loading and dumping synthetic manifests with each JSON codec
+available (see rolib.jsoncodec).
+
+    python -m benchmarks.bench_json_codecs [aggregates ...]
+"""
+import io
+import sys
+import json
+import time
+
+from rolib import jsoncodec
+from rolib.manifest import Manifest
+
+
+def manifest_json(aggregates):
+    return json.dumps({
+        "@context": ["https://w3id.org/bundle/context"],
+        "id": "/",
+        "createdBy": {"name": "Alice W. Land", "uri": "http://example.com/foaf#alice"},
+        "aggregates": [{"uri": "/data/file{:07d}.txt".format(i),
+                        "mediatype": "text/plain",
+                        "createdOn": "2015-01-01T12:00:00Z",
+                        "createdBy": {"name": "Bob Builder"}}
+                       for i in range(aggregates)],
+        "annotations": [],
+    }, indent=4)
+
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+
+def main(sizes=(10000, 100000, 1000000)):
+    print("{:<8}{:>10}{:>12}{:>12}{:>12}{:>12}".format(
+        "codec", "aggregates", "MB", "load MB/s", "dump MB/s", "write MB/s"))
+    for aggregates in sizes:
+        contents = manifest_json(aggregates)
+        megabytes = len(contents) / 1e6
+        expected = None
+        for name in sorted(jsoncodec.CODECS):
+            previous = jsoncodec.set_codec(name)
+            try:
+                load, manifest = timed(lambda: Manifest(file=io.StringIO(contents), lazy=True))
+                dump, text = timed(manifest.to_json)
+                write, _ = timed(lambda: manifest.write_json(io.BytesIO()))
+            finally:
+                jsoncodec.set_codec(previous)
+            # Every codec must write the same bytes
+            expected = expected or text
+            assert text == expected, name
+            print("{:<8}{:>10}{:>12.1f}{:>12.1f}{:>12.1f}{:>12.1f}".format(
+                name, aggregates, megabytes, megabytes / load, megabytes / dump,
+                megabytes / write))
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or (10000, 100000, 1000000))
@@ -0,0 +1,63 @@
+"""
+Cost of attribute access on manifest objects: reading plain and objectified
+properties of a manifest freshly loaded from JSON, and listing the aggregates
+of a lazily loaded one.
+
+    python -m benchmarks.bench_manifest_attributes [aggregates] [repeat]
+"""
+import io
+import sys
+import json
+import timeit
+
+from rolib.manifest import Manifest
+
+
+def manifest_json(aggregates):
+    return json.dumps({
+        "@context": ["https://w3id.org/bundle/context"],
+        "id": "/",
+        "createdBy": {"name": "Alice W. Land", "uri": "http://example.com/foaf#alice"},
+        "aggregates": [{"uri": "/data/file{:07d}.txt".format(i),
+                        "mediatype": "text/plain",
+                        "createdBy": {"name": "Bob Builder"}}
+                       for i in range(aggregates)],
+        "annotations": [],
+    })
+
+
+def main(aggregates=10000, repeat=5):
+    contents = manifest_json(aggregates)
+
+    def load():
+        return Manifest(file=io.StringIO(contents))
+
+    def lazy_ids():
+        manifest = Manifest(file=io.StringIO(contents), lazy=True)
+        for uri in manifest.aggregates.ids():
+            pass
+
+    def first_pass():
+        manifest = load()
+        for aggregate in manifest.aggregates:
+            aggregate.createdBy.name
+
+    manifest = load()
+    aggregate = manifest.get_aggregate("/data/file0000000.txt")
+    cases = (
+        ("load", load, 1),
+        ("load + read every createdBy", first_pass, 1),
+        ("lazy load + list every uri", lazy_ids, 1),
+        ("manifest.aggregates", lambda: manifest.aggregates, 1000),
+        ("manifest.createdBy", lambda: manifest.createdBy, 100000),
+        ("aggregate.uri", lambda: aggregate.uri, 100000),
+        ("aggregate.createdBy", lambda: aggregate.createdBy, 100000),
+    )
+    print("{} aggregates".format(aggregates))
+    for label, function, number in cases:
+        best = min(timeit.repeat(function, number=number, repeat=repeat)) / number
+        print("{:<32}{:>14.3f} us".format(label, best * 1e6))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,50 @@
+"""
+Memory used by the member list of a large archive, comparing a ZipInfo object
+per member with the column based ZipInfoTable (compact_info=True).
+
+    python -m benchmarks.bench_zipinfo_memory [members]
+"""
+import os
+import sys
+import time
+import tempfile
+import tracemalloc
+
+from rolib.packages.zipextended.zipfileextended import ZipFileExtended
+
+
+def build(filename, members):
+    with ZipFileExtended(filename, mode="w") as zip:
+        for i in range(members):
+            zip.writestr("data/dir{:03d}/file{:07d}.txt".format(i % 1000, i), b"")
+
+
+def measure(filename, **kwargs):
+    tracemalloc.start()
+    start = time.perf_counter()
+    zip = ZipFileExtended(filename, mode="r", **kwargs)
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    zip.close()
+    return current, peak, elapsed
+
+
+def main(members=200000):
+    fd, filename = tempfile.mkstemp(suffix=".zip")
+    os.close(fd)
+    try:
+        build(filename, members)
+        print("{} members".format(members))
+        print("{:<14}{:>14}{:>14}{:>14}{:>10}".format(
+            "layout", "resident", "peak", "per member", "open (s)"))
+        for label, kwargs in (("ZipInfo", {}), ("ZipInfoTable", {"compact_info": True})):
+            current, peak, elapsed = measure(filename, **kwargs)
+            print("{:<14}{:>14,}{:>14,}{:>14.1f}{:>10.2f}".format(
+                label, current, peak, current / members, elapsed))
+    finally:
+        os.unlink(filename)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
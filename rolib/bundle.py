@@ -2,10 +2,15 @@ from rolib.packages.zipextended.packages import zipfile
 import rolib.packages.zipextended
 from tempfile import TemporaryFile, NamedTemporaryFile
 from rolib.ucf import UCF
+from rolib.packages.zipextended.zipfileextended import (ZipFileExtended, VERIFY_STRUCTURE,
+                                                           DEFLATE_BLOCK_SIZE)
 from .manifest import Manifest, Aggregate, Annotation
+from . import fixity
 import json
 import codecs
 import os
+from contextlib import contextmanager
+import itertools
 
 MANIFEST_DIR = ".ro/"
 MANIFEST_FILE = MANIFEST_DIR + "manifest.json"
@@ -13,60 +18,188 @@ MIMETYPE = "application/vnd.wf4ever.robundle+zip"
 
 class Bundle(UCF, object):
 
-    def __init__(self, file, mode="r", compression=zipfile.ZIP_STORED, allowZip64=True):
+    # Checksums recorded for the aggregates written, see rolib.fixity
+    checksum_algorithms = fixity.DEFAULT_ALGORITHMS
+
+    def __init__(self, file, mode="r", compression=zipfile.ZIP_STORED, allowZip64=True,
+                 lazy=False, index_file=None, compact_info=False, pread=None):
         self.manifest = Manifest()
-        super(Bundle, self).__init__(file,mode=mode,compression=compression,allowZip64=allowZip64,mimetype=MIMETYPE)
+        self._batch_depth = 0
+        self._deferred_commit = None
+        super(Bundle, self).__init__(file,mode=mode,compression=compression,allowZip64=allowZip64,mimetype=MIMETYPE,
+                                     lazy=lazy,index_file=index_file,
+                                     compact_info=compact_info, pread=pread)
         self._register_reserved_file(MANIFEST_FILE)
         self._register_reserved_directory(MANIFEST_DIR)
-        if MANIFEST_FILE in self.namelist():
+        if MANIFEST_FILE in self.NameToInfo:
                 self.manifest = Manifest(file=self.open(MANIFEST_FILE))
 
     @classmethod
     def create_from_manifest(cls, file, manifest_or_manifestfilename, compression=zipfile.ZIP_STORED, allowZip64=True):
         with Bundle(file, mode="w", compression=compression, allowZip64=allowZip64) as bundle:
             if manifest_or_manifestfilename:
-                if isinstance(manifest_or_manifestfilename, str):
-                    bundle.manifest = Manifest(filename=manifest_or_manifestfilename)
-                else:
-                    bundle.manifest = manifest_or_manifestfilename
-            for aggreate in bundle.manifest.aggregates:
-                uri = aggreate.uri
-                if uri[0] == '/':
-                    uri = uri[1:]
-                if os.path.isfile(uri):
-                    super(Bundle, bundle).write(uri)
-
-            for annotation in bundle.manifest.annotations:
-                uri = annotation.contents
-                if uri[0] == '/':
-                    uri = uri[1:]
-                if os.path.isfile(uri):
-                    super(Bundle, bundle).write(uri)
+                bundle.manifest = _manifest(manifest_or_manifestfilename)
+            for filename, aggregate in _manifest_files(bundle.manifest):
+                super(Bundle, bundle).write(filename)
 
             bundle.requires_commit = True
             return bundle
 
+    @classmethod
+    def update_from_manifest(cls, file, manifest_or_manifestfilename, compression=zipfile.ZIP_STORED, allowZip64=True):
+        """
+        Bring the bundle in file up to date with the manifest, with the same
+        members create_from_manifest() would give it, creating it if file
+        doesn't exist.
+
+        A member is left as it is if its file has the same size and
+        modification time as it, and the same checksums if they are recorded
+        in both the manifest and the bundle's. Other members are written
+        again and those no longer in the manifest removed, then the space
+        they leave is reclaimed with compact().
+        """
+        if isinstance(file, str) and not os.path.exists(file):
+            return cls.create_from_manifest(file, manifest_or_manifestfilename,
+                                            compression=compression, allowZip64=allowZip64)
+        with Bundle(file, mode="a", compression=compression, allowZip64=allowZip64) as bundle:
+            previous = bundle.manifest
+            if manifest_or_manifestfilename:
+                bundle.manifest = _manifest(manifest_or_manifestfilename)
+            files = []
+            for filename, aggregate in _manifest_files(bundle.manifest):
+                zinfo = bundle._info_from_file(filename)
+                files.append((filename, zinfo.filename, bundle._member_changed(zinfo, aggregate, previous)))
+            arcnames = set(arcname for filename, arcname, changed in files)
+            for arcname in bundle.namelist(ignore_reserved=True):
+                if arcname not in arcnames:
+                    super(Bundle, bundle).remove(arcname)
+            for filename, arcname, changed in files:
+                if changed:
+                    if arcname in bundle.NameToInfo:
+                        super(Bundle, bundle).remove(arcname)
+                    bundle._reclaim_manifest()
+                    super(Bundle, bundle).write(filename)
+
+            bundle.requires_commit = True
+            bundle.commit()
+            if bundle.wasted_bytes():
+                bundle.compact()
+            return bundle
+
+    def _member_changed(self, zinfo, aggregate, previous):
+        """Whether the member zinfo, made for the file of aggregate, differs
+        from the one in the bundle, whose manifest was previous"""
+        current = self.NameToInfo.get(zinfo.filename)
+        if current is None or current.file_size != zinfo.file_size:
+            return True
+        # Zip files only keep the modification time to 2 seconds
+        date_time = zinfo.date_time[:5] + (zinfo.date_time[5] // 2 * 2,)
+        if current.date_time != date_time:
+            return True
+        checksums = getattr(aggregate, "checksums", None)
+        previous_aggregate = previous.get_aggregate(aggregate.id) if checksums else None
+        previous_checksums = getattr(previous_aggregate, "checksums", None)
+        if previous_checksums:
+            common = set(checksums).intersection(previous_checksums)
+            return any(checksums[algorithm] != previous_checksums[algorithm]
+                       for algorithm in common)
+        return False
+
     def write(self, filename, arcname=None, compress_type=None):
-        super(Bundle, self).write(filename,arcname=arcname,compress_type=compress_type)
-        self.manifest.add_aggregate(Aggregate(filename))
+        self._reclaim_manifest()
+        fixity.check_algorithms(self.checksum_algorithms)
+        checksums = super(Bundle, self).write(filename, arcname=arcname, compress_type=compress_type,
+                                              digests=self.checksum_algorithms)
+        self._add_aggregate(filename, checksums)
+        self.requires_commit = True
+
+    def write_many(self, filenames, arcnames=None, compress_type=None, workers=None):
+        self._reclaim_manifest()
+        fixity.check_algorithms(self.checksum_algorithms)
+        filenames = list(filenames)
+        checksums = super(Bundle, self).write_many(filenames, arcnames=arcnames,
+                                                   compress_type=compress_type, workers=workers,
+                                                   digests=self.checksum_algorithms)
+        for filename, sums in zip(filenames, checksums):
+            self._add_aggregate(filename, sums)
+        self.requires_commit = True
+
+    def write_blocks(self, filename, arcname=None, workers=None,
+                     block_size=DEFLATE_BLOCK_SIZE):
+        self._reclaim_manifest()
+        fixity.check_algorithms(self.checksum_algorithms)
+        checksums = super(Bundle, self).write_blocks(filename, arcname=arcname, workers=workers,
+                                                     block_size=block_size,
+                                                     digests=self.checksum_algorithms)
+        self._add_aggregate(filename, checksums)
         self.requires_commit = True
 
     def writestr(self, zinfo_or_arcname, data, compress_type=None):
+        self._reclaim_manifest()
         super(Bundle, self).writestr(zinfo_or_arcname, data, compress_type=compress_type)
         if isinstance(zinfo_or_arcname, zipfile.ZipInfo):
             filename = zinfo_or_arcname.filename
         else:
             filename = zinfo_or_arcname
-        self.manifest.add_aggregate(Aggregate(filename))
+        checksums = None
+        if self.checksum_algorithms:
+            if isinstance(data, str):
+                data = data.encode("utf-8")
+            checksums = fixity.checksum_bytes(data, self.checksum_algorithms)
+        self._add_aggregate(filename, checksums)
         #Every time we alter the manifest we will have to commit to update the
         #changes
         self.requires_commit = True
 
+    def _add_aggregate(self, filename, checksums=None):
+        aggregate = Aggregate(filename)
+        if checksums:
+            aggregate.checksums = checksums
+        self.manifest.add_aggregate(aggregate)
+
+    @contextmanager
+    def batch(self):
+        """
+        Group changes to the bundle so the manifest is only written once.
+
+        with bundle.batch():
+            bundle.writestr("a.txt", "a")
+            bundle.commit()
+            bundle.writestr("b.txt", "b")
+            bundle.commit()
+
+        Calls to commit() within the batch are deferred until it ends, when
+        the manifest is written as the last member of the archive and the
+        changes are committed once. Batches may be nested, only the outermost
+        one commits. If the batch ends with an exception nothing is committed
+        until the bundle is closed.
+        """
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+        if not self._batch_depth and self.fp and self.requires_commit:
+            self.commit(**(self._deferred_commit or {}))
+
     def _update_manifest(self):
-        if MANIFEST_FILE in self.namelist():
-            zipext.ZipFileExt.remove(self,MANIFEST_FILE)
-        manifest_json = self.manifest.to_json()
-        zipfile.ZipFile.writestr(self,MANIFEST_FILE,manifest_json)
+        if not self._reclaim_manifest() and MANIFEST_FILE in self.NameToInfo:
+            ZipFileExtended.remove(self,MANIFEST_FILE)
+        with self.open(MANIFEST_FILE, "w") as fp:
+            self.manifest.write_json(fp)
+
+    def _reclaim_manifest(self):
+        """If the manifest is the last member of the archive, drop it so that
+        what is written next goes over it rather than leaving it behind as
+        dead space. It is written again when the bundle is committed."""
+        zinfo = self.NameToInfo.get(MANIFEST_FILE)
+        if (zinfo is None or not self._can_commit_in_place() or
+                self._member_extent(zinfo)["end"] != self.start_dir):
+            return False
+        ZipFileExtended.remove(self, MANIFEST_FILE)
+        self.removed_filelist.remove(zinfo)
+        self.start_dir = zinfo.header_offset
+        return True
 
     def add(self, filename, arcname=None):
         self.write(filename, arcname=arcname)
@@ -75,9 +208,40 @@ class Bundle(UCF, object):
         super(Bundle, self).remove(filename)
         self.manifest.remove_aggregate(filename)
 
-    def commit(self):
+    def commit(self, rewrite=False, verify=VERIFY_STRUCTURE):
+        if self._batch_depth:
+            deferred = self._deferred_commit or {}
+            self._deferred_commit = {"rewrite": rewrite or deferred.get("rewrite", False),
+                                     "verify": verify}
+            return
+        self._deferred_commit = None
         self._update_manifest()
-        super(Bundle, self).commit()
+        super(Bundle, self).commit(rewrite=rewrite, verify=verify)
+
+    def close(self):
+        # Closing ends any batch, committing the changes made in it
+        self._batch_depth = 0
+        super(Bundle, self).close()
+
+def _manifest(manifest_or_manifestfilename):
+    if isinstance(manifest_or_manifestfilename, str):
+        return Manifest(filename=manifest_or_manifestfilename)
+    return manifest_or_manifestfilename
+
+def _manifest_files(manifest):
+    """Yield the filename of each file aggregated by the manifest, or that
+    is the content of an annotation, that is to be put in its bundle, with
+    its aggregate or annotation. Each file is only yielded once."""
+    seen = set()
+    for entry in itertools.chain(manifest.aggregates, manifest.annotations):
+        uri = entry.uri if isinstance(entry, Aggregate) else entry.content
+        if not isinstance(uri, str) or not uri:
+            continue
+        if uri[0] == '/':
+            uri = uri[1:]
+        if uri not in seen and os.path.isfile(uri):
+            seen.add(uri)
+            yield uri, entry
 
 def main():
     with Bundle("test.zip",mode='a') as b:
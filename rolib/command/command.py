@@ -15,6 +15,11 @@ import sys, select
 import os
 import os.path
 import re
+import fnmatch
+import marshal
+import tempfile
+from stat import S_ISREG
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 import logging
 
@@ -43,14 +48,34 @@ from rolib.annotation import annotationTypes, annotationPrefixes
 
 from zipfile import ZipFile
 
-from rolib.manifest import Manifest
+from rolib.manifest import Manifest, Aggregate
 from rolib.bundle import Bundle
+from rolib import fixity
 
 RDFTYP = ["RDFXML","N3","TURTLE","NT","JSONLD","RDFA"]
 VARTYP = ["JSON","CSV","XML"]
 
 MANIFEST_DIR    = ".ro"
 MANIFEST_FILE   = "manifest.json"
+MANIFEST_CACHE  = "manifest.cache"
+MANIFEST_JOURNAL = "manifest.journal"
+STAT_CACHE      = "stat.cache"
+
+# The journal is folded into the manifest once it is bigger than this
+JOURNAL_FOLD_SIZE = 1024 * 1024
+
+# Threads listing directories for a recursive ro add, which spend most of
+# their time waiting on the filesystem
+WALK_WORKERS = 8
+
+# A stat cache starts with this and the marshal version, followed by the
+# marshalled dictionary of the identifier of each file added to its size,
+# modification time, inode and the checksums recorded for it
+STAT_CACHE_MAGIC = b"ROSC\x01"
+# Files modified this recently (in nanoseconds) before they were added
+# aren't cached, as on filesystems with coarse timestamps they could be
+# changed again without their modification time changing
+STAT_CACHE_RACE = 2 * 10**9
 
 
 RDFTYPPARSERMAP = (
@@ -76,6 +101,77 @@ def manifest_directory(ro_dir):
 def manifest_file(ro_dir):
     return os.path.join(ro_dir, MANIFEST_DIR, MANIFEST_FILE)
 
+def manifest_cache_file(ro_dir):
+    return os.path.join(ro_dir, MANIFEST_DIR, MANIFEST_CACHE)
+
+def manifest_journal_file(ro_dir):
+    return os.path.join(ro_dir, MANIFEST_DIR, MANIFEST_JOURNAL)
+
+def stat_cache_file(ro_dir):
+    return os.path.join(ro_dir, MANIFEST_DIR, STAT_CACHE)
+
+def read_stat_cache(ro_dir):
+    """
+    Return the stat cache of the research object in ro_dir, the dictionary
+    of each file added to its (size, mtime_ns, inode, checksums). It is
+    empty if there is no stat cache or it can't be read.
+    """
+    try:
+        with open(stat_cache_file(ro_dir), "rb") as fp:
+            data = fp.read()
+    except OSError:
+        return {}
+    magic = STAT_CACHE_MAGIC + bytes([marshal.version])
+    if not data.startswith(magic):
+        return {}
+    try:
+        cache = marshal.loads(memoryview(data)[len(magic):])
+    except (EOFError, ValueError, TypeError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+def write_stat_cache(ro_dir, cache):
+    """Replace the stat cache of the research object in ro_dir with cache.
+    It is left as it was if it can't be written."""
+    filename = stat_cache_file(ro_dir)
+    try:
+        fp = tempfile.NamedTemporaryFile(dir=os.path.dirname(filename),
+                                         prefix=".stat", delete=False)
+    except OSError as e:
+        log.debug("Couldn't write stat cache {}: {}".format(filename, e))
+        return
+    try:
+        with fp:
+            fp.write(STAT_CACHE_MAGIC + bytes([marshal.version]))
+            fp.write(marshal.dumps(cache))
+        os.replace(fp.name, filename)
+    except OSError as e:
+        log.debug("Couldn't write stat cache {}: {}".format(filename, e))
+        os.unlink(fp.name)
+
+def read_manifest(ro_dir, lazy=False, writable=False):
+    """
+    Read the manifest of the research object in ro_dir, through the snapshot
+    of it kept in .ro so that it isn't parsed again until it changes, and
+    with the changes in its journal made. Only a writable manifest can be
+    passed to write_manifest(), other than to fold its journal.
+    """
+    return Manifest(filename=manifest_file(ro_dir), cache=manifest_cache_file(ro_dir),
+                    journal=manifest_journal_file(ro_dir), lazy=lazy, writable=writable)
+
+def write_manifest(ro_dir, manifest, fold=False):
+    """
+    Append the changes made to a manifest read by read_manifest(writable=True)
+    to its journal, rather than rewriting it. The journal is folded into the
+    manifest if fold is True or it has grown past JOURNAL_FOLD_SIZE.
+    """
+    journal = manifest_journal_file(ro_dir)
+    if not fold:
+        manifest.write_journal(journal)
+        fold = os.path.isfile(journal) and os.path.getsize(journal) > JOURNAL_FOLD_SIZE
+    if fold:
+        manifest.fold_journal(manifest_file(ro_dir), journal)
+
 def directory_and_manifest_exist(ro_dir):
     manifestdir = manifest_directory(ro_dir)
     manifestfilepath = manifest_file(ro_dir)
@@ -174,15 +270,18 @@ def init(name, dir, id=None, creator=None, verbose=False, force=False):
     manifest.description = name
 
     log.debug("manifest: " + manifest.to_json())
-    with open(manifestfilepath, 'w') as manifest_filehandle:
-        manifest_filehandle.write(manifest.to_json())
+    manifest.fold_journal(manifestfilepath, manifest_journal_file(dir))
     return 0
 
-def status(dir, verbose=False):
+def status(dir, verbose=False, ignore=(), prune_manifest_dir=False):
     """
     Display status of a designated research object
 
-    ro status [ -d dir ]
+    ro status [ -d dir ] [ -i pattern ... ] [ --prune-ro ]
+
+    Files matching an ignore pattern, and directories matching one along
+    with their contents, are left out of the unaggregated files, as is the
+    .ro directory if prune_manifest_dir is True.
     """
 
     manifestfilepath = manifest_file(dir)
@@ -190,7 +289,7 @@ def status(dir, verbose=False):
         print("Could not find manifest file: {}".format(manifestfilepath))
         return 1
 
-    manifest = Manifest(filename=manifestfilepath)
+    manifest = read_manifest(dir, lazy=True)
     print("Research Object status")
     print("  Identifier: {}".format(manifest.id))
     print("  Title: {}".format(manifest.title))
@@ -203,44 +302,131 @@ def status(dir, verbose=False):
         print("    URI: {}".format(manifest.createdBy.uri))
     print("  Created: {}".format(manifest.createdOn))
     print("  Aggregates:")
-    aggregates = [aggregate.uri for aggregate in manifest.aggregates]
-    for aggregate in aggregates:
+    for aggregate in manifest.aggregates.ids():
         print("       {}".format(aggregate))
-    #Establish the Unaggregated files
-    files = []
-    for dirpath, dirnames, filenames in os.walk(dir):
-        #make the path relative to the top dir of the ro
-        dirpath = os.path.relpath(dirpath, dir)
-        files += [sanitize_filename_for_identifier(os.path.join(dirpath, filename), dir) for filename in filenames]
-    for aggregate in aggregates:
-        if aggregate in files:
-            files.remove(aggregate)
+    #Establish the Unaggregated files, printing them as they are found
+    ignore = tuple(ignore)
+    if prune_manifest_dir:
+        ignore += (os.sep + MANIFEST_DIR,)
     print("")
     print("Unaggregated files:")
-    for file in files:
-        print(file)
+    for file in walk_files(dir, ignore):
+        if file not in manifest.aggregates:
+            print(file)
     print("")
 
     return 0
 
+def walk_files(dir, ignore=(), workers=1, stat=False):
+    """
+    Yield the identifiers of the files in the directory dir and its
+    subdirectories, as sanitize_filename_for_identifier() gives them,
+    without following links to directories.
+
+    ignore holds glob patterns for the files and directories to leave out,
+    matched against both their name and their identifier. The contents of
+    directories left out aren't walked.
+
+    If workers is more than 1 that many threads list the directories ahead
+    of those being yielded from. The files are yielded in the same order.
+
+    If stat is True (identifier, (size, mtime_ns, inode)) is yielded for
+    each regular file, following links, instead.
+    """
+    ignored = None
+    if ignore:
+        ignored = re.compile("|".join(fnmatch.translate(pattern) for pattern in ignore)).match
+    if workers > 1:
+        with ThreadPoolExecutor(workers) as executor:
+            # Listings of the directories to walk, most of them still running
+            stack = [executor.submit(_scan_directory, dir, "", ignored, stat)]
+            try:
+                while stack:
+                    files, directories = stack.pop().result()
+                    for file in files:
+                        yield file
+                    stack += [executor.submit(_scan_directory, path, identifier, ignored, stat)
+                              for path, identifier in directories]
+            finally:
+                for listing in stack:
+                    listing.cancel()
+        return
+    # Directories to walk, with their identifiers
+    stack = [(dir, "")]
+    while stack:
+        files, directories = _scan_directory(*stack.pop(), ignored=ignored, stat=stat)
+        for file in files:
+            yield file
+        stack += directories
+
+def _scan_directory(path, identifier, ignored=None, stat=False):
+    """
+    Return the identifiers of the files in the directory path, whose
+    identifier is identifier, and the paths and identifiers of the
+    directories in it, leaving out those ignored() matches. If stat is True
+    the files are the regular files, with their stat as walk_files() gives.
+    """
+    files = []
+    directories = []
+    try:
+        entries = os.scandir(path)
+    except OSError:
+        # As os.walk, skip directories that can't be listed
+        return files, directories
+    with entries:
+        for entry in entries:
+            entry_identifier = identifier + os.sep + entry.name
+            if ignored and (ignored(entry.name) or ignored(entry_identifier)):
+                continue
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                if not entry.is_symlink():
+                    directories.append((entry.path, entry_identifier))
+            elif not stat:
+                files.append(entry_identifier)
+            else:
+                try:
+                    file_stat = entry.stat()
+                except OSError:
+                    continue
+                if S_ISREG(file_stat.st_mode):
+                    files.append((entry_identifier, _stat_key(file_stat)))
+    return files, directories
+
+def _stat_key(file_stat):
+    return (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino)
+
 def in_directory(file, directory):
     #make both absolute
     directory = os.path.join(os.path.realpath(directory), '')
-    file = os.path.realpath(file)
+    # With a trailing separator so the directory itself is in it
+    file = os.path.join(os.path.realpath(file), '')
 
     #return true, if the common prefix of both is equal to directory
     #e.g. /a/b/c/d.rst and directory is /a/b, the common prefix is /a/b
     return os.path.commonprefix([file, directory]) == directory
 
 
-def add(dir, file_or_directory, createdBy=None, createdOn=None, mediatype=None, recursive=False, verbose=False, force=False):
+def add(dir, file_or_directory, createdBy=None, createdOn=None, mediatype=None, recursive=False, verbose=False, force=False, workers=None, checksums=None):
     """
     Add files to a research object manifest
 
     ro add [ -d dir ] file
     ro add [ -d dir ] [-r] [directory]
 
-    Use -r/--recursive to add subdirectories recursively
+    Use -r/--recursive to add subdirectories recursively, listing them with
+    workers threads (default WALK_WORKERS)
+
+    checksums are the algorithms of the checksums recorded for each file
+    added (default fixity.DEFAULT_ALGORITHMS), () records none.
+
+    Files already aggregated whose size, modification time and inode are
+    the same as when they were last added, with the same checksums, are
+    skipped, as recorded in the stat cache in .ro. Use force to add them
+    again.
 
     If no file or directory specified, defaults to current directory.
     """
@@ -253,31 +439,68 @@ def add(dir, file_or_directory, createdBy=None, createdOn=None, mediatype=None,
         print("Error: Can't add files outside the ro directory")
         return 1
 
-    files = []
+    # Files modified since this aren't put in the stat cache
+    recent = time.time_ns() - STAT_CACHE_RACE
+    # The files to add, with their stat
+    entries = []
     if os.path.isdir(file_or_directory):
+        # Identifiers are made by joining names onto that of the directory,
+        # rather than with os.path.relpath() for every file
+        directory = os.path.relpath(file_or_directory, dir)
+        directory = "" if directory == os.curdir else os.sep + directory
         if recursive:
-            for dirpath, dirnames, filenames in os.walk(file_or_directory):
-                #make the path relative to the top dir of the ro
-                dirpath = os.path.relpath(dirpath, dir)
-                files += [os.path.join(dirpath, filename) for filename in filenames]
+            # The research object's own files in .ro are never aggregated
+            ignore = (os.sep + MANIFEST_DIR,) if not directory else ()
+            entries = ((directory + file, file_stat) for file, file_stat in
+                       walk_files(file_or_directory, ignore, workers or WALK_WORKERS, stat=True))
         else:
-            files = [os.path.join(file_or_directory, filename) for filename in os.listdir(file_or_directory) if os.path.isfile(os.path.join(file_or_directory, filename))]
+            entries = [(directory + file, file_stat) for file, file_stat in
+                       _scan_directory(file_or_directory, "", stat=True)[0]]
     else:
         if os.path.isfile(file_or_directory):
-            files = [file_or_directory]
+            entries = [(sanitize_filename_for_identifier(file_or_directory, dir),
+                        _stat_key(os.stat(file_or_directory)))]
         else:
             print("Error - File does not exist: {}".format(file_or_directory))
     # Read and update manifest
     if verbose:
         print("ro add -d ") #TODO fix print
-    manifest_file_path = manifest_file(dir)
-    manifest = Manifest(filename=manifest_file_path)
-    for file in files:
-        file = sanitize_filename_for_identifier(file, dir)
-        manifest.add_aggregate(file, createdBy=createdBy, createdOn=createdOn, mediatype=mediatype)
+    manifest = read_manifest(dir, lazy=True, writable=True)
+    if checksums is None:
+        checksums = fixity.DEFAULT_ALGORITHMS
+    checksums = tuple(checksums)
+    # Files already aggregated that haven't changed since they were added,
+    # with the same checksums, are skipped unless forced
+    stat_cache = read_stat_cache(dir)
+    files = []
+    for file, file_stat in entries:
+        file_stat += (checksums,)
+        if not force and stat_cache.get(file) == file_stat and file in manifest.aggregates:
+            continue
+        files.append(file)
+        if file_stat[1] < recent:
+            stat_cache[file] = file_stat
+        else:
+            stat_cache.pop(file, None)
+    if checksums:
+        # Hash the files several at a time, identifiers are joined onto dir.
+        # As the walk does, skip files removed or made unreadable since
+        paths = [os.path.join(dir, file[1:]) for file in files]
+        hashed = []
+        for file, sums in zip(files, fixity.checksums(paths, checksums, skip_errors=True)):
+            if sums is None:
+                stat_cache.pop(file, None)
+            else:
+                hashed.append(Aggregate(file, checksums=sums))
+        files = hashed
+    manifest.add_aggregates(files, createdBy=createdBy, createdOn=createdOn, mediatype=mediatype)
 
-    with open(manifest_file_path, 'w') as manifest_filehandle:
-        manifest_filehandle.write(manifest.to_json())
+    write_manifest(dir, manifest)
+    # Forget the files no longer aggregated
+    aggregated = {file: file_stat for file, file_stat in stat_cache.items()
+                  if file in manifest.aggregates}
+    if files or len(aggregated) != len(stat_cache):
+        write_stat_cache(dir, aggregated)
 
     return 0
 
@@ -288,9 +511,8 @@ def remove(dir, file_uri_or_pattern, verbose=False, regexp=False):
     remove [ -d <dir> ] <file-or-uri>
     remove -d <dir> -w <pattern>
     """
-    #Get the manifest file for this ro
-    manifest_file_path = manifest_file(dir)
-    manifest = Manifest(filename=manifest_file_path)
+    #Get the manifest for this ro
+    manifest = read_manifest(dir, lazy=True, writable=True)
 
     if regexp:
         try:
@@ -310,8 +532,7 @@ def remove(dir, file_uri_or_pattern, verbose=False, regexp=False):
         if annotation:
             manifest.remove_annotation(annotation)
 
-    with open(manifest_file_path, 'w') as manifest_filehandle:
-        manifest_filehandle.write(manifest.to_json())
+    write_manifest(dir, manifest)
 
     return 0
 
@@ -331,9 +552,9 @@ def list(dir):
         print("Could not find manifest file: {}".format(manifestfilepath))
         return 1
 
-    manifest = Manifest(filename=manifestfilepath)
+    manifest = read_manifest(dir, lazy=True)
     print("{} aggregates:".format(manifest.id))
-    aggregates = [aggregate.uri for aggregate in manifest.aggregates]
+    aggregates = [aggregate for aggregate in manifest.aggregates.ids()]
     for aggregate in aggregates:
         print("       {}".format(aggregate))
 
@@ -351,7 +572,7 @@ def annotate(dir, file_uri_or_pattern, attributename=None, attributevalue=None,
         print("Could not find manifest file: {}".format(manifestfilepath))
         return 1
 
-    manifest = Manifest(filename=manifestfilepath)
+    manifest = read_manifest(dir, writable=True)
     files = []
     if regexp:
         try:
@@ -372,8 +593,7 @@ def annotate(dir, file_uri_or_pattern, attributename=None, attributevalue=None,
                     annotation_file_or_uri = sanitize_filename_for_identifier(annotation_file_or_uri, dir)
             manifest.add_annotation(about=file, contents=annotation_file_or_uri)
 
-    with open(manifestfilepath, 'w') as manifest_filehandle:
-        manifest_filehandle.write(manifest.to_json())
+    write_manifest(dir, manifest)
 
 
     return 0
@@ -389,11 +609,13 @@ def annotations(dir, file=None):
         print("Could not find manifest file: {}".format(manifestfilepath))
         return 1
 
-    manifest = Manifest(filename=manifestfilepath)
+    manifest = read_manifest(dir, lazy=True)
     print("Annotations:")
-    for annotation in manifest.annotations:
-        if file and annotation.about and annotation.about != file:
-            continue
+    if file:
+        annotations = manifest.annotations_about(file)
+    else:
+        annotations = manifest.annotations
+    for annotation in annotations:
         print("---")
         print("id:       {}".format(annotation.uri))
         if annotation.about:
@@ -412,23 +634,33 @@ def manifest(dir):
         print("Could not find manifest file: {}".format(manifestfilepath))
         return 1
 
+    if os.path.isfile(manifest_journal_file(dir)):
+        write_manifest(dir, read_manifest(dir, lazy=True), fold=True)
     with open(manifestfilepath) as manifestfile:
         for line in manifestfile:
             print(line,end='')
     print("")
     return 0
 
-def bundle(dir, file):
+def bundle(dir, file, update=False):
     """
     Create a Research Object Bundle
+
+    ro bundle [ -d dir ] [ -f file ] [ -u ]
+
+    Use -u/--update to only write the files that have changed since the
+    bundle in file was made, rather than making it again.
     """
     manifestfilepath = manifest_file(dir)
     if not directory_and_manifest_exist(dir):
         print("Could not find manifest file: {}".format(manifestfilepath))
         return 1
 
-    manifest = Manifest(filename=manifestfilepath)
-    bundle = Bundle.create_from_manifest(file, manifest)
+    manifest = read_manifest(dir)
+    if update:
+        bundle = Bundle.update_from_manifest(file, manifest)
+    else:
+        bundle = Bundle.create_from_manifest(file, manifest)
     bundle.close()
 
 
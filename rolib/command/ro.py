@@ -62,15 +62,15 @@ def run(config, options):
     elif cmd == "init":
         status = command.init(options.name, config["robase"], creator=config["username"], verbose=options.verbose, force=options.force)
     elif cmd == "status":
-        status = command.status(config["robase"], verbose=options.verbose)
+        status = command.status(config["robase"], verbose=options.verbose, ignore=options.ignore, prune_manifest_dir=options.prune_ro)
     elif cmd == "add":
-        status = command.add(config["robase"], options.file, recursive=options.recursive ,verbose=options.verbose)
+        status = command.add(config["robase"], options.file, recursive=options.recursive ,verbose=options.verbose, force=options.force, workers=options.jobs, checksums=options.checksums)
     elif cmd == "remove":
         status = command.remove(config["robase"], options.file_or_uri, options.verbose, options.regexp)
     elif cmd == "ls":
         status = command.list(config["robase"])
     elif cmd == "bundle":
-        status = command.bundle(config["robase"], options.file)
+        status = command.bundle(config["robase"], options.file, update=options.update)
     elif cmd in ["annotate"]:
         status = command.annotate(config["robase"], file_uri_or_pattern=options.about, annotation_file_or_uri=options.contents, regexp=options.regexp)
     elif cmd == "annotations":
@@ -203,6 +203,24 @@ def parseCommandArgs(argv):
                       dest="recursive",
                       default=False,
                       help="Add all files in directory recursively")
+    parser_create.add_argument("-j", "--jobs",
+                      type=int,
+                      dest="jobs",
+                      metavar="<n>",
+                      default=None,
+                      help="Number of threads listing directories when adding recursively")
+    parser_create.add_argument("-c", "--checksum",
+                      action="append",
+                      dest="checksums",
+                      metavar="<algorithm>",
+                      choices=("sha256", "blake2b"),
+                      default=None,
+                      help="Checksum to record for each file, sha256 (the default) or blake2b, may be repeated")
+    parser_create.add_argument("--no-checksum",
+                      action="store_const",
+                      dest="checksums",
+                      const=[],
+                      help="Don't record checksums of the files")
 
     parser_create = subparsers.add_parser("remove", prog="remove")
     parser_create.add_argument("-d", "--ro-directory",
@@ -223,6 +241,17 @@ def parseCommandArgs(argv):
                       dest="rodir",
                       metavar="<dir>",
                       help="Directory of Research Object (defaults to current directory)")
+    parser_create.add_argument("-i", "--ignore",
+                      action="append",
+                      dest="ignore",
+                      metavar="<pattern>",
+                      default=[],
+                      help="Glob pattern of files and directories not to list as unaggregated, may be repeated")
+    parser_create.add_argument("--prune-ro",
+                      action="store_true",
+                      dest="prune_ro",
+                      default=False,
+                      help="Don't list the files in the .ro directory as unaggregated")
 
     parser_create = subparsers.add_parser("ls", prog="ls")
     parser_create.add_argument("-d", "--ro-directory",
@@ -240,6 +269,11 @@ def parseCommandArgs(argv):
                       dest="file",
                       metavar="<file>",
                       help="Filename to use for research object bundle")
+    parser_create.add_argument("-u", "--update",
+                      action="store_true",
+                      dest="update",
+                      default=False,
+                      help="Update an existing bundle, only writing the files that have changed")
 
     parser_create = subparsers.add_parser("manifest", prog="manifest")
     parser_create.add_argument("-d", "--ro-directory",
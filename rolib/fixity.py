@@ -0,0 +1,83 @@
+"""
+Checksums of the files aggregated by a research object, recorded in the
+manifest as the fixity information of their Aggregate:
+
+    "checksums": {"sha256": "<hex digest>", "blake2b": "<hex digest>"}
+
+    from rolib import fixity
+    fixity.checksum("data.csv")
+    fixity.checksums(filenames, algorithms=("sha256", "blake2b"), workers=4)
+
+Files are read in large blocks, each one fed to every algorithm, so a file
+is only read once however many checksums are made of it. hashlib releases
+the GIL while it hashes, so checksums() hashes several files at once in
+threads.
+"""
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from rolib.packages.parallel import parallel_map
+
+ALGORITHMS = ("sha256", "blake2b")
+DEFAULT_ALGORITHMS = ("sha256",)
+
+# Size of the blocks files are read in
+READ_SIZE = 1024 * 1024
+
+# Threads hashing files at once, which spend much of their time reading
+HASH_WORKERS = 4
+
+
+def check_algorithms(algorithms):
+    """Raise ValueError if any of algorithms is not one of ALGORITHMS"""
+    for algorithm in algorithms:
+        if algorithm not in ALGORITHMS:
+            raise ValueError("Unsupported checksum algorithm: {}".format(algorithm))
+
+
+def _hashes(algorithms):
+    check_algorithms(algorithms)
+    return [hashlib.new(algorithm) for algorithm in algorithms]
+
+
+def checksum(filename, algorithms=DEFAULT_ALGORITHMS):
+    """Return a dictionary of the hex digests of the contents of filename,
+    by algorithm"""
+    hashes = _hashes(algorithms)
+    buffer = bytearray(READ_SIZE)
+    view = memoryview(buffer)
+    with open(filename, "rb", buffering=0) as fp:
+        while True:
+            length = fp.readinto(buffer)
+            if not length:
+                break
+            for hash in hashes:
+                hash.update(view[:length])
+    return {algorithm: hash.hexdigest() for algorithm, hash in zip(algorithms, hashes)}
+
+
+def checksum_bytes(data, algorithms=DEFAULT_ALGORITHMS):
+    """As checksum(), for the bytes data"""
+    hashes = _hashes(algorithms)
+    for hash in hashes:
+        hash.update(data)
+    return {algorithm: hash.hexdigest() for algorithm, hash in zip(algorithms, hashes)}
+
+
+def _checksum_if_readable(filename, algorithms):
+    try:
+        return checksum(filename, algorithms)
+    except OSError:
+        return None
+
+
+def checksums(filenames, algorithms=DEFAULT_ALGORITHMS, workers=None, skip_errors=False):
+    """
+    Yield checksum() of each of filenames in order, hashing workers files
+    at once in threads (default HASH_WORKERS), as parallel_map() does. If
+    skip_errors is True None is yielded for a file that can't be read,
+    such as one removed since it was listed, rather than raising OSError.
+    """
+    check_algorithms(algorithms)
+    arguments = ((filename, algorithms) for filename in filenames)
+    function = _checksum_if_readable if skip_errors else checksum
+    return parallel_map(function, arguments, workers or HASH_WORKERS, ThreadPoolExecutor)
@@ -0,0 +1,166 @@
+"""
+The JSON encoder and decoder used to read and write manifests.
+
+The standard library json module is always available. When orjson is
+installed it is used instead, as it encodes much faster, with its output
+adjusted so that what is written is byte for byte what json.dumps() writes.
+
+    from rolib import jsoncodec
+    jsoncodec.loads('{"id": "/"}')
+    jsoncodec.dumps(obj, indent=4, default=None)
+    jsoncodec.set_codec("json")
+"""
+import json
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class JSONCodec(object):
+    """Encodes and decodes JSON with the standard library json module"""
+
+    name = "json"
+
+    def loads(self, data):
+        """Decode the JSON document data, a str or bytes"""
+        return json.loads(data)
+
+    def load(self, fp):
+        return self.loads(fp.read())
+
+    def dumps(self, obj, indent=None, default=None):
+        """
+        Encode obj as a str, with indent spaces per level, or compactly
+        without spaces if indent is None. Non ASCII characters are escaped.
+        default is called for objects that can't otherwise be encoded.
+        """
+        if indent is None:
+            return json.dumps(obj, separators=(",", ":"), default=default)
+        return json.dumps(obj, indent=indent, default=default)
+
+
+# Numbers with a fraction or exponent, which orjson and json format
+# differently, after a key, in a compact array or in an indented array
+_FLOAT = re.compile(r"-?[0-9]+[.eE]")
+_FLOAT_AFTER_KEY = re.compile(r'":\s?-?[0-9]+[.eE]')
+_FLOAT_IN_ARRAY = re.compile(r"[\[,]-?[0-9]+[.eE]")
+_FLOAT_IN_INDENTED_ARRAY = re.compile(r"[\[,]\n *-?[0-9]+[.eE]")
+# Makes every digit 0, to find integers orjson may decode as floats, as they
+# don't fit in 64 bits
+_DIGITS = str.maketrans("123456789", "000000000")
+_DIGITS_BYTES = bytes.maketrans(b"123456789", b"000000000")
+_LONG_NUMBER = "0" * 19
+_NON_ASCII = re.compile(r"[^\n\x20-\x7e]")
+# Stand in for each level of indentation while reindenting: the control
+# characters that are always escaped in strings, so never "\n"
+_LEVELS = [chr(code) for code in range(0x20) if chr(code) != "\n"]
+
+
+def _escape(match):
+    code = ord(match.group())
+    if code > 0xFFFF:
+        code -= 0x10000
+        return "\\u{:04x}\\u{:04x}".format(0xD800 | (code >> 10), 0xDC00 | (code & 0x3FF))
+    return "\\u{:04x}".format(code)
+
+
+def _floats(text, indented):
+    if indented:
+        return (_FLOAT.match(text) or _FLOAT_AFTER_KEY.search(text) or
+                _FLOAT_IN_INDENTED_ARRAY.search(text))
+    return (_FLOAT.match(text) or _FLOAT_AFTER_KEY.search(text) or
+            _FLOAT_IN_ARRAY.search(text))
+
+
+def _reindent(text, indent):
+    """Change text indented by 2 spaces a level to indent spaces a level"""
+    # Strings can't hold a raw newline or control character, so each level's
+    # indentation is swapped for a control character, deepest first, and then
+    # for the new indentation
+    depth = 0
+    while "\n" + "  " * (depth + 1) in text:
+        depth += 1
+    if depth >= len(_LEVELS):
+        return None
+    for level in range(depth, 0, -1):
+        text = text.replace("\n" + "  " * level, _LEVELS[level])
+    for level in range(1, depth + 1):
+        text = text.replace(_LEVELS[level], "\n" + " " * (indent * level))
+    return text
+
+
+class OrjsonCodec(JSONCodec):
+    """
+    Encodes and decodes JSON with orjson, falling back to json for what
+    orjson doesn't support (e.g. integers of more than 64 bits or NaN) or
+    may write differently (floats and null, which it writes for NaN).
+    """
+
+    name = "orjson"
+
+    def loads(self, data):
+        if isinstance(data, str):
+            long_number = _LONG_NUMBER in data.translate(_DIGITS)
+        else:
+            long_number = _LONG_NUMBER.encode() in bytes(data).translate(_DIGITS_BYTES)
+        if not long_number:
+            try:
+                return orjson.loads(data)
+            except orjson.JSONDecodeError:
+                # Let json decide, and raise its error if it is invalid
+                pass
+        return super(OrjsonCodec, self).loads(data)
+
+    def dumps(self, obj, indent=None, default=None):
+        # Leave what json can't encode to default, as json would
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+        if indent is not None:
+            option |= orjson.OPT_INDENT_2
+        try:
+            text = orjson.dumps(obj, default=default, option=option).decode("utf-8")
+        except orjson.JSONEncodeError:
+            text = None
+        if text is not None and "null" not in text and not _floats(text, indent is not None):
+            if indent is not None and indent != 2:
+                text = _reindent(text, indent)
+            if text is not None:
+                if text.isascii() and "\x7f" not in text:
+                    return text
+                return _NON_ASCII.sub(_escape, text)
+        return super(OrjsonCodec, self).dumps(obj, indent, default)
+
+
+CODECS = {JSONCodec.name: JSONCodec}
+if orjson is not None:
+    CODECS[OrjsonCodec.name] = OrjsonCodec
+
+_codec = OrjsonCodec() if orjson is not None else JSONCodec()
+
+
+def get_codec():
+    return _codec
+
+
+def set_codec(name):
+    """Use the codec called name, one of CODECS, returning the codec used before"""
+    global _codec
+    if name not in CODECS:
+        raise ValueError("Unknown or unavailable JSON codec: {}".format(name))
+    previous = _codec
+    _codec = CODECS[name]()
+    return previous.name
+
+
+def loads(data):
+    return _codec.loads(data)
+
+
+def load(fp):
+    return _codec.load(fp)
+
+
+def dumps(obj, indent=None, default=None):
+    return _codec.dumps(obj, indent, default)
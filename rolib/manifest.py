@@ -2,17 +2,23 @@
 # ro_manifest.py
 """Research Object manifest read, write, decode functions
 """
+import io
 import sys
 import os
 import os.path
 import json
+import marshal
 import re
+import struct
+import tempfile
+import time
 import logging
 import ssl
 from abc import ABCMeta
 from datetime import datetime
 import codecs
 import uuid
+from collections.abc import MutableSequence
 
 
 try:
@@ -34,6 +40,8 @@ from rdflib.namespace import RDF, DCTERMS
 
 #from namespaces import RO, OA, ORE, BUNDLE, PAV
 
+from rolib import jsoncodec
+
 
 log = logging.getLogger(__name__)
 
@@ -104,14 +112,31 @@ class JSONLDObject(SimpleNamespace, object):
     """
     A class that provides attribute based access to an instances __dict__
 
+    Values of the properties registered with register_class_for_property()
+    are objectified into the registered class, or a list of them, when the
+    object is created or the property is set.
     """
+
+    # property -> class its values are objectified into
+    _property_classes = {}
+
     def __init__(self, **kwargs):
         super(JSONLDObject, self).__init__(**kwargs)
-        #self.__getattribute__ = JSONLDObject.__getattribute__
+        for property, cls in self._property_classes.items():
+            value = self.__dict__.get(property)
+            if value is not None:
+                self.__dict__[property] = _objectify(value, cls)
 
     @classmethod
     def register_class_for_property(cls , property, newCls):
-        pass
+        """
+        Objectify the values of property into newCls, for this class and its
+        subclasses. Register properties before subclasses register their own.
+        """
+        if "_property_classes" not in cls.__dict__:
+            # Copy on write so the registry of a base class is left alone
+            cls._property_classes = dict(cls._property_classes)
+        cls._property_classes[property] = newCls
 
     @property
     def context(self):
@@ -121,36 +146,11 @@ class JSONLDObject(SimpleNamespace, object):
     def context(self, value):
         self.__dict__["@context"] = value
 
-
-    def __getattribute__(self, attr):
-        """
-
-        """
-        map = {"annotations": Annotation,"aggregates": Aggregate, "authoredBy": Agent, "createdBy": Agent, "curatedBy": Agent, "contributedBy": Agent, "retrievedBy": Agent}
-
-        if(attr in map.keys()):
-            cls = map[attr]
-            value = super(JSONLDObject, self).__getattribute__(attr)
-            if value is not None:
-                if isinstance(value,list):
-                    #use a copy of the list being returned as we might be modifying it
-                    for i in list(value):
-                        if not isinstance(i,cls):
-                            #Objectify the value and replace original with objectified
-                            #version in the __dict__
-                            object = cls(**i)#TODO might not be a dict
-                            value.remove(i)
-                            value.append(object)
-                elif not isinstance(value,cls):
-                    try:
-                        value = cls(**value)
-                    except TypeError:
-                        value = cls(value)
-                    self.__setattr__(attr,value)
-            return value
-        else:
-            return super(JSONLDObject, self).__getattribute__(attr)
-
+    def __setattr__(self, attr, value):
+        cls = self._property_classes.get(attr)
+        if cls is not None and value is not None:
+            value = _objectify(value, cls)
+        super(JSONLDObject, self).__setattr__(attr, value)
 
     def populated(self):
         """
@@ -160,6 +160,18 @@ class JSONLDObject(SimpleNamespace, object):
         return {key: value for (key,value) in self.__dict__.items() if value is not None}
 
 
+def _objectify(value, cls):
+    """Return value as an instance of cls, or a list of them"""
+    if isinstance(value, list):
+        return [_objectify(v, cls) for v in value]
+    if isinstance(value, cls):
+        return value
+    try:
+        return cls(**value)
+    except TypeError:
+        return cls(value)
+
+
 class ManifestEntry(JSONLDObject):
 
     #Does this need to be ab Abstract Base Class anymore?
@@ -178,6 +190,12 @@ class ManifestEntry(JSONLDObject):
     def id(self, id):
         self.uri = id
 
+    @classmethod
+    def id_from_json(cls, contents):
+        """Return the id of the entry that would be made from the JSON object
+        contents, without making it"""
+        return contents.get("uri")
+
     def __hash__(self):
         return hash(self.id)
 
@@ -185,6 +203,344 @@ class ManifestEntry(JSONLDObject):
         return self.id.__eq__(rhs.id)
 
 
+# Stands in for an entry of a ManifestEntryList that hasn't been loaded yet
+_DEFERRED = object()
+
+
+class ManifestEntryList(MutableSequence):
+    """
+    The ManifestEntry objects held in a list property of a manifest, such as
+    its aggregates or annotations, kept in order and indexed by id so that
+    lookups, replacements and removals don't scan the list.
+
+    Entries are objectified into cls as they are added. Appending an entry
+    with the same id as an existing one replaces it, moving it to the end.
+    An entry's id must not be changed while it is in the list.
+
+    Indexing uses a list of the ids in order, made when the list is first
+    indexed after entries are removed or inserted, so looping over the list
+    by index is linear. Inserting an entry other than at the end, or
+    replacing one with an entry with a different id, rebuilds the index.
+
+    If lazy is True entries added as JSON objects (dicts) are kept as they
+    are and only objectified when they are first accessed. ids() iterates
+    over the entries without objectifying them.
+
+    While _changes is a list, the entries added ("add"), inserted
+    ("insert"), replaced in place ("update") and removed ("remove") are
+    recorded in it, to be written to a manifest journal. The entries handed
+    out meanwhile are fingerprinted so that _take_changes() can also record
+    those changed in place.
+    """
+
+    def __init__(self, cls, entries=(), lazy=False):
+        self._cls = cls
+        self._entries = {}
+        self._deferred = None
+        # The ids in order, or None until the list is next indexed
+        self._order = None
+        self._changes = None
+        # id -> fingerprint of each entry handed out while recording changes
+        self._fingerprints = {}
+        self.lazy = lazy
+        for entry in entries:
+            self.append(entry)
+
+    def _defer(self, ids, load):
+        """
+        Fill the empty list with entries whose JSON objects are only loaded,
+        all at once, when one of them is first needed. load() returns them
+        in the order of ids. If the list isn't lazy they are loaded now.
+        """
+        if not self.lazy:
+            for entry in load():
+                self.append(entry)
+            return
+        self._deferred = (ids, load)
+        self._entries = dict.fromkeys(ids, _DEFERRED)
+        self._order = None
+
+    def _undefer(self):
+        ids, load = self._deferred
+        self._deferred = None
+        for id, entry in zip(ids, load()):
+            if self._entries.get(id) is _DEFERRED:
+                self._entries[id] = entry
+
+    def _objectify(self, entry):
+        if not isinstance(entry, self._cls):
+            entry = self._cls(**entry)#TODO might not be a dict
+        return entry
+
+    def _id(self, entry_or_id):
+        if isinstance(entry_or_id, ManifestEntry):
+            return entry_or_id.id
+        return entry_or_id
+
+    def _entry(self, id):
+        """Return the entry with this id, objectifying it if need be"""
+        entry = self._entries[id]
+        if entry is _DEFERRED:
+            self._undefer()
+            entry = self._entries[id]
+        if isinstance(entry, dict):
+            entry = self._entries[id] = self._objectify(entry)
+        if self._changes is not None and id not in self._fingerprints:
+            self._fingerprints[id] = _fingerprint(entry)
+        return entry
+
+    def get(self, id, default=None):
+        """Return the entry with this id, or default if there is none"""
+        if id not in self._entries:
+            return default
+        return self._entry(id)
+
+    def ids(self):
+        """Return a view of the ids of the entries, in order"""
+        return self._entries.keys()
+
+    def json_entries(self):
+        """Return the entries for serialising, untouched lazy entries are
+        returned as the JSON objects they were read from"""
+        if self._deferred is not None:
+            self._undefer()
+        return list(self._entries.values())
+
+    def __contains__(self, entry_or_id):
+        return self._id(entry_or_id) in self._entries
+
+    def __iter__(self):
+        for id in self._entries:
+            yield self._entry(id)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _ids(self):
+        """Return the list of the ids in order"""
+        if self._order is None:
+            self._order = list(self._entries)
+        return self._order
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._entry(id) for id in self._ids()[i]]
+        return self._entry(self._ids()[i])
+
+    def __setitem__(self, i, entry):
+        if isinstance(i, slice):
+            entries = list(entry)
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                positions = range(start, stop, step)
+                if len(entries) != len(positions):
+                    raise ValueError("attempt to assign sequence of size {} to extended "
+                                     "slice of size {}".format(len(entries), len(positions)))
+                for position, entry in zip(positions, entries):
+                    self[position] = entry
+                return
+            del self[i]
+            for position, entry in enumerate(entries, start):
+                self.insert(position, entry)
+            return
+        id = self._ids()[i]
+        new_id, entry = self._identify(entry)
+        if new_id == id:
+            self.update(entry)
+            return
+        position = range(len(self))[i]
+        self._discard(id)
+        self.insert(position, entry)
+
+    def __delitem__(self, i):
+        if isinstance(i, slice):
+            for id in self._ids()[i]:
+                self._discard(id)
+        else:
+            self._discard(self._ids()[i])
+
+    def insert(self, i, entry):
+        id, entry = self._identify(entry)
+        self._discard(id)
+        # Positions past either end are clamped, as list.insert() does
+        position = max(0, min(len(self), i if i >= 0 else len(self) + i))
+        if position == len(self):
+            self.append(entry)
+            return
+        entries = self._entries
+        self._entries = {}
+        for existing in entries:
+            if len(self._entries) == position:
+                self._entries[id] = entry
+            self._entries[existing] = entries[existing]
+        self._order = None
+        self._index(id, entry)
+        self._record("insert", [position, entry])
+
+    def _identify(self, entry):
+        """Return the id of entry and entry, objectified unless it is kept
+        as JSON"""
+        if self.lazy and isinstance(entry, dict):
+            return self._cls.id_from_json(entry), entry
+        entry = self._objectify(entry)
+        return entry.id, entry
+
+    def append(self, entry):
+        id, entry = self._identify(entry)
+        self._discard(id)
+        self._entries[id] = entry
+        if self._order is not None:
+            self._order.append(id)
+        self._index(id, entry)
+        self._record("add", entry)
+
+    def update(self, entry):
+        """Replace the entry with the same id as entry where it is in the
+        list, or append entry if there is none"""
+        id, entry = self._identify(entry)
+        if id not in self._entries:
+            self.append(entry)
+            return
+        self._unindex(id, self._entries[id])
+        self._fingerprints.pop(id, None)
+        self._entries[id] = entry
+        self._index(id, entry)
+        self._record("update", entry)
+
+    def remove(self, entry_or_id):
+        if not self._discard(self._id(entry_or_id)):
+            raise ValueError("{} is not in the list".format(entry_or_id))
+
+    def _discard(self, id):
+        entry = self._entries.pop(id, None)
+        if entry is None:
+            return False
+        self._unindex(id, entry)
+        self._fingerprints.pop(id, None)
+        self._order = None
+        self._record("remove", id)
+        return True
+
+    def _record(self, change, value):
+        if self._changes is not None:
+            self._changes.append((change, value))
+
+    def _take_changes(self):
+        """
+        Return the changes recorded since they were last taken, with an
+        "update" for each entry handed out since that has been changed in
+        place, and start recording afresh from the entries as they are now
+        """
+        for id, fingerprint in self._fingerprints.items():
+            entry = self._entries[id]
+            if _fingerprint(entry) != fingerprint:
+                self._record("update", entry)
+        changes, self._changes = self._changes, []
+        # Entries written are followed from how they were written
+        for change, value in changes:
+            if change in ("add", "update") and isinstance(value, self._cls):
+                if self._entries.get(value.id) is value:
+                    self._fingerprints[value.id] = _fingerprint(value)
+        return changes
+
+    def _apply(self, change, value):
+        """Make a change read back from a manifest journal"""
+        if change == "add":
+            self.append(value)
+        elif change == "update":
+            self.update(value)
+        elif change == "remove":
+            self._discard(value)
+        elif change == "insert":
+            self.insert(*value)
+        elif change == "clear":
+            self.clear()
+        else:
+            raise ValueError("Unknown manifest journal change: {}".format(change))
+
+    def _index(self, id, entry):
+        """Called when entry is added, for subclasses keeping other indexes"""
+        pass
+
+    def _unindex(self, id, entry):
+        """Called when entry is removed"""
+        pass
+
+    def clear(self):
+        self._entries.clear()
+        self._fingerprints.clear()
+        self._deferred = None
+        self._order = None
+        self._record("clear", None)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class AnnotationList(ManifestEntryList):
+    """
+    The annotations of a manifest, also indexed by the resources they are
+    about. An annotation may be about a single resource or a list of them.
+    If the about of an annotation in the list is changed it must be
+    reindexed.
+    """
+
+    def __init__(self, entries=(), lazy=False):
+        self._about = {}
+        self._indexed_about = {}
+        super(AnnotationList, self).__init__(Annotation, entries, lazy)
+
+    def about(self, uri):
+        """Return the annotations about the resource uri, in order"""
+        return [self._entry(id) for id in self._about.get(uri, ())]
+
+    def _defer(self, ids, load, abouts=()):
+        """As ManifestEntryList._defer(), abouts holds the resources each
+        annotation is about, in the order of ids"""
+        for id, uris in zip(ids, abouts if self.lazy else ()):
+            self._indexed_about[id] = uris
+            for uri in uris:
+                self._about.setdefault(uri, {})[id] = None
+        super(AnnotationList, self)._defer(ids, load)
+
+    def reindex(self, annotation):
+        """Bring the index in line with a changed annotation.about"""
+        self._unindex(annotation.id, annotation)
+        self._index(annotation.id, annotation)
+        self._record("update", annotation)
+
+    def _index(self, id, annotation):
+        if isinstance(annotation, dict):
+            abouts = _about_uris(annotation.get("about"))
+        else:
+            abouts = _about_uris(annotation.about)
+        self._indexed_about[id] = abouts
+        for uri in abouts:
+            # A dict is used as an ordered set of annotation ids
+            self._about.setdefault(uri, {})[id] = None
+
+    def _unindex(self, id, annotation):
+        for uri in self._indexed_about.pop(id, ()):
+            ids = self._about[uri]
+            ids.pop(id, None)
+            if not ids:
+                del self._about[uri]
+
+    def clear(self):
+        super(AnnotationList, self).clear()
+        self._about.clear()
+        self._indexed_about.clear()
+
+
+def _about_uris(about):
+    """Return the resources in the about of an annotation as a tuple"""
+    if about is None:
+        return ()
+    if isinstance(about, (list, tuple)):
+        return tuple(uri for uri in about if isinstance(uri, str))
+    return (about,)
+
+
 class Agent(ManifestEntry):
 
     def __init__(self, name, uri=None, orcid=None, **kwargs):
@@ -195,11 +551,22 @@ class Agent(ManifestEntry):
         id = self.uri or self.name
         return id
 
+    @classmethod
+    def id_from_json(cls, contents):
+        return contents.get("uri") or contents.get("name")
+
     @id.setter
     def id(self, id):
         self.uri = id
 
 
+JSONLDObject.register_class_for_property("authoredBy", Agent)
+JSONLDObject.register_class_for_property("createdBy", Agent)
+JSONLDObject.register_class_for_property("curatedBy", Agent)
+JSONLDObject.register_class_for_property("contributedBy", Agent)
+JSONLDObject.register_class_for_property("retrievedBy", Agent)
+
+
 class Aggregate(ManifestEntry, ProvenancePropertiesMixin):
 
     def __init__(self, uri, createdBy=None, createdOn=None, mediatype=None, **kwargs):
@@ -214,40 +581,279 @@ class Annotation(ManifestEntry, ProvenancePropertiesMixin):
             uri = uuid.uuid4().urn
         super().__init__(uri=uri, about=about, content=content, **kwargs)
 
+    @classmethod
+    def id_from_json(cls, contents):
+        if not contents.get("uri"):
+            # Annotations without a uri are given one when they are made
+            contents["uri"] = uuid.uuid4().urn
+        return contents["uri"]
+
 
 class Manifest(ManifestEntry, ProvenancePropertiesMixin):
+    """
+    A Research Object manifest.
+
+    m = Manifest(id="/", filename=None, file=None, contents=None, lazy=False,
+                 cache=None, journal=None, writable=False)
+
+    The manifest is read from the file at filename, the file-like object file
+    or the already decoded JSON object contents, if one is given.
+
+    lazy: if True the aggregates and annotations read are kept as JSON
+          objects and only made into Aggregate and Annotation objects when
+          they are first accessed. aggregates.ids() lists them without
+          making any.
+
+    cache: a file to keep a binary snapshot of the manifest read from
+           filename in. The snapshot is read instead of the manifest while
+           the manifest's size, modification time and inode are unchanged,
+           and is rewritten otherwise, unless the manifest was modified in
+           the last couple of seconds. The aggregates and annotations of a lazy
+           manifest are only read from it when one is first accessed.
+
+    journal: a file of changes to the manifest made since it was last
+             written in full. The changes are made to the manifest read.
+             fold_journal() writes the whole manifest and removes the
+             journal.
+
+    writable: if True, with a journal, the changes made to the manifest
+              after it is read are kept for write_journal() to append to
+              the journal. Otherwise nothing is kept, so that reading the
+              manifest only to look at it costs no more for the journal.
+
+    In a writable manifest changes to the aggregates and annotations are
+    recorded as they are made. Entries changed in place, e.g. get_aggregate(uri).mediatype = ..., and
+    the manifest's other properties, such as its title, createdBy and
+    createdOn, are found when the journal is written by comparing them with
+    how they were when handed out or last written. Each entry handed out is
+    encoded once more for this.
+    """
+
+    # Kept out of __dict__, which holds the manifest's properties
+    __slots__ = ("_property_fingerprints",)
 
-    def __init__(self, id="/", filename=None, file=None, contents=None, format="json-ld"):
+    def __init__(self, id="/", filename=None, file=None, contents=None, format="json-ld",
+                 lazy=False, cache=None, journal=None, writable=False):
 
+        self._property_fingerprints = None
         self.id = id
         self.aggregates = []
         self.annotations = []
-        if filename is not None:
+        snapshot = None
+        if filename is not None and cache is not None:
+            snapshot = _read_snapshot(filename, cache)
+        if snapshot is not None:
+            contents = snapshot[0]
+        elif filename is not None:
+            # Taken before reading, so a change while reading goes unsnapshotted
+            stat = os.stat(filename)
             with open(filename) as file:
-                contents = json.load(file)
+                contents = jsoncodec.load(file)
+            _identify_annotations(contents.get("annotations"))
+            if cache is not None:
+                _write_snapshot(cache, stat, contents)
         elif file is not None:
             with file:
                 data = file.read()
                 if isinstance(data,bytes):
                     data = data.decode('UTF-8')
-                contents = json.loads(data)
+                contents = jsoncodec.loads(data)
+            _identify_annotations(contents.get("annotations"))
         if contents is not None:
             super(Manifest, self).__init__(**contents)
+        # Index the entries read in
+        self.__dict__["aggregates"] = ManifestEntryList(Aggregate, self.__dict__["aggregates"] or [], lazy)
+        self.__dict__["annotations"] = AnnotationList(self.__dict__["annotations"] or [], lazy)
+        if snapshot is not None:
+            self.aggregates._defer(*snapshot[1])
+            self.annotations._defer(*snapshot[2])
+        if journal is not None:
+            self._replay_journal(journal)
+        if journal is not None and writable:
+            for property in JOURNALED_PROPERTIES:
+                self.__dict__[property]._changes = []
+            self._property_fingerprints = self._fingerprint_properties()
+
+    @property
+    def aggregates(self):
+        return self.__dict__["aggregates"]
+
+    @aggregates.setter
+    def aggregates(self, aggregates):
+        old = self.__dict__.get("aggregates")
+        lazy = getattr(old, "lazy", False)
+        self.__dict__["aggregates"] = _replacement(
+            old, ManifestEntryList(Aggregate, aggregates or [], lazy))
+
+    @property
+    def annotations(self):
+        return self.__dict__["annotations"]
 
+    @annotations.setter
+    def annotations(self, annotations):
+        old = self.__dict__.get("annotations")
+        lazy = getattr(old, "lazy", False)
+        self.__dict__["annotations"] = _replacement(old, AnnotationList(annotations or [], lazy))
+
+    def _replay_journal(self, journal):
+        try:
+            fp = open(journal, encoding="utf-8")
+        except FileNotFoundError:
+            return
+        with fp:
+            for line in fp:
+                try:
+                    record = jsoncodec.loads(line)
+                except ValueError:
+                    # The last record is cut short if writing it was interrupted
+                    log.warning("Ignoring incomplete record at the end of {}".format(journal))
+                    break
+                property = record["property"]
+                if property in JOURNALED_PROPERTIES:
+                    self.__dict__[property]._apply(record["change"], record["value"])
+                else:
+                    self._apply_property(property, record["change"], record["value"])
+
+    def _apply_property(self, property, change, value):
+        """Make a change to a property other than the aggregates and
+        annotations read back from a manifest journal"""
+        if change == "set":
+            cls = self._property_classes.get(property)
+            if cls is not None and value is not None:
+                value = _objectify(value, cls)
+            self.__dict__[property] = value
+        elif change == "delete":
+            self.__dict__.pop(property, None)
+        else:
+            raise ValueError("Unknown manifest journal change: {}".format(change))
+
+    def _fingerprint_properties(self):
+        return {property: _fingerprint(value) for (property, value) in self.__dict__.items()
+                if property not in JOURNALED_PROPERTIES}
+
+    def _take_property_changes(self):
+        """Return the changes to the properties other than the aggregates
+        and annotations since they were last taken"""
+        fingerprints = self._fingerprint_properties()
+        changes = [("set", property, self.__dict__[property])
+                   for (property, fingerprint) in fingerprints.items()
+                   if self._property_fingerprints.get(property) != fingerprint]
+        changes += [("delete", property, None) for property in self._property_fingerprints
+                    if property not in fingerprints]
+        self._property_fingerprints = fingerprints
+        return changes
+
+    def write_journal(self, journal):
+        """
+        Append the changes made to the manifest since it was read, or last
+        written, to the journal file, a JSON record a line. The manifest
+        must have been read with a journal and writable.
+        """
+        if self._property_fingerprints is None:
+            raise ValueError("The manifest wasn't read with a journal and writable")
+        lines = []
+        changes = self._take_property_changes()
+        for property in JOURNALED_PROPERTIES:
+            changes += [(change, property, value) for (change, value)
+                        in self.__dict__[property]._take_changes()]
+        for change, property, value in changes:
+            record = {"change": change, "property": property, "value": value}
+            lines.append(jsoncodec.dumps(record, default=_json_default) + "\n")
+        if lines:
+            # Written at once, so that an interruption only cuts the last record short
+            with open(journal, "a", encoding="utf-8") as fp:
+                fp.write("".join(lines))
+
+    def fold_journal(self, filename, journal):
+        """
+        Write the whole manifest to filename, replacing it, and remove the
+        journal, as the manifest written holds its changes.
+        """
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(filename) or ".",
+                                         prefix=".manifest", delete=False) as fp:
+            self.write_json(fp)
+        if os.path.exists(filename):
+            os.chmod(fp.name, os.stat(filename).st_mode)
+        os.replace(fp.name, filename)
+        try:
+            os.unlink(journal)
+        except FileNotFoundError:
+            pass
+        if self._property_fingerprints is not None:
+            # The manifest written holds the changes so far
+            self._take_property_changes()
+            for property in JOURNALED_PROPERTIES:
+                self.__dict__[property]._take_changes()
 
     def to_json(self):
-        return json.dumps(self.__dict__, indent=4, cls=ManifestEncoder)
+        return jsoncodec.dumps(self.__dict__, indent=4, default=_json_default)
+
+    def write_json(self, fp, compact=False):
+        """
+        Write the manifest as JSON to the file-like object fp, which may be
+        opened in text or binary mode, e.g. a zip member opened for writing.
+
+        The document is encoded an aggregate or annotation at a time and
+        written in chunks, rather than built up as one string. The output is
+        the same as to_json() unless compact is True, when it is written
+        without indentation or spaces.
+        """
+        if compact:
+            indent, newline, key_separator = None, "", ":"
+        else:
+            indent, newline, key_separator = 4, "\n", ": "
+        writer = _ChunkedWriter(fp)
+        write = writer.write
+
+        def encode(value, level):
+            # Indent nested lines to the level the value is written at
+            text = jsoncodec.dumps(value, indent, _json_default)
+            return text.replace("\n", "\n" + " " * (4 * level)) if newline else text
+
+        write("{")
+        for i, (key, value) in enumerate(self.__dict__.items()):
+            if i:
+                write(",")
+            write(newline + " " * (4 * bool(newline)))
+            write(jsoncodec.dumps(key) + key_separator)
+            if isinstance(value, ManifestEntryList) and len(value):
+                write("[")
+                for j, entry in enumerate(value.json_entries()):
+                    if j:
+                        write(",")
+                    write(newline + " " * (8 * bool(newline)))
+                    write(encode(entry, 2))
+                write(newline + " " * (4 * bool(newline)) + "]")
+            else:
+                write(encode(value, 1))
+        if self.__dict__:
+            write(newline)
+        write("}")
+        writer.flush()
+
+    @classmethod
+    def iter_aggregates(cls, filename=None, file=None):
+        """
+        Yield the aggregates of the manifest in the file at filename, or the
+        file-like object file, one at a time. The manifest is read
+        incrementally so it is never held in memory as a whole.
+        """
+        return _iter_entries("aggregates", Aggregate, filename, file)
+
+    @classmethod
+    def iter_annotations(cls, filename=None, file=None):
+        """
+        Yield the annotations of the manifest in the file at filename, or the
+        file-like object file, one at a time (see iter_aggregates)
+        """
+        return _iter_entries("annotations", Annotation, filename, file)
 
 
     def get_aggregate(self, uri):
-        for a in self.aggregates:
-            if(a.uri == uri):
-                return a
+        return self.aggregates.get(uri)
 
     def get_annotation(self, uri):
-        for a in self.annotations:
-            if(a.uri == uri):
-                return a
+        return self.annotations.get(uri)
 
 
     def add_aggregate(self, aggregate_or_uri, createdBy=None, createdOn=None, mediatype=None):
@@ -265,10 +871,42 @@ class Manifest(ManifestEntry, ProvenancePropertiesMixin):
         aggregate.createdBy = createdBy or aggregate.createdBy
         aggregate.createdOn = createdOn or aggregate.createdOn
         aggregate.mediatype = mediatype or aggregate.mediatype
-        self.remove_aggregate(aggregate)
+        # Replaces any aggregate with the same id
         self.aggregates.append(aggregate)
         return aggregate
 
+    def add_aggregates(self, aggregates_or_uris, createdBy=None, createdOn=None, mediatype=None):
+        """
+        Adds each of the aggregates, as add_aggregate() does, returning the
+        number added. An aggregate given more than once is only added once,
+        where it was last given.
+
+        The Agent made for createdBy is shared by the aggregates that are
+        made from a uri, rather than one being made for each.
+        """
+        agent = createdBy if isinstance(createdBy, Agent) else Agent(createdBy)
+        if hasattr(createdOn, 'isoformat'):
+            createdOn = createdOn.isoformat()
+
+        aggregates = {}
+        for aggregate_or_uri in aggregates_or_uris:
+            if isinstance(aggregate_or_uri, Aggregate):
+                aggregate = aggregate_or_uri
+                aggregate.createdBy = (createdBy and agent) or aggregate.createdBy or agent
+                aggregate.createdOn = createdOn or aggregate.createdOn
+                aggregate.mediatype = mediatype or aggregate.mediatype
+            else:
+                aggregate = Aggregate(aggregate_or_uri, createdBy=agent, mediatype=mediatype)
+                if createdOn:
+                    aggregate.createdOn = createdOn
+            # Moved to the end, as appending it again would
+            aggregates.pop(aggregate.id, None)
+            aggregates[aggregate.id] = aggregate
+
+        for aggregate in aggregates.values():
+            self.aggregates.append(aggregate)
+        return len(aggregates)
+
 
 
     def remove_aggregate(self, aggregate_or_uri, remove_annotations=False):
@@ -279,7 +917,7 @@ class Manifest(ManifestEntry, ProvenancePropertiesMixin):
         if aggregate in self.aggregates:
             self.aggregates.remove(aggregate)
         if remove_annotations:
-            remove_annotations_for(aggregate)
+            self.remove_annotations_for(aggregate)
 
     def add_annotation(self, annotation_or_uri=None, about=None, content=None):
 
@@ -294,7 +932,9 @@ class Manifest(ManifestEntry, ProvenancePropertiesMixin):
         annotation.about = about or annotation.about
         annotation.content = content or annotation.content
 
-        if annotation not in self.annotations:
+        if self.annotations.get(annotation.id) is annotation:
+            self.annotations.reindex(annotation)
+        else:
             self.annotations.append(annotation)
         return annotation
 
@@ -306,14 +946,297 @@ class Manifest(ManifestEntry, ProvenancePropertiesMixin):
 
         self.annotations.remove(annotation)
 
+    def annotations_about(self, manifest_entry_or_uri):
+        """
+        Return the annotations that have this manifest_entry or uri as, or
+        among, their about
+        """
+        if isinstance(manifest_entry_or_uri, ManifestEntry):
+            manifest_entry_or_uri = manifest_entry_or_uri.id
+        return self.annotations.about(manifest_entry_or_uri)
+
     def remove_annotations_for(self, manifest_entry):
         """
-        Remove any annotations that have this manifest_entry as the about
+        Remove any annotations that have this manifest_entry as the about.
+        Annotations that are also about other resources are kept, with the
+        manifest_entry removed from their about
         """
-        for a in list(self.annotations):
-            if a.about == manifest_entry.id:
+        for a in self.annotations_about(manifest_entry):
+            if isinstance(a.about, list) and len(_about_uris(a.about)) > 1:
+                a.about = [uri for uri in a.about if uri != manifest_entry.id]
+                self.annotations.reindex(a)
+            else:
                 self.remove_annotation(a)
 
+# A manifest snapshot starts with a header holding the format, the size,
+# modification time and inode of the manifest it was made from and the
+# length of the index. The index - the marshalled properties, entry ids and
+# annotation abouts - is followed by the marshalled aggregates and
+# annotations.
+_SNAPSHOT_HEADER = struct.Struct("<4sHHqqQQQ")
+_SNAPSHOT_MAGIC = b"ROMS"
+_SNAPSHOT_VERSION = 2
+# Manifests modified this recently (in nanoseconds) aren't snapshotted, as
+# on filesystems with coarse timestamps they could be changed again without
+# their size or modification time changing
+_SNAPSHOT_RACE = 2 * 10**9
+
+
+def _read_snapshot(filename, cache):
+    """
+    Return (properties, (aggregate ids, load), (annotation ids, load, abouts))
+    from the snapshot in cache if it was made from filename as it is now,
+    otherwise None.
+    """
+    try:
+        stat = os.stat(filename)
+        with open(cache, "rb") as fp:
+            data = fp.read()
+        header = _SNAPSHOT_HEADER.unpack_from(data)
+    except (OSError, struct.error):
+        return None
+    (magic, version, marshal_version, mtime, size, inode, index_size, aggregates_size) = header
+    if ((magic, version, marshal_version, mtime, size, inode) !=
+            (_SNAPSHOT_MAGIC, _SNAPSHOT_VERSION, marshal.version,
+             stat.st_mtime_ns, stat.st_size, stat.st_ino)):
+        return None
+    data = memoryview(data)
+    start = _SNAPSHOT_HEADER.size
+    aggregates_start = start + index_size
+    annotations_start = aggregates_start + aggregates_size
+    try:
+        properties, aggregate_ids, annotation_ids, abouts = marshal.loads(
+            data[start:aggregates_start])
+    except (EOFError, ValueError, TypeError):
+        return None
+    return (properties,
+            (aggregate_ids, lambda: marshal.loads(data[aggregates_start:annotations_start])),
+            (annotation_ids, lambda: marshal.loads(data[annotations_start:]), abouts))
+
+
+def _write_snapshot(cache, stat, contents):
+    """Snapshot the manifest contents, read from a file with this stat, into
+    cache. The snapshot is left as it was if it can't be written, or if the
+    file was modified too recently to be sure of seeing later changes."""
+    if stat.st_mtime_ns > time.time_ns() - _SNAPSHOT_RACE:
+        return
+    aggregates = ManifestEntryList(Aggregate, contents.get("aggregates") or [], lazy=True)
+    annotations = AnnotationList(contents.get("annotations") or [], lazy=True)
+    properties = {key: value for (key, value) in contents.items()
+                  if key not in ("aggregates", "annotations")}
+    annotation_ids = list(annotations.ids())
+    abouts = [annotations._indexed_about[id] for id in annotation_ids]
+    index = marshal.dumps((properties, list(aggregates.ids()), annotation_ids, abouts))
+    aggregates = marshal.dumps(aggregates.json_entries())
+    header = _SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, _SNAPSHOT_VERSION, marshal.version,
+                                   stat.st_mtime_ns, stat.st_size, stat.st_ino,
+                                   len(index), len(aggregates))
+    # Written alongside and moved over the old one, so that it is never seen
+    # half written
+    try:
+        fp = tempfile.NamedTemporaryFile(dir=os.path.dirname(cache) or ".",
+                                         prefix=".snapshot", delete=False)
+    except OSError as e:
+        log.debug("Couldn't write manifest snapshot {}: {}".format(cache, e))
+        return
+    try:
+        with fp:
+            fp.write(header)
+            fp.write(index)
+            fp.write(aggregates)
+            fp.write(marshal.dumps(annotations.json_entries()))
+        os.replace(fp.name, cache)
+    except OSError as e:
+        log.debug("Couldn't write manifest snapshot {}: {}".format(cache, e))
+        os.unlink(fp.name)
+
+
+def _identify_annotations(annotations):
+    """
+    Give the annotations read without a uri one made from their position
+    and contents, rather than a random one, so that reading the same
+    manifest again, e.g. to apply its journal, gives them the same uris
+    """
+    for i, annotation in enumerate(annotations or ()):
+        if isinstance(annotation, dict) and not annotation.get("uri"):
+            name = "{}:{}".format(i, jsoncodec.dumps(annotation))
+            annotation["uri"] = uuid.uuid5(uuid.NAMESPACE_URL, name).urn
+
+
+# The list properties whose changes are kept in a manifest journal as they
+# are made
+JOURNALED_PROPERTIES = ("aggregates", "annotations")
+
+
+def _fingerprint(value):
+    """Return value as encoded in a manifest, to find whether it has been
+    changed in place"""
+    return jsoncodec.dumps(value, default=_json_default)
+
+
+def _replacement(old, new):
+    """Carry the changes recorded by the list property old over to the list
+    new that replaces it"""
+    if getattr(old, "_changes", None) is not None:
+        new._changes = old._changes + [("clear", None)]
+        new._changes += [("add", entry) for entry in new.json_entries()]
+    return new
+
+
+def _iter_entries(property, cls, filename=None, file=None):
+    if filename is not None:
+        file = open(filename, "rb")
+    with file:
+        for key, value in iter_manifest_json(file):
+            if key == property:
+                yield _objectify(value, cls)
+
+
+# Size of the chunks a manifest is read in by iter_manifest_json()
+JSON_CHUNK_SIZE = 64 * 1024
+
+# Properties whose arrays are yielded an element at a time
+STREAMED_PROPERTIES = ("aggregates", "annotations")
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+def iter_manifest_json(fp, chunk_size=JSON_CHUNK_SIZE):
+    """
+    Yield (property, value) for each of the top level properties of the JSON
+    manifest in the file-like object fp, reading it chunk_size characters or
+    bytes at a time. The elements of the aggregates and annotations arrays
+    are yielded one at a time as (property, element).
+
+    Raises json.JSONDecodeError if the manifest isn't a JSON object.
+    """
+    stream = _JSONStream(fp, chunk_size)
+    stream.expect("{")
+    if stream.peek() == "}":
+        return
+    while True:
+        key = stream.value()
+        if not isinstance(key, str):
+            raise stream.error("Expecting property name")
+        stream.expect(":")
+        if key in STREAMED_PROPERTIES and stream.peek() == "[":
+            stream.expect("[")
+            if stream.peek() == "]":
+                stream.expect("]")
+            else:
+                while True:
+                    yield key, stream.value()
+                    if stream.expect(",]") == "]":
+                        break
+        else:
+            yield key, stream.value()
+        if stream.expect(",}") == "}":
+            return
+
+
+class _ChunkedWriter(object):
+    """Collects small strings and writes them to a text or binary file in
+    chunks of JSON_CHUNK_SIZE characters"""
+
+    def __init__(self, fp):
+        self._fp = fp
+        self._binary = not isinstance(fp, io.TextIOBase)
+        self._parts = []
+        self._size = 0
+
+    def write(self, text):
+        self._parts.append(text)
+        self._size += len(text)
+        if self._size >= JSON_CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        chunk = "".join(self._parts)
+        self._parts = []
+        self._size = 0
+        if chunk:
+            self._fp.write(chunk.encode("utf-8") if self._binary else chunk)
+
+
+# Characters that may continue a number decoded from the end of a chunk
+_NUMBER_CHARS = frozenset("0123456789.eE+-")
+
+
+class _JSONStream(object):
+    """
+    Reads JSON values one at a time from a file-like object, holding only
+    the unparsed part of what has been read in memory
+    """
+
+    def __init__(self, fp, chunk_size=JSON_CHUNK_SIZE):
+        self._fp = fp
+        self._chunk_size = chunk_size
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+        self._text_decoder = None
+
+    def _fill(self):
+        """Read more of the file, returning False at the end of it"""
+        if self._eof:
+            return False
+        # Read at least as much as is buffered so a large value is parsed
+        # in a few attempts
+        size = max(self._chunk_size, len(self._buffer) - self._pos)
+        while True:
+            chunk = self._fp.read(size)
+            if not isinstance(chunk, bytes):
+                break
+            if self._text_decoder is None:
+                self._text_decoder = codecs.getincrementaldecoder("utf-8-sig")()
+            data = chunk
+            chunk = self._text_decoder.decode(data, final=not data)
+            # Part of a character may have been held back until more is read
+            if chunk or not data:
+                break
+        if not chunk:
+            self._eof = True
+            return False
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def peek(self):
+        """Return the next character that isn't whitespace, or "" at the end"""
+        while True:
+            self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer) or not self._fill():
+                return self._buffer[self._pos:self._pos + 1]
+
+    def expect(self, chars):
+        """Consume the next character, which must be one of chars"""
+        char = self.peek()
+        if not char or char not in chars:
+            raise self.error("Expecting one of {!r}".format(chars))
+        self._pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # A number may continue in the part not read yet, e.g. a chunk
+            # ending "1." or "1e" has only given the integer part
+            if ((end < len(self._buffer) and self._buffer[end] not in _NUMBER_CHARS)
+                    or not self._fill()):
+                self._pos = end
+                return value
+
+    def error(self, msg):
+        return json.JSONDecodeError(msg, self._buffer, self._pos)
+
+
 class ManifestEncoder(json.JSONEncoder):
     """
     Custom JSONEncoder for any object that is a subclass of ManifestEntry that
@@ -322,9 +1245,14 @@ class ManifestEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, ManifestEntry):
             return obj.populated()
+        if isinstance(obj, ManifestEntryList):
+            return obj.json_entries()
         # Let the base class default method raise the TypeError
         return json.JSONEncoder.default(self, obj)
 
+# Encodes manifest objects for jsoncodec.dumps()
+_json_default = ManifestEncoder().default
+
 
 #def notHidden(f):
 #    return re.match("\.|.*/\.", f) == None
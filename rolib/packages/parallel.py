@@ -0,0 +1,27 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+
+def parallel_map(function, arguments, workers=None, executor=ProcessPoolExecutor):
+    """Yield function(*args) for each of arguments in order, calling it in a
+    pool of workers made by executor, worker processes by default. Only a
+    few results more than there are workers are held waiting to be consumed,
+    and arguments is only read that far ahead of them."""
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        for args in arguments:
+            yield function(*args)
+        return
+    with executor(workers) as pool:
+        pending = deque()
+        try:
+            for args in arguments:
+                pending.append(pool.submit(function, *args))
+                if len(pending) > 2 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for result in pending:
+                result.cancel()
@@ -289,6 +289,47 @@ def _EndRecData(fpin):
     return None
 
 
+def _ReadCentralDirectoryEntry(fp, concat=0):
+    """Read the central directory entry at the current position of fp.
+
+    Returns a ZipInfo instance for the entry together with the unpacked
+    fixed size part of the entry."""
+    centdir = fp.read(sizeCentralDir)
+    if len(centdir) != sizeCentralDir:
+        raise BadZipFile("Truncated central directory")
+    centdir = struct.unpack(structCentralDir, centdir)
+    if centdir[_CD_SIGNATURE] != stringCentralDir:
+        raise BadZipFile("Bad magic number for central directory")
+    filename = fp.read(centdir[_CD_FILENAME_LENGTH])
+    flags = centdir[5]
+    if flags & 0x800:
+        # UTF-8 file names extension
+        filename = filename.decode('utf-8')
+    else:
+        # Historical ZIP filename encoding
+        filename = filename.decode('cp437')
+    # Create ZipInfo instance to store file information
+    x = ZipInfo(filename)
+    x.extra = fp.read(centdir[_CD_EXTRA_FIELD_LENGTH])
+    x.comment = fp.read(centdir[_CD_COMMENT_LENGTH])
+    x.header_offset = centdir[_CD_LOCAL_HEADER_OFFSET]
+    (x.create_version, x.create_system, x.extract_version, x.reserved,
+     x.flag_bits, x.compress_type, t, d,
+     x.CRC, x.compress_size, x.file_size) = centdir[1:12]
+    if x.extract_version > MAX_EXTRACT_VERSION:
+        raise NotImplementedError("zip file version %.1f" %
+                                  (x.extract_version / 10))
+    x.volume, x.internal_attr, x.external_attr = centdir[15:18]
+    # Convert date/time code to (year, month, day, hour, min, sec)
+    x._raw_time = t
+    x.date_time = ( (d>>9)+1980, (d>>5)&0xF, d&0x1F,
+                    t>>11, (t>>5)&0x3F, (t&0x1F) * 2 )
+
+    x._decodeExtra()
+    x.header_offset = x.header_offset + concat
+    return x, centdir
+
+
 class ZipInfo (object):
     """Class with attributes describing each file in the ZIP archive."""
 
@@ -1110,41 +1151,9 @@ class ZipFile:
         fp = io.BytesIO(data)
         total = 0
         while total < size_cd:
-            centdir = fp.read(sizeCentralDir)
-            if len(centdir) != sizeCentralDir:
-                raise BadZipFile("Truncated central directory")
-            centdir = struct.unpack(structCentralDir, centdir)
-            if centdir[_CD_SIGNATURE] != stringCentralDir:
-                raise BadZipFile("Bad magic number for central directory")
+            x, centdir = _ReadCentralDirectoryEntry(fp, concat)
             if self.debug > 2:
                 print(centdir)
-            filename = fp.read(centdir[_CD_FILENAME_LENGTH])
-            flags = centdir[5]
-            if flags & 0x800:
-                # UTF-8 file names extension
-                filename = filename.decode('utf-8')
-            else:
-                # Historical ZIP filename encoding
-                filename = filename.decode('cp437')
-            # Create ZipInfo instance to store file information
-            x = ZipInfo(filename)
-            x.extra = fp.read(centdir[_CD_EXTRA_FIELD_LENGTH])
-            x.comment = fp.read(centdir[_CD_COMMENT_LENGTH])
-            x.header_offset = centdir[_CD_LOCAL_HEADER_OFFSET]
-            (x.create_version, x.create_system, x.extract_version, x.reserved,
-             x.flag_bits, x.compress_type, t, d,
-             x.CRC, x.compress_size, x.file_size) = centdir[1:12]
-            if x.extract_version > MAX_EXTRACT_VERSION:
-                raise NotImplementedError("zip file version %.1f" %
-                                          (x.extract_version / 10))
-            x.volume, x.internal_attr, x.external_attr = centdir[15:18]
-            # Convert date/time code to (year, month, day, hour, min, sec)
-            x._raw_time = t
-            x.date_time = ( (d>>9)+1980, (d>>5)&0xF, d&0x1F,
-                            t>>11, (t>>5)&0x3F, (t&0x1F) * 2 )
-
-            x._decodeExtra()
-            x.header_offset = x.header_offset + concat
             self.filelist.append(x)
             self.NameToInfo[x.filename] = x
 
@@ -1251,8 +1260,7 @@ class ZipFile:
             # Get info object for name
             zinfo = self.getinfo(name)
 
-        self._fileRefCnt += 1
-        zef_file = _SharedFile(self.fp, zinfo.header_offset, self._fpclose, self._lock)
+        zef_file = self._open_shared(zinfo.header_offset)
         try:
             # Skip the file header:
             fheader = zef_file.read(sizeFileHeader)
@@ -1707,6 +1715,12 @@ class ZipFile:
         self.fp.write(self._comment)
         self.fp.flush()
 
+    def _open_shared(self, pos):
+        """Return a _SharedFile reading the archive from pos, holding a
+        reference to the file until it is closed."""
+        self._fileRefCnt += 1
+        return _SharedFile(self.fp, pos, self._fpclose, self._lock)
+
     def _fpclose(self, fp):
         assert self._fileRefCnt > 0
         self._fileRefCnt -= 1
@@ -1,13 +1,46 @@
 import io
 import os
+import stat
+import time
 from .packages import zipfile
 import tempfile
 import types
 import shutil
+import copy
+from itertools import zip_longest
 from .packages.zipfile import ZipFile
-from .packages.zipfile import (ZIP_DEFLATED, ZIP_STORED, ZIP_LZMA, ZIP64_LIMIT)
+from ..parallel import parallel_map
+from .zipindex import ZipIndex, LazyInfoList, LazyNameToInfo, INDEX_SUFFIX
+from .zipinfotable import ZipInfoTable, CompactInfoList
+from .packages.zipfile import (ZIP_DEFLATED, ZIP_STORED, ZIP_LZMA, ZIP64_LIMIT,
+                                BadZipFile, LargeZipFile)
+from .packages.zipfile import (sizeFileHeader, structFileHeader,
+                               stringFileHeader, _FH_SIGNATURE,
+                               _FH_GENERAL_PURPOSE_FLAG_BITS,
+                               _FH_FILENAME_LENGTH, _FH_EXTRA_FIELD_LENGTH)
 import struct
 import operator
+import zlib
+import hashlib
+
+stringDataDescriptor = b"PK\x07\x08"
+
+# Size of the chunks used when moving data around within an archive
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# Size of the blocks compressed in parallel by write_blocks(), and of the
+# window of preceding data used as a preset dictionary for each block
+DEFLATE_BLOCK_SIZE = 1024 * 1024
+DEFLATE_DICTIONARY_SIZE = 32 * 1024
+
+# How much checking is done after cloning or committing an archive:
+# none trusts the copy, structure re-reads the central directory and checks
+# it against the members written and full also decompresses every member and
+# checks its CRC-32
+VERIFY_NONE = "none"
+VERIFY_STRUCTURE = "structure"
+VERIFY_FULL = "full"
+VERIFY_LEVELS = (VERIFY_NONE, VERIFY_STRUCTURE, VERIFY_FULL)
 
 
 class ZipFileExtended(ZipFile, object):
@@ -31,58 +64,234 @@ class ZipFileExtended(ZipFile, object):
                     needed, otherwise it will raise an exception when this would
                     be necessary.
 
+        lazy: if True and mode is read "r", the central directory is not read
+              when the archive is opened. Members are looked up through a
+              packed index (see zipindex) and their ZipInfo objects are only
+              created when they are requested.
+
+        index_file: the sidecar file holding the packed index for a lazy
+                    archive. Defaults to the archive's filename with
+                    INDEX_SUFFIX appended when file is a path, otherwise the
+                    index is only kept in memory.
+
+        compact_info: if True the ZipInfo fields of the members are packed
+                      into the columns of a ZipInfoTable (see zipinfotable)
+                      instead of being kept as one ZipInfo object per member.
+                      infolist() and getinfo() return views onto the table.
+                      Ignored for lazy archives.
+
+        pread: if True members are read with os.pread() on the archive's
+               file descriptor, rather than by seeking and reading its file
+               object under a lock, so that threads can read members at the
+               same time. Defaults to True when mode is read "r" and the
+               archive is in a file that supports it.
+
         """
-    def __init__(self, file, mode="r", compression=zipfile.ZIP_STORED, allowZip64=True):
+    def __init__(self, file, mode="r", compression=zipfile.ZIP_STORED, allowZip64=True,
+                 lazy=False, index_file=None, compact_info=False, pread=None):
+        self._lazy = lazy and mode == "r"
+        self._pread = False
+        self._compact_info = compact_info and not self._lazy
+        self._index = None
+        if self._lazy and index_file is None and isinstance(file, str):
+            index_file = file + INDEX_SUFFIX
+        self._index_file = index_file
+        self._writing = False
         super(ZipFileExtended, self).__init__(file,mode=mode,compression=compression,allowZip64=allowZip64)
+        if self._compact_info and not isinstance(self.filelist, CompactInfoList):
+            # The central directory wasn't read, e.g. in write mode
+            self._use_info_table(self.filelist)
         self.requires_commit = False
         self.removed_filelist = []
-
-    def _hidden_files(self):
-        """Find any files that are hidden between memebers of this archive"""
-        # Establish the file boundaries, start - end, for each file
+        if pread is None:
+            pread = self._can_pread()
+        elif pread and not self._can_pread():
+            raise ValueError("pread requires mode 'r' and an archive in a file "
+                             "that supports os.pread()")
+        self._pread = pread
+
+    def _RealGetContents(self):
+        """Read in the table of contents for the ZIP file, lazily through the
+        packed index if requested."""
+        if not self._lazy:
+            if self._compact_info:
+                self._use_info_table()
+            return super(ZipFileExtended, self)._RealGetContents()
+        self._index = ZipIndex.load(self.fp, self._index_file)
+        self._lazy_infos = {}
+        self.start_dir = self._index.start_dir
+        self._comment = self._index.comment
+        self.filelist = LazyInfoList(self._index, self._load_info)
+        self.NameToInfo = LazyNameToInfo(self._index, self._load_info)
+
+    def _use_info_table(self, infolist=()):
+        """Keep the members in a ZipInfoTable, starting with infolist"""
+        table = ZipInfoTable()
+        for zinfo in infolist:
+            table.append(zinfo)
+        self.filelist = table.filelist
+        self.NameToInfo = table.NameToInfo
+
+    def _load_info(self, cd_offset):
+        """Return the ZipInfo for the central directory entry at cd_offset,
+        reading it from the archive the first time it is requested"""
+        zinfo = self._lazy_infos.get(cd_offset)
+        if zinfo is None:
+            with self._lock:
+                self.fp.seek(self.start_dir + cd_offset)
+                zinfo, centdir = zipfile._ReadCentralDirectoryEntry(self.fp, self._index.concat)
+            self._lazy_infos[cd_offset] = zinfo
+        return zinfo
+
+    def _read_local_header(self, zinfo):
+        """Read the local header of a member, returning the unpacked header
+        and its extra field"""
+        with self._lock:
+            self.fp.seek(zinfo.header_offset)
+            fheader = self.fp.read(sizeFileHeader)
+            if len(fheader) != sizeFileHeader:
+                raise BadZipFile("Truncated file header")
+            fheader = struct.unpack(structFileHeader, fheader)
+            if fheader[_FH_SIGNATURE] != stringFileHeader:
+                raise BadZipFile("Bad magic number for file header")
+            self.fp.seek(fheader[_FH_FILENAME_LENGTH], 1)
+            extra = self.fp.read(fheader[_FH_EXTRA_FIELD_LENGTH])
+        return fheader, extra
+
+    def _data_offset(self, zinfo, fheader):
+        """Return the offset of the compressed data of a member"""
+        return (zinfo.header_offset + sizeFileHeader +
+                fheader[_FH_FILENAME_LENGTH] + fheader[_FH_EXTRA_FIELD_LENGTH])
+
+    def _open_compressed(self, zinfo):
+        """Return a file-like object reading the compressed bytes of a member
+        directly from the archive. Reads must be limited to
+        zinfo.compress_size bytes by the caller."""
+        fheader, extra = self._read_local_header(zinfo)
+        return self._open_shared(self._data_offset(zinfo, fheader))
+
+    def _open_shared(self, pos):
+        """Return a file-like object reading the archive from pos, with
+        os.pread() if the archive is read that way"""
+        if not self._pread:
+            return super(ZipFileExtended, self)._open_shared(pos)
+        with self._lock:
+            self._fileRefCnt += 1
+        return _PreadFile(self.fp, pos, self._fpclose, self._lock)
+
+    def _can_pread(self):
+        """Whether members can be read with os.pread(): the archive is only
+        being read, from a file whose descriptor reads the archive's bytes"""
+        fp = getattr(self.fp, "raw", self.fp)
+        return (self.mode == "r" and hasattr(os, "pread") and
+                isinstance(fp, io.FileIO))
+
+    def _member_extent(self, zinfo):
+        """Return the boundaries, start - end, of a member as stored in the
+        file: its local header, data and any trailing data descriptor"""
+        with self._lock:
+            fheader, extra = self._read_local_header(zinfo)
+            end_offset = self._data_offset(zinfo, fheader) + zinfo.compress_size
+            if fheader[_FH_GENERAL_PURPOSE_FLAG_BITS] & 0x08:
+                # CRC and file sizes follow the file data, optionally preceded
+                # by a signature
+                self.fp.seek(end_offset)
+                if self.fp.read(4) == stringDataDescriptor:
+                    end_offset += 4
+                end_offset += 20 if _has_zip64_extra(extra) else 12
+
+        return {"start": zinfo.header_offset, "end": end_offset}
+
+    def _gaps(self):
+        """Find the boundaries, start - end, of any data inbetween the members
+        of this archive"""
         # initial file boundaries are the start and end of the zip up to the
         # central directory
         file_boundaries = [{"start": 0, "end": 0},
                            {"start": self.start_dir, "end": self.start_dir}]
-        # Include removed files - we don't want to count them as hidden
+        # Include removed files - we don't want to count them as gaps
         for fileinfo in self.filelist + self.removed_filelist:
-
-            # establish the end_offset
-            end_offset = fileinfo.header_offset
-            end_offset += zipfile.sizeFileHeader
-            end_offset += len(fileinfo.orig_filename)
-            end_offset += len(fileinfo.extra)
-            end_offset += fileinfo.compress_size
-            is_encrypted = fileinfo.flag_bits & 0x1
-            if is_encrypted:
-                end_offset += 12
-
-            # add to the file boundaries
-            file_boundaries.append({"start": fileinfo.header_offset,
-                                    "end": end_offset})
+            file_boundaries.append(self._member_extent(fileinfo))
 
         # Look for data inbetween the file boundaries
         file_boundaries.sort(key=operator.itemgetter("start"))
         current = file_boundaries.pop(0)
-        hidden_files = []
+        gaps = []
         for next in file_boundaries:
             if current["end"] > next["start"]:
                 # next is contained within current |--c.s---n.s--n.e---c.e--|
                 continue
             elif current["end"] != next["start"]:
                 # There is some data inbetween
-                file = zipfile._SharedFile(self.fp, current["end"], self._fpclose, self._lock)
-                file.length = next["start"] - current["end"]
-                hidden_files.append(file)
+                gaps.append({"start": current["end"], "end": next["start"]})
             current = next
 
+        return gaps
+
+    def _is_orphaned_header(self, offset):
+        """Check whether there is a local header, left behind by a member
+        that is no longer in the central directory, at offset"""
+        with self._lock:
+            self.fp.seek(offset)
+            return self.fp.read(len(stringFileHeader)) == stringFileHeader
+
+    def _hidden_files(self):
+        """Find any files that are hidden between memebers of this archive.
+        Orphaned local headers are dead space rather than hidden files."""
+        hidden_files = []
+        for gap in self._gaps():
+            if self._is_orphaned_header(gap["start"]):
+                continue
+            file = zipfile._SharedFile(self.fp, gap["start"], self._fpclose, self._lock)
+            file.length = gap["end"] - gap["start"]
+            hidden_files.append(file)
+
         return hidden_files
 
+    def fragmentation(self):
+        """
+        Report the dead space in the archive.
+
+        Returns:
+          A dictionary with the number of entries and the bytes taken up by
+          members removed since the last commit ("removed_entries",
+          "removed_bytes"), local headers of members that are no longer in the
+          central directory ("orphaned_headers", "orphaned_bytes") and other
+          data inbetween members ("hidden_files", "hidden_bytes"), along with
+          their total ("wasted_bytes") and the offset of the first gap
+          ("first_gap", None if there is no dead space).
+        """
+        removed = [self._member_extent(fileinfo) for fileinfo in self.removed_filelist]
+        orphaned = []
+        hidden = []
+        for gap in self._gaps():
+            if self._is_orphaned_header(gap["start"]):
+                orphaned.append(gap)
+            else:
+                hidden.append(gap)
+
+        def size(boundaries):
+            return sum(b["end"] - b["start"] for b in boundaries)
+
+        dead = removed + orphaned + hidden
+        return {"removed_entries": len(removed),
+                "removed_bytes": size(removed),
+                "orphaned_headers": len(orphaned),
+                "orphaned_bytes": size(orphaned),
+                "hidden_files": len(hidden),
+                "hidden_bytes": size(hidden),
+                "wasted_bytes": size(dead),
+                "first_gap": min(b["start"] for b in dead) if dead else None}
+
+    def wasted_bytes(self):
+        """Return the number of bytes of dead space in the archive"""
+        return self.fragmentation()["wasted_bytes"]
+
     def _renamecheck(self, filename):
         """Check for errors before writing a file to the archive."""
         if filename in self.NameToInfo:
             import warnings
-            warnings.warn('Duplicate name: %r' % zinfo.filename, stacklevel=3)
+            warnings.warn('Duplicate name: %r' % filename, stacklevel=3)
         if self.mode not in ('w', 'x', 'a'):
             raise RuntimeError("rename() requires mode 'w', 'x', or 'a'")
         if not self.fp:
@@ -92,10 +301,20 @@ class ZipFileExtended(ZipFile, object):
     def _removecheck(self):
         """Check for errors before writing a file to the archive."""
         if self.mode not in ('w', 'x', 'a'):
-            raise RuntimeError("rename() requires mode 'w', 'x', or 'a'")
+            raise RuntimeError("remove() requires mode 'w', 'x', or 'a'")
+        if not self.fp:
+            raise RuntimeError(
+                "Attempt to modify ZIP archive that was already closed")
+
+    def _compactcheck(self):
+        """Check for errors before compacting the archive."""
+        if self.mode not in ('w', 'x', 'a'):
+            raise RuntimeError("compact() requires mode 'w', 'x', or 'a'")
         if not self.fp:
             raise RuntimeError(
                 "Attempt to modify ZIP archive that was already closed")
+        if not self._can_commit_in_place():
+            raise RuntimeError("compact() requires a seekable file")
 
     def remove(self, zinfo_or_arcname):
         """
@@ -165,6 +384,9 @@ class ZipFileExtended(ZipFile, object):
         else:
             zinfo = self.getinfo(zinfo_or_arcname)
 
+        # zinfo.orig_filename keeps the name held in the local header until the
+        # rename is committed
+        del self.NameToInfo[zinfo.filename]
         zinfo.filename = filename
         self.NameToInfo[zinfo.filename] = zinfo
 
@@ -177,6 +399,11 @@ class ZipFileExtended(ZipFile, object):
         if self.fp is None:
             return
 
+        if self._writing:
+            raise ValueError("Can't close the ZIP file while there is "
+                             "an open writing handle on it. "
+                             "Close the writing handle before closing the zip.")
+
         try:
             if self.mode in ("w", "a", 'x') and self._didModify: # write ending records
 
@@ -198,9 +425,13 @@ class ZipFileExtended(ZipFile, object):
             fp = self.fp
             self.fp = None
             self._fpclose(fp)
+            if self._index is not None:
+                self._index.close()
+                self._index = None
 
 
-    def clone(self, file, filenames_or_infolist=None, ignore_hidden_files=False):
+    def clone(self, file, filenames_or_infolist=None, ignore_hidden_files=False,
+              buffer_size=COPY_BUFFER_SIZE, verify=VERIFY_STRUCTURE):
         """ Clone the a zip file using the given file (filename or filepointer).
 
         Args:
@@ -210,6 +441,12 @@ class ZipFileExtended(ZipFile, object):
             members from this zip file to include in the new zip file.
           ignore_hidden_files (boolean): flag to indicate wether hidden files
             (data inbetween managed memebers of the archive) should be included.
+          buffer_size (int): size of the chunks used to copy the compressed
+            bytes of each member, bounding the memory used by the clone.
+          verify (str): how the new zip file is checked once written, one of
+            VERIFY_NONE, VERIFY_STRUCTURE (compare the central directory with
+            the members written) or VERIFY_FULL (also check every member's
+            CRC-32).
 
         Returns:
             At new ZipFile object of the cloned zipfile open in append mode.
@@ -219,6 +456,7 @@ class ZipFileExtended(ZipFile, object):
         Raises:
             BadZipFile exception.
         """
+        _check_verify(verify)
         # if we are filtering or need to commit changes then create via ZipFile
         if filenames_or_infolist or self.requires_commit or ignore_hidden_files:
             if filenames_or_infolist is None:
@@ -246,31 +484,107 @@ class ZipFileExtended(ZipFile, object):
 
                 for f in files:
                     if isinstance(f,zipfile.ZipInfo):
-                        bytes = self.read_compressed(f.filename)
-                        clone.write_compressed(f,bytes)
+                        clone.write_compressed_from(self, f, buffer_size)
                     else:
-                        bytes = f.read(f.length)
-                        clone._write_hidden(bytes)
+                        clone._write_hidden_from(f, f.length, buffer_size)
+                written = list(clone.filelist)
 
         else:
             # We are copying with no modifications - just copy bytes
             with self._lock:
-                self.fp.seek(0)
                 if isinstance(file, str):
                     with open(file, 'wb+') as fp:
-                        shutil.copyfileobj(self.fp, fp)
+                        _copy_file(self.fp, fp, buffer_size)
                 else:
                     fp = file
-                    shutil.copyfileobj(self.fp, fp)
+                    _copy_file(self.fp, fp, buffer_size)
                     fp.seek(0)
+            written = list(self.filelist)
 
         clone = ZipFileExtended(file, mode="a", compression=self.compression,
-                                allowZip64=self._allowZip64)
-        badfile = clone.testzip()
-        if(badfile):
-            raise zipfile.BadZipFile("Error when cloning zipfile, failed zipfile check: {} file is corrupt".format(badfile))
+                                allowZip64=self._allowZip64,
+                                compact_info=self._compact_info)
+        clone._verify(written, verify)
         return clone
 
+    def _verify(self, written, verify=VERIFY_STRUCTURE):
+        """Check this archive, as read back from its file, against the list of
+        ZipInfo instances for the members that were written to it.
+
+        Raises:
+          BadZipFile: If the check fails.
+        """
+        if verify == VERIFY_FULL:
+            badfile = self.testzip()
+            if badfile:
+                raise BadZipFile("Failed zipfile check: {} file is corrupt".format(badfile))
+        elif verify == VERIFY_STRUCTURE:
+            badfile = self._check_structure(written)
+            if badfile:
+                raise BadZipFile("Failed zipfile check: central directory entry for {} does not match what was written".format(badfile))
+
+    def _check_structure(self, written):
+        """Compare the offsets and sizes in the central directory with those of
+        the members that were written, return the name of the first member
+        that does not match"""
+        def layout(zinfo):
+            return (zinfo.filename, zinfo.header_offset, zinfo.compress_size,
+                    zinfo.file_size, zinfo.CRC)
+
+        for expected, actual in zip_longest(written, self.filelist):
+            if expected is None or actual is None:
+                return (expected or actual).filename
+            if layout(expected) != layout(actual):
+                return expected.filename
+
+    def open(self, name, mode="r", pwd=None, force_zip64=False):
+        """Return file-like object for 'name'.
+
+        With mode "w" a new member is created and the file-like object
+        returned writes to it, compressing what is written as it goes. No
+        other member can be written until it is closed. If the member may be
+        larger than 2 GiB pass force_zip64=True, as its size isn't known when
+        its header is written. name can also be a ZipInfo instance.
+        """
+        if mode != "w":
+            return super(ZipFileExtended, self).open(name, mode, pwd)
+        if not self.fp:
+            raise RuntimeError(
+                "Attempt to write to ZIP archive that was already closed")
+        if isinstance(name, zipfile.ZipInfo):
+            zinfo = name
+        else:
+            zinfo = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+            zinfo.compress_type = self.compression
+            zinfo.external_attr = 0o600 << 16
+        zinfo.file_size = 0
+        zinfo.compress_size = 0
+        zinfo.CRC = 0
+        zinfo.flag_bits = 0x00
+        if zinfo.compress_type == ZIP_LZMA:
+            # Compressed data includes an end-of-stream (EOS) marker
+            zinfo.flag_bits |= 0x02
+        if not self._seekable:
+            zinfo.flag_bits |= 0x08
+
+        with self._lock:
+            self._writecheck(zinfo)
+            if self._seekable:
+                self.fp.seek(self.start_dir)
+            zinfo.header_offset = self.fp.tell()    # Start of header bytes
+            self._didModify = True
+            zip64 = self._allowZip64 and force_zip64
+            self.fp.write(zinfo.FileHeader(zip64))
+            self._writing = True
+            return _ZipWriteFile(self, zinfo, zip64)
+
+    def _writecheck(self, zinfo):
+        if self._writing:
+            raise ValueError("Can't write to the ZIP file while there is "
+                             "another write handle open on it. "
+                             "Close the first handle before opening another.")
+        super(ZipFileExtended, self)._writecheck(zinfo)
+
     def read_compressed(self, name, pwd=None):
         """Return file bytes uncompressed for name."""
         with self.open(name, "r", pwd) as fp:
@@ -312,22 +626,243 @@ class ZipFileExtended(ZipFile, object):
             self._didModify = True
 
             zinfo.compress_size = len(data)    # Compressed size
+            zip64 = self._write_member_header(zinfo)
+            self.fp.write(data)
+            self._write_member_descriptor(zinfo, zip64)
+            self.filelist.append(zinfo)
+            self.NameToInfo[zinfo.filename] = zinfo
 
-            zip64 = zinfo.file_size > ZIP64_LIMIT or \
-                zinfo.compress_size > ZIP64_LIMIT
-            if zip64 and not self._allowZip64:
-                raise LargeZipFile("Filesize would require ZIP64 extensions")
+    def write(self, filename, arcname=None, compress_type=None, digests=()):
+        """Put the bytes from filename into the archive under the name
+        arcname.
+
+        Returns a dictionary of the hex digests of those bytes by each of the
+        hashlib algorithms in digests, made as they are compressed so the
+        file is only read once. It is empty for a directory.
+        """
+        if not digests:
+            super(ZipFileExtended, self).write(filename, arcname, compress_type)
+            return {}
+        if not self.fp:
+            raise RuntimeError(
+                "Attempt to write to ZIP archive that was already closed")
+        zinfo = self._info_from_file(filename, arcname, compress_type)
+        if zinfo.filename.endswith('/'):
+            super(ZipFileExtended, self).write(filename, arcname, compress_type)
+            return {}
+        hashes = [hashlib.new(digest) for digest in digests]
+        # Compressed size can be larger than uncompressed size
+        zip64 = zinfo.file_size * 1.05 > ZIP64_LIMIT
+        with open(filename, "rb") as source, self.open(zinfo, "w", force_zip64=zip64) as dest:
+            while True:
+                data = source.read(COPY_BUFFER_SIZE)
+                if not data:
+                    break
+                for hash in hashes:
+                    hash.update(data)
+                dest.write(data)
+        return _hexdigests(digests, hashes)
+
+    def write_many(self, filenames, arcnames=None, compress_type=None,
+                   workers=None, digests=()):
+        """Put the bytes from each of filenames into the archive under the
+        matching name in arcnames, or its own name if arcnames is None.
+
+        The files are compressed in parallel by a pool of worker processes
+        and appended in order with write_compressed(), so the archive is the
+        same whatever the number of workers. workers defaults to the number of
+        CPUs; with a single worker the files are compressed in this process.
+        Each file is held in memory while it is compressed and written.
+
+        Returns a list of the hex digests of each file by the hashlib
+        algorithms in digests, as write() does, made by the workers.
+        """
+        if not self.fp:
+            raise RuntimeError(
+                "Attempt to write to ZIP archive that was already closed")
+        filenames = list(filenames)
+        if arcnames is None:
+            arcnames = filenames
+        members = [(filename, self._info_from_file(filename, arcname, compress_type), digests)
+                   for (filename, arcname) in zip(filenames, arcnames)]
+        compressed = parallel_map(_compress_file, members, workers)
+        return [self._write_compressed_file(zinfo, result)
+                for (filename, zinfo, _), result in zip(members, compressed)]
+
+    def write_blocks(self, filename, arcname=None, workers=None,
+                     block_size=DEFLATE_BLOCK_SIZE, digests=()):
+        """Put the bytes from filename into the archive under the name
+        arcname, DEFLATE compressing it in blocks of block_size bytes in
+        parallel, as pigz does.
+
+        Each block is compressed by a pool of worker processes, primed with
+        the preceding 32KiB of the file as a preset dictionary and ended with
+        a full flush, so the blocks join into a single DEFLATE stream any
+        unzip can read. Their CRC-32s are combined without re-reading the
+        data. workers defaults to the number of CPUs. The file is read once,
+        in this process, which hands the blocks to the workers.
+
+        Returns the hex digests of the file's bytes by the hashlib algorithms
+        in digests, as write() does.
+        """
+        if not self.fp:
+            raise RuntimeError(
+                "Attempt to write to ZIP archive that was already closed")
+        zinfo = self._info_from_file(filename, arcname, ZIP_DEFLATED)
+        if zinfo.filename.endswith('/'):
+            return self.write(filename, arcname, ZIP_DEFLATED, digests)
+        size = zinfo.file_size
+        hashes = [hashlib.new(digest) for digest in digests]
+
+        with self._lock, open(filename, "rb") as fp:
+            if self._seekable:
+                self.fp.seek(self.start_dir)
+            zinfo.header_offset = self.fp.tell()    # Start of header bytes
+            self._writecheck(zinfo)
+            self._didModify = True
+            if not self._seekable:
+                zinfo.flag_bits |= 0x08
+            # Must overwrite CRC and sizes with correct data later
+            zinfo.CRC = CRC = 0
+            zinfo.compress_size = compress_size = 0
+            zinfo.file_size = file_size = 0
+            # Compressed size can be larger than uncompressed size
+            zip64 = self._allowZip64 and size * 1.05 > ZIP64_LIMIT
             self.fp.write(zinfo.FileHeader(zip64))
-            self.fp.write(data)
-            if zinfo.flag_bits & 0x08:
-                # Write CRC and file sizes after the file data
-                fmt = '<LQQ' if zip64 else '<LLL'
-                self.fp.write(struct.pack(fmt, zinfo.CRC, zinfo.compress_size,
-                                          zinfo.file_size))
-            self.fp.flush()
-            self.start_dir = self.fp.tell()
+            blocks = _read_blocks(fp, size, block_size, hashes)
+            for block in parallel_map(_deflate_block, blocks, workers):
+                block_crc, length, data = block
+                CRC = _crc32_combine(CRC, block_crc, length)
+                file_size += length
+                compress_size += len(data)
+                self.fp.write(data)
+            zinfo.CRC = CRC
+            zinfo.file_size = file_size
+            zinfo.compress_size = compress_size
+            if not zinfo.flag_bits & 0x08:
+                if not zip64 and self._allowZip64:
+                    if file_size > ZIP64_LIMIT:
+                        raise RuntimeError('File size has increased during compressing')
+                    if compress_size > ZIP64_LIMIT:
+                        raise RuntimeError('Compressed size larger than uncompressed size')
+                # Seek backwards and write file header (which will now include
+                # correct CRC and file sizes)
+                position = self.fp.tell()
+                self.fp.seek(zinfo.header_offset)
+                self.fp.write(zinfo.FileHeader(zip64))
+                self.fp.seek(position)
+            self._write_member_descriptor(zinfo, zip64)
             self.filelist.append(zinfo)
             self.NameToInfo[zinfo.filename] = zinfo
+        return _hexdigests(digests, hashes)
+
+    def _info_from_file(self, filename, arcname=None, compress_type=None):
+        """Create the ZipInfo for writing filename under arcname, as write()
+        does"""
+        st = os.stat(filename)
+        isdir = stat.S_ISDIR(st.st_mode)
+        mtime = time.localtime(st.st_mtime)
+        date_time = mtime[0:6]
+        if arcname is None:
+            arcname = filename
+        arcname = os.path.normpath(os.path.splitdrive(arcname)[1])
+        while arcname[0] in (os.sep, os.altsep):
+            arcname = arcname[1:]
+        if isdir:
+            arcname += '/'
+        zinfo = zipfile.ZipInfo(arcname, date_time)
+        zinfo.external_attr = (st[0] & 0xFFFF) << 16      # Unix attributes
+        if isdir:
+            zinfo.external_attr |= 0x10  # MS-DOS directory flag
+        if compress_type is None:
+            zinfo.compress_type = self.compression
+        else:
+            zinfo.compress_type = compress_type
+        zinfo.file_size = st.st_size
+        zinfo.flag_bits = 0x00
+        return zinfo
+
+    def _write_compressed_file(self, zinfo, compressed):
+        """Write a member compressed by _compress_file(), returning the hex
+        digests it made of the file"""
+        zinfo.CRC, zinfo.file_size, data, hexdigests = compressed
+        self.write_compressed(zinfo, data)
+        return hexdigests
+
+    def write_compressed_from(self, source, zinfo, buffer_size=COPY_BUFFER_SIZE):
+        """Write a member of another archive into this archive by copying its
+        compressed bytes in chunks of at most buffer_size bytes.
+        'source' is the ZipFileExtended holding the member and 'zinfo' its
+        ZipInfo instance in that archive, which is left unchanged.
+        """
+        if not self.fp:
+            raise RuntimeError(
+                "Attempt to write to ZIP archive that was already closed")
+
+        compressed = source._open_compressed(zinfo)
+        try:
+            zinfo = copy.copy(zinfo)
+            with self._lock:
+                if self._seekable:
+                    self.fp.seek(self.start_dir)
+
+                # ensure the two match as the header is about to be re-written
+                zinfo.orig_filename = zinfo.filename
+                zinfo.header_offset = self.fp.tell()    # update start of header
+
+                self._writecheck(zinfo)
+                self._didModify = True
+
+                zip64 = self._write_member_header(zinfo)
+                self._write_from(compressed, zinfo.compress_size, buffer_size)
+                self._write_member_descriptor(zinfo, zip64)
+                self.filelist.append(zinfo)
+                self.NameToInfo[zinfo.filename] = zinfo
+        finally:
+            compressed.close()
+
+    def _write_member_header(self, zinfo):
+        """Write the local header for zinfo at the current position of the
+        file. Returns wether ZIP64 extensions were used."""
+        zip64 = zinfo.file_size > ZIP64_LIMIT or \
+            zinfo.compress_size > ZIP64_LIMIT
+        if zip64 and not self._allowZip64:
+            raise LargeZipFile("Filesize would require ZIP64 extensions")
+        self.fp.write(zinfo.FileHeader(zip64))
+        return zip64
+
+    def _write_member_descriptor(self, zinfo, zip64):
+        """Finish a member once its compressed bytes have been written"""
+        if zinfo.flag_bits & 0x08:
+            # Write CRC and file sizes after the file data
+            fmt = '<LQQ' if zip64 else '<LLL'
+            self.fp.write(struct.pack(fmt, zinfo.CRC, zinfo.compress_size,
+                                      zinfo.file_size))
+        self.fp.flush()
+        self.start_dir = self.fp.tell()
+
+    def _write_from(self, source, length, buffer_size=COPY_BUFFER_SIZE):
+        """Copy length bytes from the file-like object source to the current
+        position of the file, buffer_size bytes at a time. source may share
+        the underlying file with this archive."""
+        position = self.fp.tell()
+        if self._seekable and isinstance(source, zipfile._SharedFile):
+            # Let the kernel copy as much as it can when both are real files
+            with source._lock:
+                copied = _kernel_copy(source._file, source._pos,
+                                      self.fp, position, length)
+            source._pos += copied
+            position += copied
+            length -= copied
+        while length > 0:
+            data = source.read(min(length, buffer_size))
+            if not data:
+                raise BadZipFile("Unexpected end of file when copying data")
+            if self._seekable:
+                self.fp.seek(position)
+            self.fp.write(data)
+            position += len(data)
+            length -= len(data)
 
     def _write_hidden(self, data):
         """Write data to the file that contains the zipfile without adding it as
@@ -339,18 +874,178 @@ class ZipFileExtended(ZipFile, object):
             self.fp.flush()
             self.start_dir = self.fp.tell()
 
+    def _write_hidden_from(self, source, length, buffer_size=COPY_BUFFER_SIZE):
+        """Copy length bytes from the file-like object source to the file that
+        contains the zipfile without adding them as a managed entry of the
+        zip"""
+        with self._lock:
+            if self._seekable:
+                self.fp.seek(self.start_dir)
+            self._write_from(source, length, buffer_size)
+            self.fp.flush()
+            self.start_dir = self.fp.tell()
+
     def _reset(self):
         # Reset modification and commit flags
         self._didModify = False
         self.requires_commit = False
         self.removed_filelist = []
         # Reread contents
+        self.filelist = []
+        self.NameToInfo = {}
         self._RealGetContents()
         # seek to start of directory ready for subsequent writes
         self.fp.seek(self.start_dir)
 
 
-    def commit(self):
+    def commit(self, rewrite=False, verify=VERIFY_STRUCTURE):
+        """Commit removed and renamed members to the underlying file.
+
+        By default the changes are made in place and only the central
+        directory is rewritten: removed members are left behind as dead space
+        and renamed members have their local header updated. A renamed member
+        whose new name does not fit in its local header is moved to the end of
+        the archive.
+
+        Args:
+          rewrite (boolean): rebuild the whole archive through clone() rather
+            than committing in place.
+          verify (str): how the committed archive is checked, one of
+            VERIFY_NONE, VERIFY_STRUCTURE or VERIFY_FULL (see clone()).
+
+        Raises:
+          BadZipFile: If the committed archive fails verification.
+        """
+        _check_verify(verify)
+        if rewrite or not self._can_commit_in_place():
+            self._commit_rewrite(verify)
+        else:
+            self._commit_in_place(verify)
+
+    def _can_commit_in_place(self):
+        return (self.mode in ('w', 'x', 'a') and self._seekable and
+                hasattr(self.fp, 'truncate'))
+
+    def _commit_in_place(self, verify=VERIFY_STRUCTURE):
+        with self._lock:
+            for zinfo in self.filelist:
+                if zinfo.filename != zinfo.orig_filename:
+                    self._rename_local_header(zinfo)
+            self.fp.seek(self.start_dir)
+            self._write_end_record()
+            # The new central directory may be shorter than the old one
+            self.fp.truncate()
+            self.fp.seek(self.start_dir)
+            if verify == VERIFY_NONE:
+                self._didModify = False
+                self.requires_commit = False
+                self.removed_filelist = []
+            else:
+                written = self.filelist
+                # Read back the central directory that was just written
+                self._reset()
+                self._verify(written, verify)
+
+    def _rename_local_header(self, zinfo):
+        """Bring the local header of a renamed member in line with its new
+        name"""
+        filename, flag_bits = zinfo._encodeFilenameFlags()
+        fheader, extra = self._read_local_header(zinfo)
+
+        if fheader[_FH_FILENAME_LENGTH] == len(filename):
+            # The new name fits - overwrite the name and utf-8 flag in place
+            local_flag_bits = ((fheader[_FH_GENERAL_PURPOSE_FLAG_BITS] & ~0x800)
+                               | (flag_bits & 0x800))
+            self.fp.seek(zinfo.header_offset + struct.calcsize("<4s2B"))
+            self.fp.write(struct.pack("<H", local_flag_bits))
+            self.fp.seek(zinfo.header_offset + sizeFileHeader)
+            self.fp.write(filename)
+        else:
+            # Move the member to the end of the archive, the old local header
+            # and data are left behind as dead space
+            compressed = self._open_compressed(zinfo)
+            try:
+                self.fp.seek(self.start_dir)
+                zinfo.header_offset = self.start_dir
+                zip64 = self._write_member_header(zinfo)
+                self._write_from(compressed, zinfo.compress_size)
+                self._write_member_descriptor(zinfo, zip64)
+            finally:
+                compressed.close()
+        zinfo.orig_filename = zinfo.filename
+
+    def compact(self, ignore_hidden_files=False):
+        """
+        Reclaim the dead space in the archive left by removed and moved
+        members.
+
+        Only the part of the archive after the first gap is moved, the members
+        before it are left untouched. Any pending changes are committed first,
+        through commit() so that subclasses can bring their own members up to
+        date.
+
+        Args:
+          ignore_hidden_files (boolean): flag to indicate wether hidden files
+            (data inbetween managed memebers of the archive) should be
+            dropped along with the dead space. They are kept by default, as
+            clone() keeps them.
+
+        Returns:
+          The number of bytes reclaimed.
+
+        Raises:
+          RuntimeError: If the archive is closed, read only or not seekable.
+          BadZipFile: If members of the archive overlap.
+        """
+        self._compactcheck()
+
+        if self.requires_commit:
+            self.commit()
+
+        with self._lock:
+            segments = [(self._member_extent(zinfo), zinfo) for zinfo in self.filelist]
+            if not ignore_hidden_files:
+                segments += [({"start": f._pos, "end": f._pos + f.length}, None)
+                             for f in self._hidden_files()]
+            segments.sort(key=lambda segment: segment[0]["start"])
+
+            position = 0
+            for boundary, zinfo in segments:
+                if boundary["start"] < position:
+                    raise BadZipFile("Overlapping members, unable to compact archive")
+                length = boundary["end"] - boundary["start"]
+                if boundary["start"] != position:
+                    self._move(boundary["start"], position, length)
+                    if zinfo is not None:
+                        zinfo.header_offset = position
+                position += length
+
+            reclaimed = self.start_dir - position
+            if reclaimed:
+                self.start_dir = position
+                self.fp.seek(self.start_dir)
+                self._write_end_record()
+                self.fp.truncate()
+                self.fp.seek(self.start_dir)
+                self._didModify = False
+        return reclaimed
+
+    def _move(self, source, destination, length):
+        """Move length bytes within the file from source to an earlier
+        destination"""
+        while length > 0:
+            self.fp.seek(source)
+            data = self.fp.read(min(length, COPY_BUFFER_SIZE))
+            if not data:
+                raise BadZipFile("Unexpected end of file when compacting archive")
+            self.fp.seek(destination)
+            self.fp.write(data)
+            source += len(data)
+            destination += len(data)
+            length -= len(data)
+        self.fp.flush()
+
+    def _commit_rewrite(self, verify=VERIFY_STRUCTURE):
         # zip will be validated by clone
         # Try to create tempfiles in same directory first
         if not self._filePassed:
@@ -366,7 +1061,7 @@ class ZipFileExtended(ZipFile, object):
 
         # clone the zip to create the up-to-date version -
         # will verify and raise BadZipFile error if it fails
-        clone = self.clone(clonefp)
+        clone = self.clone(clonefp, verify=verify)
 
         # Now we need to move files around
         # Is this a real file, and does it live on the same mount point?
@@ -380,16 +1075,16 @@ class ZipFileExtended(ZipFile, object):
                 os.rename(self.filename, backupfp.name)
             except:
                 raise RuntimeError("Failed to commit updates to zipfile")
+            oldfp = self.fp
             try:
                 os.rename(clone.filename, self.filename)
-                oldfp = self.fp
                 self.fp = clonefp
                 self._reset()
             except Exception as err:
-                print(err)
                 self.fp = oldfp
+                clonefp.close()
                 os.rename(backupfp.name, self.filename)
-                raise RuntimeError("Failed to commit updates to zipfile")
+                raise RuntimeError("Failed to commit updates to zipfile") from err
         # Is it a file-like stream?
         elif hasattr(self.fp, 'write'):
             # self.fp is a stream or lives on another mount point
@@ -408,13 +1103,15 @@ class ZipFileExtended(ZipFile, object):
                         for b in fp:
                             self.fp.write(b)
                     self._reset()
-                except:
+                except Exception as err:
+                    # Put back the original bytes
                     backupfp.seek(0)
                     self.fp.seek(0)
-                    for b in backup.fp:
-                        self.fp.write(b)
+                    self.fp.truncate()
+                    shutil.copyfileobj(backupfp, self.fp)
                     backupfp.close()
-                    raise RuntimeError("Failed to commit updates to zipfile")
+                    os.unlink(backupfp.name)
+                    raise RuntimeError("Failed to commit updates to zipfile") from err
             backupfp.close()
         else:
             # failed to commit
@@ -424,6 +1121,108 @@ class ZipFileExtended(ZipFile, object):
             os.unlink(backupfp.name)
 
 
+class _PreadFile(zipfile._SharedFile):
+    """Reads an archive from pos as _SharedFile does, with os.pread() on the
+    file descriptor so that neither the lock nor the file's position are
+    needed, and several threads can read at once"""
+
+    def __init__(self, file, pos, close, lock):
+        super(_PreadFile, self).__init__(file, pos, close, lock)
+        self._fd = file.fileno()
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = max(os.fstat(self._fd).st_size - self._pos, 0)
+        data = os.pread(self._fd, n, self._pos)
+        self._pos += len(data)
+        return data
+
+    def close(self):
+        # The count of references to the file isn't otherwise thread safe
+        with self._lock:
+            super(_PreadFile, self).close()
+
+
+class _ZipWriteFile(io.BufferedIOBase):
+    """File-like object writing a member into a ZipFileExtended, returned by
+    ZipFileExtended.open(name, "w")"""
+
+    def __init__(self, zf, zinfo, zip64):
+        self._zinfo = zinfo
+        self._zip64 = zip64
+        self._zipfile = zf
+        self._compressor = zipfile._get_compressor(zinfo.compress_type)
+        self._file_size = 0
+        self._compress_size = 0
+        self._crc = 0
+        self._position = zf.fp.tell()
+
+    @property
+    def _fileobj(self):
+        return self._zipfile.fp
+
+    def _write_data(self, data):
+        # A rejected write on the archive may have moved the file position
+        fp = self._fileobj
+        if fp.tell() != self._position:
+            fp.seek(self._position)
+        fp.write(data)
+        self._position += len(data)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+        nbytes = len(data)
+        self._file_size += nbytes
+        self._crc = zipfile.crc32(data, self._crc) & 0xffffffff
+        if self._compressor:
+            data = self._compressor.compress(data)
+            self._compress_size += len(data)
+        self._write_data(data)
+        return nbytes
+
+    def close(self):
+        if self.closed:
+            return
+        super(_ZipWriteFile, self).close()
+        zf = self._zipfile
+        zinfo = self._zinfo
+        try:
+            # Flush any data from the compressor, and update header info
+            if self._compressor:
+                buf = self._compressor.flush()
+                self._compress_size += len(buf)
+                self._write_data(buf)
+                zinfo.compress_size = self._compress_size
+            else:
+                zinfo.compress_size = self._file_size
+            zinfo.CRC = self._crc
+            zinfo.file_size = self._file_size
+
+            if not zinfo.flag_bits & 0x08:
+                if not self._zip64:
+                    if self._file_size > ZIP64_LIMIT:
+                        raise RuntimeError('File size unexpectedly exceeded ZIP64 '
+                                           'limit')
+                    if self._compress_size > ZIP64_LIMIT:
+                        raise RuntimeError('Compressed size unexpectedly exceeded '
+                                           'ZIP64 limit')
+                # Seek backwards and write file header (which will now include
+                # correct CRC and file sizes)
+                position = self._fileobj.tell()
+                self._fileobj.seek(zinfo.header_offset)
+                self._fileobj.write(zinfo.FileHeader(self._zip64))
+                self._fileobj.seek(position)
+            zf._write_member_descriptor(zinfo, self._zip64)
+            zf.filelist.append(zinfo)
+            zf.NameToInfo[zinfo.filename] = zinfo
+        finally:
+            zf._writing = False
+
+
 def read(self, n=-1, decompress=True):
     """Read and return up to n bytes.
     If the argument is omitted, None, or negative, data is read and returned
@@ -498,6 +1297,200 @@ def _read1(self, n, decompress=True):
     return data
 
 
+def _hexdigests(digests, hashes):
+    return {digest: hash.hexdigest() for digest, hash in zip(digests, hashes)}
+
+
+def _compress_file(filename, zinfo, digests=()):
+    """Read and compress the contents of filename for the member zinfo,
+    returning its CRC-32, size, compressed bytes and the hex digests of its
+    contents by each hashlib algorithm in digests"""
+    if zinfo.filename.endswith('/'):
+        return 0, 0, b"", {}
+    with open(filename, "rb") as fp:
+        data = fp.read()
+    file_size = len(data)
+    CRC = zipfile.crc32(data) & 0xffffffff
+    hexdigests = {digest: hashlib.new(digest, data).hexdigest() for digest in digests}
+    cmpr = zipfile._get_compressor(zinfo.compress_type)
+    if cmpr:
+        data = cmpr.compress(data) + cmpr.flush()
+    return CRC, file_size, data, hexdigests
+
+
+def _read_blocks(fp, size, block_size, hashes):
+    """Yield the arguments of _deflate_block() for each block of the first
+    size bytes of the file fp, updating each of hashes with them as they are
+    read"""
+    dictionary = b""
+    for offset in range(0, size, block_size) or [0]:
+        data = fp.read(min(block_size, size - offset))
+        for hash in hashes:
+            hash.update(data)
+        yield data, dictionary, offset + block_size >= size
+        dictionary = (dictionary + data)[-DEFLATE_DICTIONARY_SIZE:]
+
+
+def _deflate_block(data, dictionary, last):
+    """DEFLATE data as part of a stream split into blocks, dictionary being
+    up to 32KiB of the stream before it, returning its CRC-32, length and
+    compressed bytes"""
+    if dictionary:
+        cmpr = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15,
+                                zdict=dictionary)
+    else:
+        cmpr = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    compressed = cmpr.compress(data)
+    # A full flush ends the block on a byte boundary so the next one can
+    # follow it in the same stream
+    compressed += cmpr.flush(zlib.Z_FINISH if last else zlib.Z_FULL_FLUSH)
+    return zlib.crc32(data), len(data), compressed
+
+
+def _gf2_matrix_times(matrix, vector):
+    total = 0
+    i = 0
+    while vector:
+        if vector & 1:
+            total ^= matrix[i]
+        vector >>= 1
+        i += 1
+    return total
+
+
+def _gf2_matrix_square(matrix):
+    return [_gf2_matrix_times(matrix, row) for row in matrix]
+
+
+# Operators for the lengths of the blocks combined so far
+_CRC32_OPERATORS = {}
+
+
+def _crc32_combine_operator(length):
+    """Return the matrix that moves a CRC-32 past length zero bytes, as used
+    by zlib's crc32_combine()"""
+    matrix = _CRC32_OPERATORS.get(length)
+    if matrix is not None:
+        return matrix
+    # Start with the operator for one zero bit, then square it up to bytes
+    odd = [0xedb88320] + [1 << n for n in range(31)]
+    even = _gf2_matrix_square(odd)
+    odd = _gf2_matrix_square(even)
+    matrix = [1 << n for n in range(32)]
+    remaining = length
+    while remaining:
+        even = _gf2_matrix_square(odd)
+        if remaining & 1:
+            matrix = [_gf2_matrix_times(even, row) for row in matrix]
+        remaining >>= 1
+        if not remaining:
+            break
+        odd = _gf2_matrix_square(even)
+        if remaining & 1:
+            matrix = [_gf2_matrix_times(odd, row) for row in matrix]
+        remaining >>= 1
+    if len(_CRC32_OPERATORS) < 64:
+        _CRC32_OPERATORS[length] = matrix
+    return matrix
+
+
+def _crc32_combine(crc1, crc2, length2):
+    """Return the CRC-32 of two blocks joined together from the CRC-32 of
+    each and the length of the second"""
+    if length2 <= 0:
+        return crc1
+    return _gf2_matrix_times(_crc32_combine_operator(length2), crc1) ^ crc2
+
+
+def _check_verify(verify):
+    if verify not in VERIFY_LEVELS:
+        raise ValueError("verify must be one of {}".format(", ".join(VERIFY_LEVELS)))
+
+
+def _has_zip64_extra(extra):
+    """Check whether the extra field contains a ZIP64 extended information
+    record"""
+    while len(extra) >= 4:
+        tp, ln = struct.unpack('<HH', extra[:4])
+        if tp == 1:
+            return True
+        extra = extra[ln+4:]
+    return False
+
+
+def _copy_file_range(source_fd, source_offset, destination_fd,
+                     destination_offset, count):
+    return os.copy_file_range(source_fd, destination_fd, count,
+                              source_offset, destination_offset)
+
+
+def _sendfile(source_fd, source_offset, destination_fd, destination_offset,
+              count):
+    os.lseek(destination_fd, destination_offset, os.SEEK_SET)
+    return os.sendfile(destination_fd, source_fd, source_offset, count)
+
+
+# Kernel side copies in order of preference, where the platform has them
+_KERNEL_COPIES = [copy for (copy, name) in ((_copy_file_range, "copy_file_range"),
+                                            (_sendfile, "sendfile"))
+                  if hasattr(os, name)]
+
+
+def _kernel_copy(source, source_offset, destination, destination_offset, length):
+    """Copy length bytes from source_offset in source to destination_offset in
+    destination without passing them through Python, using copy_file_range
+    or sendfile. Only possible when both are real files.
+
+    Returns the number of bytes copied, which is less than length when the
+    kernel could not copy everything and the remainder has to be copied by
+    hand. Both file objects are left positioned just after the bytes copied.
+    """
+    try:
+        source_fd = source.fileno()
+        destination_fd = destination.fileno()
+        # The kernel only sees what has been written out. Flushing doesn't
+        # drop the read-ahead of a BufferedReader, so source must not be a
+        # separate file object open on the file being written.
+        source.flush()
+        destination.flush()
+    except (AttributeError, OSError, ValueError):
+        # Not a real file
+        source.seek(source_offset)
+        destination.seek(destination_offset)
+        return 0
+
+    copied = 0
+    try:
+        for copy in _KERNEL_COPIES:
+            try:
+                while copied < length:
+                    count = copy(source_fd, source_offset + copied,
+                                 destination_fd, destination_offset + copied,
+                                 length - copied)
+                    if not count:
+                        # End of the source file
+                        return copied
+                    copied += count
+                return copied
+            except OSError:
+                # Not supported for these files - try the next way of copying
+                continue
+        return copied
+    finally:
+        # The kernel moved neither file object, so seek them past the copy
+        source.seek(source_offset + copied)
+        destination.seek(destination_offset + copied)
+
+
+def _copy_file(source, destination, buffer_size=COPY_BUFFER_SIZE):
+    """Copy the whole of source to the current position of destination"""
+    source.seek(0, 2)
+    length = source.tell()
+    position = destination.tell()
+    _kernel_copy(source, 0, destination, position, length)
+    shutil.copyfileobj(source, destination, buffer_size)
+
+
 def find_mount_point(path):
     path = os.path.abspath(path)
     while not os.path.ismount(path):
@@ -0,0 +1,310 @@
+"""
+Packed index of the central directory of a zip archive.
+
+The index lets an archive be opened without creating a ZipInfo instance for
+each of its members. It can be kept in a sidecar file next to the archive,
+keyed on the size and modification time of the archive, so that subsequent
+opens only need to map the sidecar into memory.
+
+Layout of the index (native byte order, all integers unsigned 64 bit):
+
+    header      magic, byte order mark, version, archive size, archive
+                mtime (ns), start of the central directory, size of the
+                central directory, concat, number of entries, size of the
+                names table
+    cd_order    offset of each entry within the central directory, in
+                central directory order
+    by_name     offset of each entry within the central directory, sorted by
+                name
+    name_offs   offsets of each name within the names table (entries + 1)
+    names       utf-8 encoded names of the entries, sorted
+"""
+import os
+import mmap
+import struct
+import tempfile
+from array import array
+from itertools import accumulate
+from collections.abc import Mapping, Sequence
+
+from .packages.zipfile import (BadZipFile, _EndRecData, _ECD_SIZE, _ECD_OFFSET,
+                               _ECD_LOCATION, _ECD_SIGNATURE, _ECD_COMMENT,
+                               stringEndArchive64, sizeEndCentDir64,
+                               sizeEndCentDir64Locator, structCentralDir,
+                               stringCentralDir, sizeCentralDir, _CD_SIGNATURE,
+                               _CD_FLAG_BITS, _CD_FILENAME_LENGTH,
+                               _CD_EXTRA_FIELD_LENGTH, _CD_COMMENT_LENGTH)
+
+INDEX_SUFFIX = ".index"
+INDEX_MAGIC = b"ROZIPIDX"
+INDEX_VERSION = 1
+
+# Written in native byte order so indexes from other platforms are rejected
+_BYTE_ORDER_MARK = 0x0102030405060708
+
+structIndexHeader = "=8s9Q"
+sizeIndexHeader = struct.calcsize(structIndexHeader)
+
+_IH_MAGIC = 0
+_IH_BYTE_ORDER_MARK = 1
+_IH_VERSION = 2
+_IH_ARCHIVE_SIZE = 3
+_IH_ARCHIVE_MTIME = 4
+_IH_START_DIR = 5
+_IH_SIZE_CD = 6
+_IH_CONCAT = 7
+_IH_COUNT = 8
+_IH_NAMES_SIZE = 9
+
+
+class ZipIndex(object):
+    """
+    Packed, read only index of the members of a zip archive.
+
+    index = ZipIndex.load(fp, index_file=None)
+
+    fp: The file-like object of the archive.
+
+    index_file: Path of the sidecar file holding the index. If the sidecar
+                is missing or out of date it is rebuilt from the central
+                directory and written back. If None the index is only built
+                in memory.
+    """
+
+    def __init__(self, buffer, comment=b""):
+        self._buffer = buffer
+        header = struct.unpack_from(structIndexHeader, buffer)
+        self.archive_size = header[_IH_ARCHIVE_SIZE]
+        self.archive_mtime = header[_IH_ARCHIVE_MTIME]
+        self.start_dir = header[_IH_START_DIR]
+        self.size_cd = header[_IH_SIZE_CD]
+        self.concat = header[_IH_CONCAT]
+        self.count = header[_IH_COUNT]
+        self.comment = comment
+
+        view = memoryview(buffer)
+        tables = view[sizeIndexHeader:sizeIndexHeader + 8 * (3 * self.count + 1)].cast("Q")
+        self.cd_order = tables[:self.count]
+        self._by_name = tables[self.count:2 * self.count]
+        self._name_offsets = tables[2 * self.count:]
+        start = sizeIndexHeader + 8 * (3 * self.count + 1)
+        self._names = view[start:start + header[_IH_NAMES_SIZE]]
+        self._views = [view, tables, self.cd_order, self._by_name,
+                       self._name_offsets, self._names]
+
+    @classmethod
+    def load(cls, fp, index_file=None):
+        """Return the index for the archive fp, using the sidecar index_file
+        when it is up to date"""
+        try:
+            endrec = _EndRecData(fp)
+        except OSError:
+            raise BadZipFile("File is not a zip file")
+        if not endrec:
+            raise BadZipFile("File is not a zip file")
+        size_cd = endrec[_ECD_SIZE]             # bytes in central directory
+        offset_cd = endrec[_ECD_OFFSET]         # offset of central directory
+        # "concat" is zero, unless zip was concatenated to another file
+        concat = endrec[_ECD_LOCATION] - size_cd - offset_cd
+        if endrec[_ECD_SIGNATURE] == stringEndArchive64:
+            # If Zip64 extension structures are present, account for them
+            concat -= (sizeEndCentDir64 + sizeEndCentDir64Locator)
+        start_dir = offset_cd + concat
+
+        archive_size, archive_mtime = _stat(fp)
+        if index_file is not None:
+            buffer = _map_sidecar(index_file, archive_size, archive_mtime,
+                                  start_dir, size_cd)
+            if buffer is not None:
+                return cls(buffer, endrec[_ECD_COMMENT])
+
+        buffer = _build(fp, archive_size, archive_mtime, start_dir, size_cd,
+                        concat)
+        if index_file is not None and archive_size is not None:
+            _write_sidecar(index_file, buffer)
+        return cls(buffer, endrec[_ECD_COMMENT])
+
+    def find(self, name):
+        """Return the offset within the central directory of the entry for
+        name, or None if there is no such member"""
+        try:
+            key = name.encode("utf-8", "surrogatepass")
+        except (AttributeError, UnicodeError):
+            return None
+        # Find the last of any entries with this name, as ZipFile does
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key < self._name(mid):
+                hi = mid
+            else:
+                lo = mid + 1
+        if lo and self._name(lo - 1) == key:
+            return self._by_name[lo - 1]
+        return None
+
+    def _name(self, i):
+        return self._names[self._name_offsets[i]:self._name_offsets[i + 1]].tobytes()
+
+    def close(self):
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+        if isinstance(self._buffer, mmap.mmap):
+            try:
+                self._buffer.close()
+            except BufferError:
+                # A view is still held elsewhere - leave it to be collected
+                pass
+        self._buffer = None
+
+
+class LazyInfoList(Sequence):
+    """Read only list of the ZipInfo instances of an archive, in central
+    directory order, created as they are accessed"""
+
+    def __init__(self, index, load):
+        self._index = index
+        self._load = load
+
+    def __len__(self):
+        return self._index.count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._load(offset) for offset in self._index.cd_order[i]]
+        return self._load(self._index.cd_order[i])
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+
+class LazyNameToInfo(Mapping):
+    """Read only mapping of member names to ZipInfo instances, using the
+    index to find a member without reading the whole central directory"""
+
+    def __init__(self, index, load):
+        self._index = index
+        self._load = load
+
+    def __getitem__(self, name):
+        offset = self._index.find(name)
+        if offset is None:
+            raise KeyError(name)
+        return self._load(offset)
+
+    def __contains__(self, name):
+        return self._index.find(name) is not None
+
+    def __iter__(self):
+        for offset in self._index.cd_order:
+            yield self._load(offset).filename
+
+    def __len__(self):
+        return self._index.count
+
+
+def _stat(fp):
+    """Return the size and modification time (ns) of the file behind fp, or
+    (None, None) if it isn't a real file"""
+    try:
+        st = os.fstat(fp.fileno())
+    except (AttributeError, OSError, ValueError):
+        return None, None
+    return st.st_size, st.st_mtime_ns
+
+
+def _normalize(filename):
+    # Normalize the name as ZipInfo does, so lookups match NameToInfo
+    null_byte = filename.find(chr(0))
+    if null_byte >= 0:
+        filename = filename[0:null_byte]
+    if os.sep != "/" and os.sep in filename:
+        filename = filename.replace(os.sep, "/")
+    return filename
+
+
+def _build(fp, archive_size, archive_mtime, start_dir, size_cd, concat):
+    """Build the index from the central directory of the archive"""
+    fp.seek(start_dir)
+    data = fp.read(size_cd)
+    names = []
+    offsets = array("Q")
+    pos = 0
+    while pos < size_cd:
+        if pos + sizeCentralDir > len(data):
+            raise BadZipFile("Truncated central directory")
+        centdir = struct.unpack_from(structCentralDir, data, pos)
+        if centdir[_CD_SIGNATURE] != stringCentralDir:
+            raise BadZipFile("Bad magic number for central directory")
+        start = pos + sizeCentralDir
+        filename = data[start:start + centdir[_CD_FILENAME_LENGTH]]
+        if centdir[_CD_FLAG_BITS] & 0x800:
+            filename = filename.decode("utf-8")
+        else:
+            filename = filename.decode("cp437")
+        names.append(_normalize(filename).encode("utf-8", "surrogatepass"))
+        offsets.append(pos)
+        pos = (start + centdir[_CD_FILENAME_LENGTH] +
+               centdir[_CD_EXTRA_FIELD_LENGTH] + centdir[_CD_COMMENT_LENGTH])
+
+    # sorted() is stable, so entries sharing a name stay in directory order
+    order = sorted(range(len(names)), key=names.__getitem__)
+    by_name = array("Q", (offsets[i] for i in order))
+    sorted_names = [names[i] for i in order]
+    name_offsets = array("Q", accumulate([0] + [len(n) for n in sorted_names]))
+    names_table = b"".join(sorted_names)
+
+    header = struct.pack(structIndexHeader, INDEX_MAGIC, _BYTE_ORDER_MARK,
+                         INDEX_VERSION, archive_size or 0, archive_mtime or 0,
+                         start_dir, size_cd, concat, len(offsets),
+                         len(names_table))
+    return b"".join([header, offsets.tobytes(), by_name.tobytes(),
+                     name_offsets.tobytes(), names_table])
+
+
+def _map_sidecar(index_file, archive_size, archive_mtime, start_dir, size_cd):
+    """Map the sidecar index into memory if it is up to date for the archive,
+    otherwise return None"""
+    if archive_size is None:
+        return None
+    try:
+        with open(index_file, "rb") as fp:
+            buffer = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    try:
+        header = struct.unpack_from(structIndexHeader, buffer)
+    except struct.error:
+        buffer.close()
+        return None
+    if (header[_IH_MAGIC] != INDEX_MAGIC or
+            header[_IH_BYTE_ORDER_MARK] != _BYTE_ORDER_MARK or
+            header[_IH_VERSION] != INDEX_VERSION or
+            header[_IH_ARCHIVE_SIZE] != archive_size or
+            header[_IH_ARCHIVE_MTIME] != archive_mtime or
+            header[_IH_START_DIR] != start_dir or
+            header[_IH_SIZE_CD] != size_cd or
+            len(buffer) != (sizeIndexHeader + 8 * (3 * header[_IH_COUNT] + 1) +
+                            header[_IH_NAMES_SIZE])):
+        buffer.close()
+        return None
+    return buffer
+
+
+def _write_sidecar(index_file, buffer):
+    """Atomically write the index next to the archive. The index is only a
+    cache, so failing to write it is not an error."""
+    try:
+        dir = os.path.dirname(os.path.abspath(index_file))
+        with tempfile.NamedTemporaryFile(dir=dir, delete=False) as fp:
+            fp.write(buffer)
+        os.replace(fp.name, index_file)
+    except OSError:
+        try:
+            os.unlink(fp.name)
+        except (NameError, OSError):
+            pass
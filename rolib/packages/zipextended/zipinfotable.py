@@ -0,0 +1,244 @@
+"""
+Compact, column based storage for the ZipInfo records of large archives.
+
+Rather than keeping a ZipInfo instance, with its date_time tuple and integer
+objects, for every member, the fields of all members are packed into typed
+arrays. ZipInfoTable.filelist and ZipInfoTable.NameToInfo present the table
+as the list and dictionary that ZipFile expects, handing out lightweight
+CompactZipInfo views that read and write the table.
+"""
+from array import array
+from collections.abc import Mapping, Sequence
+
+from .packages import zipfile
+
+# ZipInfo fields stored in typed arrays, with their array type codes
+_COLUMNS = (
+    ("header_offset", "Q"),
+    ("compress_size", "Q"),
+    ("file_size", "Q"),
+    ("CRC", "I"),
+    ("external_attr", "I"),
+    ("compress_type", "H"),
+    ("flag_bits", "H"),
+    ("volume", "H"),
+    ("internal_attr", "H"),
+    ("create_system", "B"),
+    ("create_version", "B"),
+    ("extract_version", "B"),
+    ("reserved", "B"),
+)
+
+# ZipInfo fields that are usually empty, stored only when they are not
+_SPARSE = ("orig_filename", "comment", "extra")
+
+
+class ZipInfoTable(object):
+    """Column store for the ZipInfo fields of the members of an archive"""
+
+    def __init__(self):
+        self._columns = {name: array(typecode) for (name, typecode) in _COLUMNS}
+        self._year = array("H")
+        # month, day, hour, minute and second packed into 26 bits
+        self._time = array("I")
+        self._names = []
+        self._sparse = {name: {} for name in _SPARSE}
+        # Rows removed from the archive keep their data for removed_filelist
+        self._live = bytearray()
+        self._count = 0
+        self._index = {}
+        self.filelist = CompactInfoList(self)
+        self.NameToInfo = CompactNameToInfo(self)
+
+    def __len__(self):
+        return self._count
+
+    def append(self, zinfo):
+        """Add the fields of zinfo as a new row, returning the row"""
+        row = len(self._names)
+        for (name, typecode) in _COLUMNS:
+            self._columns[name].append(getattr(zinfo, name, 0))
+        self._set_date_time(row, zinfo.date_time)
+        self._names.append(zinfo.filename)
+        for name in _SPARSE:
+            self._set_sparse(row, name, getattr(zinfo, name, None))
+        self._live.append(1)
+        self._count += 1
+        self._index[zinfo.filename] = row
+        return row
+
+    def info(self, row):
+        return CompactZipInfo(self, row)
+
+    def rows(self):
+        """Iterate over the rows still in the archive, in order"""
+        live = self._live
+        return (row for row in range(len(live)) if live[row])
+
+    def find(self, zinfo):
+        """Return the row holding zinfo"""
+        if isinstance(zinfo, CompactZipInfo) and zinfo._table is self:
+            return zinfo._row
+        row = self._index.get(zinfo.filename)
+        if row is not None and self._columns["header_offset"][row] == zinfo.header_offset:
+            return row
+        for row in reversed(range(len(self._names))):
+            if (self._live[row] and self._names[row] == zinfo.filename and
+                    self._columns["header_offset"][row] == zinfo.header_offset):
+                return row
+        raise ValueError("{!r} is not in the archive".format(zinfo))
+
+    def remove(self, row):
+        if self._live[row]:
+            self._live[row] = 0
+            self._count -= 1
+
+    def get(self, row, name):
+        if name == "filename":
+            return self._names[row]
+        elif name == "date_time":
+            time = self._time[row]
+            return (self._year[row], time >> 22, (time >> 17) & 0x1F,
+                    (time >> 12) & 0x1F, (time >> 6) & 0x3F, time & 0x3F)
+        elif name == "_raw_time":
+            dt = self.get(row, "date_time")
+            return dt[3] << 11 | dt[4] << 5 | (dt[5] // 2)
+        elif name in self._sparse:
+            value = self._sparse[name].get(row)
+            if value is None:
+                value = self._names[row] if name == "orig_filename" else b""
+            return value
+        return self._columns[name][row]
+
+    def set(self, row, name, value):
+        if name == "filename":
+            # orig_filename keeps the old name until the rename is committed
+            if row not in self._sparse["orig_filename"]:
+                self._sparse["orig_filename"][row] = self._names[row]
+            self._names[row] = value
+            self._set_sparse(row, "orig_filename",
+                             self._sparse["orig_filename"][row])
+        elif name == "date_time":
+            self._set_date_time(row, value)
+        elif name == "_raw_time":
+            # Derived from date_time
+            pass
+        elif name in self._sparse:
+            self._set_sparse(row, name, value)
+        else:
+            self._columns[name][row] = value
+
+    def _set_date_time(self, row, date_time):
+        year, month, day, hour, minute, second = date_time[:6]
+        time = month << 22 | day << 17 | hour << 12 | minute << 6 | second
+        if row == len(self._year):
+            self._year.append(year)
+            self._time.append(time)
+        else:
+            self._year[row] = year
+            self._time[row] = time
+
+    def _set_sparse(self, row, name, value):
+        default = self._names[row] if name == "orig_filename" else b""
+        if value is None or value == default:
+            self._sparse[name].pop(row, None)
+        else:
+            self._sparse[name][row] = value
+
+
+class CompactZipInfo(zipfile.ZipInfo):
+    """A ZipInfo whose fields live in a row of a ZipInfoTable"""
+
+    __slots__ = ("_table", "_row")
+
+    def __init__(self, table, row):
+        object.__setattr__(self, "_table", table)
+        object.__setattr__(self, "_row", row)
+
+    def __eq__(self, other):
+        return (isinstance(other, CompactZipInfo) and
+                other._table is self._table and other._row == self._row)
+
+    def __hash__(self):
+        return hash((id(self._table), self._row))
+
+    def __copy__(self):
+        # A copy is detached from the table, so changing it leaves the
+        # archive's member alone
+        zinfo = zipfile.ZipInfo(self.filename, self.date_time)
+        for name in zipfile.ZipInfo.__slots__:
+            setattr(zinfo, name, getattr(self, name))
+        return zinfo
+
+
+def _field(name):
+    def get(self):
+        return self._table.get(self._row, name)
+
+    def set(self, value):
+        self._table.set(self._row, name, value)
+    return property(get, set)
+
+for name in zipfile.ZipInfo.__slots__:
+    setattr(CompactZipInfo, name, _field(name))
+
+
+class CompactInfoList(Sequence):
+    """The members of a ZipInfoTable presented as ZipFile.filelist"""
+
+    def __init__(self, table):
+        self._table = table
+
+    def __len__(self):
+        return len(self._table)
+
+    def __iter__(self):
+        for row in self._table.rows():
+            yield self._table.info(row)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(self)[i]
+        if len(self._table) == len(self._table._names):
+            # Nothing removed - rows and positions match
+            row = range(len(self._table._names))[i]
+        else:
+            row = list(self._table.rows())[i]
+        return self._table.info(row)
+
+    def append(self, zinfo):
+        self._table.append(zinfo)
+
+    def remove(self, zinfo):
+        self._table.remove(self._table.find(zinfo))
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+
+class CompactNameToInfo(Mapping):
+    """The members of a ZipInfoTable presented as ZipFile.NameToInfo"""
+
+    def __init__(self, table):
+        self._table = table
+
+    def __getitem__(self, name):
+        return self._table.info(self._table._index[name])
+
+    def __setitem__(self, name, zinfo):
+        self._table._index[name] = self._table.find(zinfo)
+
+    def __delitem__(self, name):
+        del self._table._index[name]
+
+    def __contains__(self, name):
+        return name in self._table._index
+
+    def __iter__(self):
+        return iter(self._table._index)
+
+    def __len__(self):
+        return len(self._table._index)
@@ -4,7 +4,9 @@ import rolib.packages.zipextended.packages.zipfile as zipfile
 import datetime
 import tempfile
 
-from rolib.packages.zipextended.zipfileextended import ZipFileExtended
+from rolib.packages.zipextended.zipfileextended import (ZipFileExtended, COPY_BUFFER_SIZE,
+                                                        VERIFY_STRUCTURE, VERIFY_NONE,
+                                                        _check_verify)
 
 META_INF_DIR = "META-INF"
 MIMETYPE_FILE = "mimetype"
@@ -26,7 +28,8 @@ DEFAULT_RESERVED_DIRECTORIES = [ META_INF_DIR ]
 
 class UCF(ZipFileExtended, object):
 
-    def __init__(self, file, mode="r", compression=zipfile.ZIP_STORED, allowZip64=True,mimetype=None):
+    def __init__(self, file, mode="r", compression=zipfile.ZIP_STORED, allowZip64=True,mimetype=None,
+                 lazy=False, index_file=None, compact_info=False, pread=None):
         """
         Class with methods to open, read, write, remove, rename, close and list Universal Container Format (UCF) files.
 
@@ -56,9 +59,25 @@ class UCF(ZipFileExtended, object):
                     be read from the archive.
                     If the mode parameter is 'r' the mimetype parameter will be
                     ignored and read from the archive.
+
+        lazy:       If True and the mode is 'r', members are looked up through
+                    a packed index instead of reading the whole central
+                    directory on open (see ZipFileExtended).
+
+        index_file: The sidecar file for the packed index of a lazy UCF.
+
+        compact_info: If True the members are kept in a compact, column based
+                      table rather than as ZipInfo objects (see
+                      ZipFileExtended).
+
+        pread: If True members are read with os.pread(), so that several
+               threads can read them at once (see ZipFileExtended). By
+               default it is used when possible in read mode.
         """
         self._check_compression_type(compression)
-        super(UCF, self).__init__(file,mode=mode,compression=compression,allowZip64=allowZip64)
+        super(UCF, self).__init__(file,mode=mode,compression=compression,allowZip64=allowZip64,
+                                  lazy=lazy,index_file=index_file,
+                                  compact_info=compact_info, pread=pread)
         if mode == 'r':
             #if we're in read mode then verify that the mimetype is there and
             #valid - if not then an exception will be raised
@@ -97,7 +116,7 @@ class UCF(ZipFileExtended, object):
         self._add_mimetype_file()
 
     def get_mimetype_from_file(self):
-        if 'mimetype' not in self.namelist():
+        if 'mimetype' not in self.NameToInfo:
             raise MissingMimetypeFileException("Mimetype file is missing.")
         fileinfo = self.getinfo('mimetype')
         if fileinfo.header_offset != MIMETYPE_FILE_OFFSET:
@@ -108,12 +127,20 @@ class UCF(ZipFileExtended, object):
         mimetype = mimetype.decode(encoding='ascii')
         return mimetype
 
-    def write(self, filename, arcname=None, compress_type=None):
+    def write(self, filename, arcname=None, compress_type=None, digests=()):
         if arcname is None:
             arcname = filename
         compress_type = compress_type or zipfile.ZIP_STORED
         self._check_compression_type(compress_type)
-        super(UCF, self).write(filename=filename,arcname=arcname,compress_type=compress_type)
+        return super(UCF, self).write(filename=filename,arcname=arcname,compress_type=compress_type,
+                                      digests=digests)
+
+    def write_many(self, filenames, arcnames=None, compress_type=None, workers=None, digests=()):
+        compress_type = compress_type or zipfile.ZIP_STORED
+        self._check_compression_type(compress_type)
+        return super(UCF, self).write_many(filenames, arcnames=arcnames,
+                                           compress_type=compress_type, workers=workers,
+                                           digests=digests)
 
     def writestr(self, zinfo_or_arcname, data, compress_type=None):
         if isinstance(zinfo_or_arcname, zipfile.ZipInfo):
@@ -187,20 +214,22 @@ class UCF(ZipFileExtended, object):
             #create a temporary new archive, copy everything over and
             #then switch it in when that has completed successfully.
             #This is how zip -u works?
-            self.commit()
+            self.commit(rewrite=True)
 
     #TODO: Let clone take a filter for the files to include?
 
-    def clone(self, file):
+    def clone(self, file, buffer_size=COPY_BUFFER_SIZE, verify=VERIFY_STRUCTURE):
+        _check_verify(verify)
         with UCF(file,mode="w",mimetype=self.mimetype) as new_zip:
             #Don't copy the mimetype file - it's already added by the init above
             infolist = (fileinfo for fileinfo in self.infolist() if fileinfo.filename != MIMETYPE_FILE)
             for fileinfo in infolist:
-                bytes = self.read_compressed(fileinfo.filename)
-                new_zip.write_compressed(fileinfo,bytes)
-            badfile = new_zip.testzip()
-        if(badfile):
-            raise zipfile.BadZipFile("Error when cloning zipfile, failed zipfile CRC-32 check: file is corrupt")
+                new_zip.write_compressed_from(self, fileinfo, buffer_size)
+            written = list(new_zip.filelist)
+        if verify != VERIFY_NONE:
+            #Read back what was written - raises BadZipFile if it doesn't match
+            with ZipFileExtended(file) as check:
+                check._verify(written, verify)
         return new_zip
 
     def namelist(self,ignore_reserved=False):
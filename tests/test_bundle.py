@@ -0,0 +1,139 @@
+import json
+import hashlib
+import unittest as unittest
+import zipfile as stdzipfile
+
+import os
+
+from tests.support import TESTFN, TESTFN2, unlink
+
+from rolib.bundle import Bundle, MANIFEST_FILE
+from rolib.manifest import Manifest
+
+
+class BundleTestCase(unittest.TestCase):
+
+    def setUp(self):
+        with Bundle(TESTFN, mode="w") as bundle:
+            bundle.writestr("first", "first file contents")
+
+    def tearDown(self):
+        unlink(TESTFN)
+
+    def manifest_uris(self):
+        with stdzipfile.ZipFile(TESTFN) as zip:
+            self.assertIsNone(zip.testzip())
+            self.assertEqual(zip.namelist()[-1], MANIFEST_FILE)
+            manifest = json.loads(zip.read(MANIFEST_FILE).decode("utf-8"))
+        return [aggregate["uri"] for aggregate in manifest["aggregates"]]
+
+    def test_batch_defers_commit(self):
+        with Bundle(TESTFN, mode="a") as bundle:
+            with bundle.batch():
+                for name in ("second", "third"):
+                    bundle.writestr(name, name + " file contents")
+                    bundle.commit()
+                    self.assertTrue(bundle.requires_commit)
+            self.assertFalse(bundle.requires_commit)
+            self.assertEqual(bundle.namelist()[-1], MANIFEST_FILE)
+
+        self.assertEqual(len(self.manifest_uris()), 3)
+
+    def test_close_commits_open_batch(self):
+        bundle = Bundle(TESTFN, mode="a")
+        with bundle.batch():
+            bundle.writestr("second", "second file contents")
+            bundle.close()
+        self.assertEqual(len(self.manifest_uris()), 2)
+
+    def test_manifest_is_rewritten_in_place(self):
+        for name in ("second", "third", "fourth"):
+            with Bundle(TESTFN, mode="a") as bundle:
+                bundle.writestr(name, name + " file contents")
+
+        self.assertEqual(len(self.manifest_uris()), 4)
+        with Bundle(TESTFN, mode="r") as bundle:
+            self.assertEqual(bundle.wasted_bytes(), 0)
+
+    def test_compact_keeps_manifest(self):
+        with Bundle(TESTFN, mode="a") as bundle:
+            bundle.writestr("second", "second file contents")
+        with Bundle(TESTFN, mode="a") as bundle:
+            bundle.remove("first")
+            bundle.writestr("third", "third file contents")
+            bundle.compact()
+            self.assertEqual(bundle.wasted_bytes(), 0)
+
+        self.assertEqual(self.manifest_uris(), ["second", "third"])
+        with Bundle(TESTFN, mode="r") as bundle:
+            self.assertEqual(list(bundle.manifest.aggregates.ids()), ["second", "third"])
+
+    def test_iter_aggregates_from_bundle(self):
+        with Bundle(TESTFN, mode="a") as bundle:
+            bundle.writestr("second", "second file contents")
+        with Bundle(TESTFN, mode="r") as bundle:
+            aggregates = Manifest.iter_aggregates(file=bundle.open(MANIFEST_FILE))
+            self.assertEqual([a.uri for a in aggregates], ["first", "second"])
+
+    def test_checksums_recorded(self):
+        with Bundle(TESTFN, mode="a") as bundle:
+            bundle.writestr("second", "second file contents")
+            self.assertEqual(bundle.manifest.get_aggregate("second").checksums,
+                             {"sha256": hashlib.sha256(b"second file contents").hexdigest()})
+            bundle.checksum_algorithms = ()
+            bundle.writestr("third", "third file contents")
+            self.assertFalse(hasattr(bundle.manifest.get_aggregate("third"), "checksums"))
+
+
+class BundleUpdateTestCase(unittest.TestCase):
+
+    sources = [TESTFN2 + suffix for suffix in ("a", "b", "c")]
+
+    def setUp(self):
+        self.manifest = Manifest()
+        for source in self.sources:
+            self.write_source(source, source + " contents")
+            self.manifest.add_aggregate("/" + source)
+
+    def tearDown(self):
+        for filename in [TESTFN, TESTFN2] + self.sources:
+            unlink(filename)
+
+    def write_source(self, source, data, mtime=1000000000):
+        with open(source, "w") as fp:
+            fp.write(data)
+        os.utime(source, (mtime, mtime))
+
+    def contents(self, filename):
+        with stdzipfile.ZipFile(filename) as zip:
+            self.assertIsNone(zip.testzip())
+            return {name: zip.read(name) for name in zip.namelist()}
+
+    def test_update_matches_rebuild(self):
+        # Created when there is no bundle
+        Bundle.update_from_manifest(TESTFN, self.manifest)
+        with Bundle(TESTFN) as bundle:
+            offset = bundle.getinfo(self.sources[0]).header_offset
+
+        self.write_source(self.sources[1], "changed", mtime=1000000010)
+        self.manifest.remove_aggregate("/" + self.sources[2])
+        Bundle.update_from_manifest(TESTFN, self.manifest)
+        Bundle.create_from_manifest(TESTFN2, self.manifest)
+
+        self.assertEqual(self.contents(TESTFN), self.contents(TESTFN2))
+        with Bundle(TESTFN) as bundle:
+            self.assertEqual(bundle.read(self.sources[1]), b"changed")
+            self.assertNotIn(self.sources[2], bundle.namelist())
+            self.assertEqual(bundle.getinfo(self.sources[0]).header_offset, offset)
+            self.assertEqual(bundle.wasted_bytes(), 0)
+
+    def test_update_compares_checksums(self):
+        self.manifest.get_aggregate("/" + self.sources[0]).checksums = {"sha256": "old"}
+        Bundle.update_from_manifest(TESTFN, self.manifest)
+        # Same size and modification time, but a different checksum
+        self.write_source(self.sources[0], self.sources[0] + " CONTENTS")
+        self.manifest.get_aggregate("/" + self.sources[0]).checksums = {"sha256": "new"}
+        Bundle.update_from_manifest(TESTFN, self.manifest)
+        with Bundle(TESTFN) as bundle:
+            self.assertEqual(bundle.read(self.sources[0]),
+                             (self.sources[0] + " CONTENTS").encode())
@@ -0,0 +1,284 @@
+import io
+import os
+import json
+import time
+import shutil
+import tempfile
+import unittest as unittest
+import zipfile as stdzipfile
+from unittest import mock
+from contextlib import redirect_stdout
+
+from tests import support
+from rolib import fixity
+
+try:
+    from rolib.command import command
+except ImportError:
+    # The ro commands need rolib.annotation, future and httplib2
+    command = None
+
+
+def _age(path, seconds=10):
+    """Set the modification time of path back by seconds from now"""
+    mtime = time.time_ns() - seconds * 10**9
+    os.utime(path, ns=(mtime, mtime))
+
+
+@unittest.skipIf(command is None, "the ro commands can't be imported")
+class CommandTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.run_command(command.init, "test", self.dir)
+        self.files = ["a.txt", "b.txt", os.path.join("sub", "c.txt")]
+        os.mkdir(os.path.join(self.dir, "sub"))
+        for file in self.files:
+            self.write(file, "contents of " + file)
+
+    def path(self, file):
+        return os.path.join(self.dir, file)
+
+    def write(self, file, contents, age=True):
+        with open(self.path(file), "w") as fp:
+            fp.write(contents)
+        if age:
+            _age(self.path(file))
+
+    def run_command(self, function, *args, **kwargs):
+        with redirect_stdout(io.StringIO()) as output:
+            status = function(*args, **kwargs)
+        self.assertFalse(status, output.getvalue())
+        return output.getvalue()
+
+    def journal(self):
+        """Return the records in the manifest journal"""
+        try:
+            with open(command.manifest_journal_file(self.dir)) as fp:
+                return [json.loads(line) for line in fp]
+        except FileNotFoundError:
+            return []
+
+    def add(self, **kwargs):
+        """Run ro add -r on the research object, returning the files hashed
+        and the aggregates written to the journal"""
+        records = len(self.journal())
+        with mock.patch.object(fixity, "checksum", wraps=fixity.checksum) as checksum:
+            self.run_command(command.add, self.dir, self.dir, recursive=True, **kwargs)
+        hashed = sorted(os.path.relpath(call[0][0], self.dir) for call in checksum.call_args_list)
+        added = sorted(record["value"]["uri"] for record in self.journal()[records:]
+                       if record["change"] == "add")
+        return hashed, added
+
+
+class StatCacheTestCase(CommandTestCase):
+
+    def test_add_skips_unchanged_files(self):
+        identifiers = sorted(os.sep + file for file in self.files)
+        self.assertEqual(self.add(), (sorted(self.files), identifiers))
+        cache = command.read_stat_cache(self.dir)
+        self.assertEqual(sorted(cache), identifiers)
+        stat = os.stat(self.path("a.txt"))
+        self.assertEqual(cache[os.sep + "a.txt"],
+                         (stat.st_size, stat.st_mtime_ns, stat.st_ino, ("sha256",)))
+
+        self.assertEqual(self.add(), ([], []))
+        self.assertEqual(self.add(force=True), (sorted(self.files), identifiers))
+
+        # Only the file changed is hashed and added again
+        self.write("a.txt", "changed contents")
+        self.assertEqual(self.add(), (["a.txt"], [os.sep + "a.txt"]))
+        sums = command.read_manifest(self.dir).get_aggregate(os.sep + "a.txt").checksums
+        self.assertEqual(sums, fixity.checksum(self.path("a.txt")))
+
+        # As is every file when other checksums are asked for
+        self.assertEqual(self.add(checksums=("sha256", "blake2b")),
+                         (sorted(self.files), identifiers))
+        self.assertEqual(self.add(checksums=("sha256", "blake2b")), ([], []))
+
+    def test_add_recent_files_are_not_cached(self):
+        self.write("b.txt", "just changed", age=False)
+        self.assertEqual(self.add()[0], sorted(self.files))
+        self.assertNotIn(os.sep + "b.txt", command.read_stat_cache(self.dir))
+        self.assertEqual(self.add(), (["b.txt"], [os.sep + "b.txt"]))
+
+    def test_add_leaves_out_manifest_directory(self):
+        self.add()
+        ids = list(command.read_manifest(self.dir).aggregates.ids())
+        self.assertEqual(sorted(ids), sorted(os.sep + file for file in self.files))
+        self.assertFalse([id for id in ids if id.startswith(os.sep + command.MANIFEST_DIR)])
+
+    def test_in_directory(self):
+        self.assertTrue(command.in_directory(self.dir, self.dir))
+        self.assertTrue(command.in_directory(self.path("sub"), self.dir))
+        self.assertTrue(command.in_directory(self.path("a.txt"), self.dir))
+        self.assertFalse(command.in_directory(os.path.dirname(self.dir), self.dir))
+        self.assertFalse(command.in_directory(self.dir + "other", self.dir))
+
+    def test_stat_cache_round_trip(self):
+        cache = {os.sep + "a.txt": (12, 1234567890123456789, 42, ("sha256", "blake2b"))}
+        command.write_stat_cache(self.dir, cache)
+        self.assertEqual(command.read_stat_cache(self.dir), cache)
+        with open(command.stat_cache_file(self.dir), "r+b") as fp:
+            fp.truncate(len(command.STAT_CACHE_MAGIC) + 5)
+        self.assertEqual(command.read_stat_cache(self.dir), {})
+        os.unlink(command.stat_cache_file(self.dir))
+        self.assertEqual(command.read_stat_cache(self.dir), {})
+
+
+class JournalTestCase(CommandTestCase):
+
+    def test_write_manifest_folds_large_journal(self):
+        journal = command.manifest_journal_file(self.dir)
+        manifest = command.manifest_file(self.dir)
+        with open(manifest) as fp:
+            contents = fp.read()
+        self.add()
+        self.assertTrue(os.path.exists(journal))
+        with open(manifest) as fp:
+            self.assertEqual(fp.read(), contents)
+
+        # Appending past the threshold writes the whole manifest
+        with mock.patch.object(command, "JOURNAL_FOLD_SIZE", os.path.getsize(journal)):
+            self.run_command(command.remove, self.dir, "/a.txt")
+        self.assertFalse(os.path.exists(journal))
+        with open(manifest) as fp:
+            ids = [aggregate["uri"] for aggregate in json.load(fp)["aggregates"]]
+        self.assertEqual(sorted(ids), [os.sep + "b.txt", os.path.join(os.sep + "sub", "c.txt")])
+
+    def test_manifest_folds_journal(self):
+        self.add()
+        output = self.run_command(command.manifest, self.dir)
+        self.assertFalse(os.path.exists(command.manifest_journal_file(self.dir)))
+        self.assertIn(os.sep + "a.txt", output)
+        with open(command.manifest_file(self.dir)) as fp:
+            self.assertEqual(len(json.load(fp)["aggregates"]), len(self.files))
+
+    def test_init_removes_stale_journal(self):
+        self.add()
+        self.run_command(command.init, "again", self.dir, force=True)
+        self.assertFalse(os.path.exists(command.manifest_journal_file(self.dir)))
+        manifest = command.read_manifest(self.dir)
+        self.assertEqual(manifest.title, "again")
+        self.assertEqual(len(manifest.aggregates), 0)
+
+
+class WalkTestCase(CommandTestCase):
+
+    def setUp(self):
+        super(WalkTestCase, self).setUp()
+        os.makedirs(self.path(os.path.join("sub", "deeper")))
+        self.write(os.path.join("sub", "deeper", "d.log"), "log")
+        self.write("e.log", "log")
+        os.symlink(self.path("sub"), self.path("linked"))
+
+    def walk(self, *args, **kwargs):
+        return [file for file in command.walk_files(self.dir, *args, **kwargs)
+                if not file.startswith(os.sep + command.MANIFEST_DIR + os.sep)]
+
+    def test_walk_files(self):
+        files = self.walk()
+        self.assertEqual(sorted(files),
+                         sorted(os.sep + file for file in self.files +
+                                [os.path.join("sub", "deeper", "d.log"), "e.log"]))
+        # Links to directories are neither walked nor listed, as os.walk
+        self.assertFalse([file for file in files if file.startswith(os.sep + "linked")])
+        self.assertEqual(self.walk(), files)
+
+    def test_walk_files_ignore(self):
+        self.assertEqual(sorted(self.walk(["*.log"])), sorted(os.sep + file for file in self.files))
+        with mock.patch.object(command, "_scan_directory", wraps=command._scan_directory) as scan:
+            files = self.walk(["deeper"])
+        self.assertNotIn(os.path.join(os.sep + "sub", "deeper", "d.log"), files)
+        self.assertIn(os.sep + "e.log", files)
+        # The contents of a directory left out aren't listed
+        self.assertNotIn(self.path(os.path.join("sub", "deeper")),
+                         [call[0][0] for call in scan.call_args_list])
+        # Patterns are matched against identifiers as well as names
+        self.assertEqual(sorted(self.walk([os.path.join(os.sep + "sub", "*")])),
+                         [os.sep + "a.txt", os.sep + "b.txt", os.sep + "e.log"])
+
+    def test_status_ignore(self):
+        self.run_command(command.add, self.dir, self.path("a.txt"))
+        output = self.run_command(command.status, self.dir)
+        unaggregated = output.split("Unaggregated files:")[1].split()
+        self.assertIn(os.sep + "e.log", unaggregated)
+        self.assertIn(os.path.join(os.sep + command.MANIFEST_DIR, command.MANIFEST_FILE),
+                      unaggregated)
+        self.assertNotIn(os.sep + "a.txt", unaggregated)
+
+        output = self.run_command(command.status, self.dir, ignore=["*.log"],
+                                  prune_manifest_dir=True)
+        self.assertEqual(sorted(output.split("Unaggregated files:")[1].split()),
+                         [os.sep + "b.txt", os.path.join(os.sep + "sub", "c.txt")])
+
+    def test_walk_files_workers(self):
+        for i in range(3):
+            for j in range(3):
+                directory = self.path(os.path.join("tree{}".format(i), "branch{}".format(j)))
+                os.makedirs(directory)
+                for k in range(4):
+                    self.write(os.path.join(directory, "leaf{}".format(k)), "leaf")
+        files = self.walk(workers=1)
+        self.assertEqual(len(files), len(self.files) + 2 + 36)
+        for workers in (2, 4):
+            self.assertEqual(self.walk(workers=workers), files)
+        self.assertEqual(list(command.walk_files(self.dir, workers=4, stat=True)),
+                         list(command.walk_files(self.dir, workers=1, stat=True)))
+
+    def test_add_subdirectory_identifiers(self):
+        # Added from another directory, so identifiers can't rely on the cwd
+        cwd = os.getcwd()
+        self.addCleanup(os.chdir, cwd)
+        os.chdir(os.path.dirname(self.dir))
+        self.run_command(command.add, self.dir, self.path("sub"), recursive=True)
+        self.run_command(command.add, self.dir, self.path(os.path.join("sub", "deeper")))
+        self.run_command(command.add, self.dir, self.path("e.log"))
+        self.assertEqual(sorted(command.read_manifest(self.dir).aggregates.ids()),
+                         [os.sep + "e.log",
+                          os.path.join(os.sep + "sub", "c.txt"),
+                          os.path.join(os.sep + "sub", "deeper", "d.log")])
+
+
+class BundleTestCase(CommandTestCase):
+
+    def setUp(self):
+        super(BundleTestCase, self).setUp()
+        self.add()
+        # Files are bundled by their path from the research object
+        cwd = os.getcwd()
+        self.addCleanup(os.chdir, cwd)
+        os.chdir(self.dir)
+        self.bundle = self.dir + ".zip"
+        self.rebuilt = self.dir + "-rebuilt.zip"
+        self.addCleanup(support.unlink, self.bundle)
+        self.addCleanup(support.unlink, self.rebuilt)
+
+    def members(self, filename):
+        with stdzipfile.ZipFile(filename) as zip:
+            self.assertIsNone(zip.testzip())
+            return {name: zip.read(name) for name in zip.namelist()}
+
+    def assertUpdated(self):
+        self.run_command(command.bundle, self.dir, self.bundle, update=True)
+        self.run_command(command.bundle, self.dir, self.rebuilt)
+        self.assertEqual(self.members(self.bundle), self.members(self.rebuilt))
+
+    def test_update_missing_bundle(self):
+        self.assertUpdated()
+        self.assertIn("sub/c.txt", self.members(self.bundle))
+
+    def test_update_empty_bundle(self):
+        open(self.bundle, "wb").close()
+        self.assertUpdated()
+
+    def test_update_after_remove(self):
+        self.run_command(command.bundle, self.dir, self.bundle)
+        self.write("b.txt", "changed contents")
+        self.add()
+        self.run_command(command.remove, self.dir, "/a.txt")
+        self.assertUpdated()
+        members = self.members(self.bundle)
+        self.assertNotIn("a.txt", members)
+        self.assertEqual(members["b.txt"], b"changed contents")
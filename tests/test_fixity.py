@@ -0,0 +1,42 @@
+import hashlib
+import unittest as unittest
+
+from tests.support import TESTFN, TESTFN2, unlink
+
+from rolib import fixity
+
+
+class FixityTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # Larger than a read, so the file is hashed in more than one block
+        self.data = bytes(range(256)) * (fixity.READ_SIZE // 256 + 3)
+        for filename, data in ((TESTFN, self.data), (TESTFN2, b"")):
+            with open(filename, "wb") as fp:
+                fp.write(data)
+
+    def tearDown(self):
+        unlink(TESTFN)
+        unlink(TESTFN2)
+
+    def test_checksum(self):
+        self.assertEqual(fixity.checksum(TESTFN),
+                         {"sha256": hashlib.sha256(self.data).hexdigest()})
+        self.assertEqual(fixity.checksum(TESTFN, ("sha256", "blake2b")),
+                         fixity.checksum_bytes(self.data, ("sha256", "blake2b")))
+        self.assertEqual(fixity.checksum(TESTFN2, ("blake2b",)),
+                         {"blake2b": hashlib.blake2b().hexdigest()})
+        self.assertRaises(ValueError, fixity.checksum, TESTFN, ("md5",))
+
+    def test_checksums_in_order(self):
+        filenames = [TESTFN, TESTFN2] * 10
+        expected = [fixity.checksum(filename) for filename in filenames]
+        for workers in (1, 3):
+            self.assertEqual(list(fixity.checksums(filenames, workers=workers)), expected)
+
+    def test_checksums_skip_errors(self):
+        filenames = [TESTFN, TESTFN + "-missing", TESTFN2]
+        self.assertRaises(OSError, list, fixity.checksums(filenames, workers=2))
+        for workers in (1, 2):
+            self.assertEqual(list(fixity.checksums(filenames, workers=workers, skip_errors=True)),
+                             [fixity.checksum(TESTFN), None, fixity.checksum(TESTFN2)])
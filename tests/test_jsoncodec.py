@@ -0,0 +1,52 @@
+import json
+import unittest as unittest
+
+from rolib import jsoncodec
+
+# Strings needing escapes, numbers and nesting that the codecs must agree on
+documents = [
+    {"@context": ["https://w3id.org/bundle/context"], "id": "/",
+     "aggregates": [{"uri": "/fé\U0001F600.txt", "createdBy": {}, "size": 2 ** 70}],
+     "annotations": [], "escapes": "\x00\x1f\x7f \"\\/\n\t "},
+    {"float": 1e16, "small": 0.00001, "list": [[], {}, [1, -2]]},
+    [None, True, False, float("nan")],
+    "just a string",
+]
+
+# Nested deeper than there are control characters to reindent with
+for depth in (9, 10, 11, 40):
+    document = ["leaf", {"key": "\n\t"}]
+    for level in range(depth):
+        document = {"level{}".format(level): [document, level]}
+    documents.append(document)
+
+
+@unittest.skipUnless("orjson" in jsoncodec.CODECS, "orjson isn't installed")
+class OrjsonCodecTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.json = jsoncodec.JSONCodec()
+        self.orjson = jsoncodec.OrjsonCodec()
+
+    def test_dumps_matches_json(self):
+        for document in documents:
+            for indent in (None, 0, 2, 4):
+                self.assertEqual(self.orjson.dumps(document, indent),
+                                 self.json.dumps(document, indent))
+
+    def test_loads_matches_json(self):
+        for document in documents[:2]:
+            text = json.dumps(document)
+            self.assertEqual(self.orjson.loads(text), self.json.loads(text))
+            self.assertEqual(self.orjson.loads(text.encode("utf-8")), self.json.loads(text))
+        self.assertIsInstance(self.orjson.loads("[123456789012345678901234567890]")[0], int)
+        self.assertRaises(json.JSONDecodeError, self.orjson.loads, '{"a": 1')
+
+    def test_set_codec(self):
+        previous = jsoncodec.set_codec("json")
+        try:
+            self.assertIsInstance(jsoncodec.get_codec(), jsoncodec.JSONCodec)
+            self.assertRaises(ValueError, jsoncodec.set_codec, "missing")
+        finally:
+            jsoncodec.set_codec(previous)
+        self.assertEqual(jsoncodec.get_codec().name, previous)
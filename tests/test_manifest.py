@@ -1,8 +1,12 @@
+import io
+import os
+import json
 import unittest as unittest
 
 from tests.support import (TESTFN, TESTFN2, unlink, get_files)
 
-from rolib.manifest import Manifest, Aggregate
+from rolib.manifest import (Manifest, Aggregate, Annotation, Agent, JSONLDObject,
+                            iter_manifest_json)
 
 manifest = """
 {
@@ -60,6 +64,12 @@ manifest = """
     ]
 }
 """
+
+def _age(filename, seconds=10):
+    """Set the modification time of filename back by seconds"""
+    stat = os.stat(filename)
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns - seconds * 10**9))
+
 class ManfiestTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -117,6 +127,21 @@ class ManfiestTestCase(unittest.TestCase):
         a = manifest.get_aggregate("/test")
         self.assertEquals(a.createdBy.name,"Deckard")
 
+    def test_manifest_add_aggregates(self):
+        uris = ["/test{}".format(i) for i in range(5)] + ["/test1", Aggregate("/test0")]
+        manifest = Manifest()
+        manifest.add_aggregate("/test3", createdBy="Deckard")
+        for uri in uris:
+            manifest.add_aggregate(uri, createdBy="Alice W.Land", createdOn="2013-03-05T17:29:03Z", mediatype="text/plain")
+        expected = manifest.to_json()
+
+        manifest = Manifest()
+        manifest.add_aggregate("/test3", createdBy="Deckard")
+        added = manifest.add_aggregates(uris, createdBy="Alice W.Land", createdOn="2013-03-05T17:29:03Z", mediatype="text/plain")
+        self.assertEqual(added, 5)
+        self.assertEqual(list(manifest.aggregates.ids()), ["/test2", "/test3", "/test4", "/test1", "/test0"])
+        self.assertEqual(manifest.to_json(), expected)
+
 
     def test_manifest_update_existing_aggregate(self):
         manifest = Manifest()
@@ -145,8 +170,282 @@ class ManfiestTestCase(unittest.TestCase):
         manifest.remove_aggregate(aggregate)
         self.assertNotIn(aggregate, manifest.aggregates)
 
+    def test_manifest_index_read_from_file(self):
+        m = Manifest(filename=TESTFN)
+        self.assertEqual(len(m.aggregates), 4)
+        self.assertIsInstance(m.aggregates[0], Aggregate)
+        annotation = m.get_annotation("urn:uuid:d67466b4-3aeb-4855-8203-90febe71abdf")
+        self.assertEqual(annotation.about, "/folder/soup.jpeg")
+        self.assertIsNone(m.get_aggregate("/missing"))
+
+        contents = json.loads(m.to_json())
+        self.assertEqual([a["uri"] for a in contents["aggregates"]],
+                         [a.uri for a in m.aggregates])
+        self.assertEqual(len(contents["annotations"]), 3)
+
+    def test_manifest_entry_list_sequence(self):
+        self.addCleanup(unlink, TESTFN2)
+        m = Manifest(filename=TESTFN, journal=TESTFN2, writable=True)
+        expected = list(m.aggregates)
+        for entries in (m.aggregates, expected):
+            entries.insert(1, Aggregate("/a"))
+            entries[2] = Aggregate("/b")
+            entries.insert(-1, Aggregate("/c"))
+            entries.insert(100, Aggregate("/d"))
+            del entries[0]
+            entries[1:3] = [Aggregate("/e"), Aggregate("/f"), Aggregate("/g")]
+            entries[::3] = [Aggregate("/h"), Aggregate("/i"), Aggregate("/j")]
+            del entries[-2:]
+            entries[1] = Aggregate(entries[1].uri, mediatype="text/plain")
+        self.assertEqual([m.aggregates[i].uri for i in range(len(m.aggregates))],
+                         [a.uri for a in expected])
+        self.assertEqual(m.aggregates[1:4], expected[1:4])
+        self.assertEqual(m.aggregates[1].mediatype, "text/plain")
+        # Recorded as the changes made, rather than the whole list again
+        self.assertNotIn("clear", [change for change, value in m.aggregates._changes])
+        m.write_journal(TESTFN2)
+        self.assertEqual(Manifest(filename=TESTFN, journal=TESTFN2).to_json(), m.to_json())
+
+    def test_manifest_annotations_about(self):
+        m = Manifest(filename=TESTFN)
+        meta = "urn:uuid:d67466b4-3aeb-4855-8203-90febe71abdf"
+        self.assertEqual([a.uri for a in m.annotations_about("/folder/soup.jpeg")], [meta])
+        self.assertEqual([a.content for a in m.annotations_about("/")],
+                         ["annotations/a-meta-annotation-in-this-ro.txt"])
+        self.assertEqual(m.annotations_about(meta), m.annotations_about("/"))
+        self.assertEqual(m.annotations_about("/missing"), [])
+
+        annotation = m.get_annotation(meta)
+        m.add_annotation(annotation, about="/README.txt")
+        self.assertEqual(m.annotations_about("/folder/soup.jpeg"), [])
+        self.assertEqual(m.annotations_about(m.get_aggregate("/README.txt")), [annotation])
+
+    def test_manifest_remove_annotations_for(self):
+        m = Manifest(filename=TESTFN)
+        meta = "urn:uuid:d67466b4-3aeb-4855-8203-90febe71abdf"
+        m.remove_aggregate("/folder/soup.jpeg", remove_annotations=True)
+        self.assertIsNone(m.get_annotation(meta))
+        self.assertEqual(len(m.annotations), 2)
+
+        # Only the removed resource is dropped from an annotation about several
+        annotation, = m.annotations_about("/")
+        m.remove_annotations_for(Annotation(meta))
+        self.assertEqual(annotation.about, ["/"])
+        self.assertEqual(m.annotations_about("/"), [annotation])
+        self.assertEqual(len(m.annotations), 2)
+
+    def test_properties_are_objectified(self):
+        m = Manifest(filename=TESTFN)
+        self.assertIsInstance(m.__dict__["createdBy"], Agent)
+        self.assertIsInstance(m.get_aggregate("/README.txt").__dict__["createdBy"], Agent)
+
+        aggregate = Aggregate("/test", authoredBy=[{"name": "Alice"}, "Bob"])
+        self.assertEqual([agent.name for agent in aggregate.authoredBy], ["Alice", "Bob"])
+        aggregate.curatedBy = {"name": "Carol", "uri": "http://example.com/carol"}
+        self.assertEqual(aggregate.curatedBy.uri, "http://example.com/carol")
+
+    def test_register_class_for_property(self):
+        class Rating(JSONLDObject):
+            pass
+        class Review(JSONLDObject):
+            pass
+        Review.register_class_for_property("rating", Rating)
+
+        self.assertIsInstance(Review(rating={"stars": 5}).rating, Rating)
+        self.assertIsInstance(Aggregate("/test", rating={"stars": 5}).rating, dict)
+        self.assertIsInstance(Review(createdBy={"name": "Alice"}).createdBy, Agent)
+
+    def test_lazy_manifest(self):
+        eager = Manifest(filename=TESTFN)
+        m = Manifest(filename=TESTFN, lazy=True)
+        self.assertEqual(list(m.aggregates.ids()), [a.uri for a in eager.aggregates])
+        self.assertTrue(all(isinstance(a, dict) for a in m.aggregates.json_entries()))
+
+        a = m.get_aggregate("/README.txt")
+        self.assertIsInstance(a, Aggregate)
+        self.assertEqual(a.createdBy.name, "Bob Builder")
+        self.assertIs(m.get_aggregate("/README.txt"), a)
+        self.assertEqual(sum(isinstance(a, dict) for a in m.aggregates.json_entries()), 3)
+
+        self.assertEqual(len(m.annotations_about("/")), 1)
+        self.assertEqual(json.loads(m.to_json())["aggregates"],
+                         json.loads(eager.to_json())["aggregates"])
+        m.remove_aggregate("/folder/soup.jpeg", remove_annotations=True)
+        m.add_aggregate("/new")
+        self.assertEqual(list(m.aggregates.ids())[-1], "/new")
+        self.assertEqual(len(m.annotations), 2)
+
+    def test_manifest_cache(self):
+        self.addCleanup(unlink, TESTFN2)
+        expected = Manifest(filename=TESTFN)
+        meta = "urn:uuid:d67466b4-3aeb-4855-8203-90febe71abdf"
+        # Not snapshotted while it may still change unnoticed
+        Manifest(filename=TESTFN, cache=TESTFN2)
+        self.assertFalse(os.path.exists(TESTFN2))
+        _age(TESTFN)
+        Manifest(filename=TESTFN, cache=TESTFN2)
+        self.assertTrue(os.path.exists(TESTFN2))
+
+        m = Manifest(filename=TESTFN, cache=TESTFN2, lazy=True)
+        self.assertIsNotNone(m.aggregates._deferred)
+        self.assertEqual(list(m.aggregates.ids()), list(expected.aggregates.ids()))
+        self.assertEqual([a.content for a in m.annotations_about("/")],
+                         ["annotations/a-meta-annotation-in-this-ro.txt"])
+        self.assertIsNotNone(m.aggregates._deferred)
+        self.assertEqual(m.createdBy.name, "Alice W. Land")
+        m.remove_aggregate("/folder/soup.jpeg")
+        self.assertEqual(m.get_annotation(meta).about, "/folder/soup.jpeg")
+        self.assertEqual(len(m.aggregates), 3)
+        self.assertEqual(m.get_aggregate("/README.txt").createdBy.name, "Bob Builder")
+
+        m = Manifest(filename=TESTFN, cache=TESTFN2)
+        self.assertIsInstance(m.aggregates.json_entries()[0], Aggregate)
+        self.assertEqual(m.to_json(), expected.to_json())
+
+        # The snapshot is made again when the manifest changes
+        expected.add_aggregate("/new")
+        with open(TESTFN, "w") as fp:
+            fp.write(expected.to_json())
+        _age(TESTFN)
+        m = Manifest(filename=TESTFN, cache=TESTFN2, lazy=True)
+        self.assertEqual(list(m.aggregates.ids())[-1], "/new")
+        m = Manifest(filename=TESTFN, cache=TESTFN2, lazy=True)
+        self.assertIsNotNone(m.aggregates._deferred)
+        self.assertEqual(m.to_json(), expected.to_json())
+
+        # And when it is replaced by a file of the same size and modification
+        # time
+        self.addCleanup(unlink, TESTFN + "-new")
+        stat = os.stat(TESTFN)
+        with open(TESTFN + "-new", "w") as fp:
+            fp.write(expected.to_json().replace('"/new"', '"/old"'))
+        os.utime(TESTFN + "-new", ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        os.replace(TESTFN + "-new", TESTFN)
+        m = Manifest(filename=TESTFN, cache=TESTFN2, lazy=True)
+        self.assertEqual(list(m.aggregates.ids())[-1], "/old")
+
+    def test_manifest_journal(self):
+        self.addCleanup(unlink, TESTFN2)
+        meta = "urn:uuid:d67466b4-3aeb-4855-8203-90febe71abdf"
+        with open(TESTFN) as fp:
+            size = len(fp.read())
+        m = Manifest(filename=TESTFN, journal=TESTFN2, writable=True)
+        m.add_aggregate("/new", createdBy="Carol")
+        m.remove_aggregate("/folder/soup.jpeg", remove_annotations=True)
+        annotation, = m.annotations_about("/")
+        m.add_annotation(annotation, content="changed.txt")
+        m.write_journal(TESTFN2)
+        expected = m.to_json()
+        with open(TESTFN) as fp:
+            self.assertEqual(len(fp.read()), size)
+
+        self.assertEqual(Manifest(filename=TESTFN, journal=TESTFN2).to_json(), expected)
+        m = Manifest(filename=TESTFN, journal=TESTFN2, lazy=True)
+        self.assertEqual([a["uri"] for a in json.loads(expected)["aggregates"]],
+                         list(m.aggregates.ids()))
+        self.assertEqual(json.loads(m.to_json())["annotations"],
+                         json.loads(expected)["annotations"])
+        self.assertIsNone(m.get_annotation(meta))
+        self.assertEqual(m.annotations_about("/")[0].content, "changed.txt")
+
+        # A record cut short by an interrupted write is ignored
+        m = Manifest(filename=TESTFN, journal=TESTFN2, writable=True)
+        m.aggregates = [m.get_aggregate("/new")]
+        m.write_journal(TESTFN2)
+        expected = m.to_json()
+        with open(TESTFN2, "a") as fp:
+            fp.write('{"change": "add", "property": "aggregates", "va')
+        self.assertEqual(Manifest(filename=TESTFN, journal=TESTFN2).to_json(), expected)
+
+        m.fold_journal(TESTFN, TESTFN2)
+        self.assertFalse(os.path.exists(TESTFN2))
+        self.assertEqual(Manifest(filename=TESTFN).to_json(), expected)
+        self.assertRaises(ValueError, Manifest(filename=TESTFN).write_journal, TESTFN2)
+        # Only a writable manifest keeps its changes, or fingerprints entries
+        m = Manifest(filename=TESTFN, journal=TESTFN2, lazy=True)
+        self.assertEqual(len(list(m.aggregates)), 1)
+        self.assertEqual(m.aggregates._fingerprints, {})
+        self.assertRaises(ValueError, m.write_journal, TESTFN2)
+
+        # Entries changed in place and the manifest's other properties are
+        # found when the journal is written
+        m = Manifest(filename=TESTFN, journal=TESTFN2, writable=True)
+        aggregate = m.get_aggregate("/new")
+        aggregate.mediatype = "text/plain"
+        m.createdBy.name = "Dan"
+        m.title = "Changed"
+        m.write_journal(TESTFN2)
+        aggregate.mediatype = "text/csv"
+        m.add_aggregate("/other", createdBy="Erin").mediatype = "text/html"
+        m.write_journal(TESTFN2)
+        m.get_aggregate("/other").mediatype = "image/png"
+        del m.title
+        m.write_journal(TESTFN2)
+        expected = m.to_json()
+        self.assertIn("image/png", expected)
+        self.assertEqual(Manifest(filename=TESTFN, journal=TESTFN2).to_json(), expected)
+        self.assertEqual(Manifest(filename=TESTFN, journal=TESTFN2, lazy=True).to_json(), expected)
+        self.assertEqual(Manifest(filename=TESTFN, journal=TESTFN2).createdBy.name, "Dan")
+
+    def test_iter_aggregates(self):
+        m = Manifest(filename=TESTFN)
+        aggregates = list(Manifest.iter_aggregates(filename=TESTFN))
+        self.assertEqual(aggregates, list(m.aggregates))
+        self.assertEqual(aggregates[2].createdBy.name, "Bob Builder")
+        with open(TESTFN) as fp:
+            annotations = list(Manifest.iter_annotations(file=fp))
+        self.assertEqual([a.content for a in annotations], [a.content for a in m.annotations])
+
+    def test_iter_manifest_json_chunks(self):
+        with open(TESTFN) as fp:
+            contents = json.load(fp)
+        # A JSON escape and a character split across chunks
+        data = manifest.replace('"Dr"', '"Dr \\u00e9 \u00e9"').encode("utf-8")
+        expected = list(iter_manifest_json(io.BytesIO(data)))
+        for chunk_size in (1, 2, 7):
+            self.assertEqual(list(iter_manifest_json(io.BytesIO(data), chunk_size)), expected)
+        properties = dict(expected)
+        self.assertEqual(properties["foaf:title"], "Dr \u00e9 \u00e9")
+        self.assertEqual(properties["createdBy"], contents["createdBy"])
+        self.assertEqual([value for (key, value) in expected if key == "aggregates"],
+                         contents["aggregates"])
+        self.assertRaises(json.JSONDecodeError, list, iter_manifest_json(io.StringIO('{"a": 1')))
+        # Numbers split across chunks at their fraction or exponent
+        data = '{"aggregates":[{"size":1.5},{"size":-2.25e+10},12E-3], "n": 105}'
+        for chunk_size in range(1, len(data) + 1):
+            self.assertEqual(list(iter_manifest_json(io.StringIO(data), chunk_size)),
+                             [("aggregates", {"size": 1.5}), ("aggregates", {"size": -2.25e+10}),
+                              ("aggregates", 12E-3), ("n", 105)])
+        self.assertRaises(json.JSONDecodeError, list, iter_manifest_json(io.StringIO('[1]')))
+
+    def test_write_json(self):
+        for m in (Manifest(filename=TESTFN), Manifest(filename=TESTFN, lazy=True), Manifest()):
+            m.add_aggregate("/new", createdBy="Bob Builder")
+            text = io.StringIO()
+            m.write_json(text)
+            self.assertEqual(text.getvalue(), m.to_json())
+            data = io.BytesIO()
+            m.write_json(data, compact=True)
+            self.assertNotIn(b"\n", data.getvalue())
+            self.assertEqual(json.loads(data.getvalue().decode("utf-8")), json.loads(m.to_json()))
+
+    def test_manifest_add_existing_aggregate_moves_to_end(self):
+        manifest = Manifest()
+        for uri in ("/test1", "/test2", "/test1"):
+            manifest.add_aggregate(uri)
+        self.assertEqual([a.uri for a in manifest.aggregates], ["/test2", "/test1"])
+        self.assertRaises(ValueError, manifest.aggregates.remove, "/missing")
+
     def test_manifest_add_annotation(self):
-        pass
+        manifest = Manifest()
+        annotation = manifest.add_annotation(about="/test", content="/annotation.ttl")
+        self.assertIs(manifest.get_annotation(annotation.uri), annotation)
+        self.assertIs(manifest.add_annotation(annotation), annotation)
+        self.assertEqual(len(manifest.annotations), 1)
 
     def test_manifest_remove_annotation(self):
-        pass
+        manifest = Manifest()
+        annotation = manifest.add_annotation(Annotation(about="/test"))
+        manifest.remove_annotation(annotation.uri)
+        self.assertIsNone(manifest.get_annotation(annotation.uri))
+        self.assertNotIn(annotation, manifest.annotations)
@@ -1,6 +1,7 @@
+import os
 import unittest as unittest
 import rolib.ucf
-from tests.support import TESTFN, unlink
+from tests.support import TESTFN, TESTFN2, unlink
 
 def get_files(test):
     yield TESTFN2
@@ -56,3 +57,12 @@ class UCFTestCase(unittest.TestCase):
     #    for name in container.namelist(ignore_reserved=True):
     #        pass
         pass
+
+    def test_clone_invalid_verify(self):
+        self.addCleanup(unlink, TESTFN)
+        self.addCleanup(unlink, TESTFN2)
+        with rolib.ucf.UCF(TESTFN, mode="w") as container:
+            container.writestr("data", b"contents")
+        with rolib.ucf.UCF(TESTFN) as container:
+            self.assertRaises(ValueError, container.clone, TESTFN2, verify="quick")
+        self.assertFalse(os.path.exists(TESTFN2))
@@ -0,0 +1,436 @@
+import io
+import os
+import copy
+import zlib
+import hashlib
+import unittest as unittest
+from unittest import mock
+import zipfile as stdzipfile
+from itertools import zip_longest
+from concurrent.futures import ThreadPoolExecutor
+
+from tests.support import (TESTFN, TESTFN2, unlink)
+
+from rolib.packages.zipextended.zipfileextended import ZipFileExtended, _crc32_combine
+from rolib.packages.zipextended.packages import zipfile
+
+
+class ZipFileExtendedTestCase(unittest.TestCase):
+
+    def setUp(self):
+        with ZipFileExtended(TESTFN, mode="w", compression=zipfile.ZIP_DEFLATED) as zip:
+            zip.writestr("first", b"first file contents" * 100)
+            zip.writestr("second", b"second file contents")
+            zip.writestr("third", b"third file contents" * 10)
+
+    def tearDown(self):
+        unlink(TESTFN)
+        unlink(TESTFN2)
+
+    def offsets(self):
+        with ZipFileExtended(TESTFN, mode="r") as zip:
+            return {info.filename: info.header_offset for info in zip.infolist()}
+
+    def test_remove_commits_in_place(self):
+        before = self.offsets()
+        with ZipFileExtended(TESTFN, mode="a") as zip:
+            zip.remove("first")
+
+        after = self.offsets()
+        self.assertNotIn("first", after)
+        self.assertEqual(after["second"], before["second"])
+        self.assertEqual(after["third"], before["third"])
+        with stdzipfile.ZipFile(TESTFN) as zip:
+            self.assertIsNone(zip.testzip())
+            self.assertEqual(zip.read("second"), b"second file contents")
+
+    def test_rename_same_length_commits_in_place(self):
+        before = self.offsets()
+        with ZipFileExtended(TESTFN, mode="a") as zip:
+            zip.rename("second", "SECOND")
+            self.assertNotIn("second", zip.NameToInfo)
+
+        after = self.offsets()
+        self.assertEqual(after["SECOND"], before["second"])
+        with stdzipfile.ZipFile(TESTFN) as zip:
+            self.assertIsNone(zip.testzip())
+            self.assertEqual(zip.read("SECOND"), b"second file contents")
+
+    def test_rename_longer_name_moves_member(self):
+        before = self.offsets()
+        with ZipFileExtended(TESTFN, mode="a") as zip:
+            zip.rename("first", "a/much/longer/name")
+
+        after = self.offsets()
+        self.assertGreater(after["a/much/longer/name"], before["third"])
+        self.assertEqual(after["second"], before["second"])
+        with stdzipfile.ZipFile(TESTFN) as zip:
+            self.assertIsNone(zip.testzip())
+            self.assertEqual(zip.read("a/much/longer/name"), b"first file contents" * 100)
+
+    def test_commit_rewrite(self):
+        size = os.path.getsize(TESTFN)
+        with ZipFileExtended(TESTFN, mode="a") as zip:
+            zip.remove("first")
+            zip.commit(rewrite=True)
+            self.assertEqual(zip.namelist(), ["second", "third"])
+
+        with stdzipfile.ZipFile(TESTFN) as zip:
+            self.assertIsNone(zip.testzip())
+            self.assertEqual(zip.namelist(), ["second", "third"])
+        self.assertLess(os.path.getsize(TESTFN), size)
+
+    def test_commit_rewrite_failure_restores_file(self):
+        with open(TESTFN, "rb") as fp:
+            contents = fp.read()
+        with ZipFileExtended(TESTFN, mode="a") as zip:
+            zip.remove("first")
+            with mock.patch.object(zip, "_reset", side_effect=OSError("reset")):
+                with self.assertRaises(RuntimeError) as cm:
+                    zip.commit(rewrite=True)
+            self.assertIsInstance(cm.exception.__cause__, OSError)
+            with open(TESTFN, "rb") as fp:
+                self.assertEqual(fp.read(), contents)
+
+    def test_commit_rewrite_failure_restores_stream(self):
+        with open(TESTFN, "rb") as fp:
+            contents = fp.read()
+        stream = io.BytesIO(contents)
+        zip = ZipFileExtended(stream, mode="a")
+        zip.remove("first")
+        with mock.patch.object(zip, "_reset", side_effect=OSError("reset")):
+            with self.assertRaises(RuntimeError) as cm:
+                zip.commit(rewrite=True)
+        self.assertIsInstance(cm.exception.__cause__, OSError)
+        self.assertEqual(stream.getvalue(), contents)
+        zip.close()
+
+    def test_fragmentation_counts_removed_entries(self):
+        with ZipFileExtended(TESTFN, mode="a") as zip:
+            self.assertEqual(zip.wasted_bytes(), 0)
+            zip.remove("second")
+            report = zip.fragmentation()
+            self.assertEqual(report["removed_entries"], 1)
+            self.assertEqual(report["orphaned_headers"], 0)
+            self.assertEqual(report["wasted_bytes"], report["removed_bytes"])
+            self.assertEqual(report["first_gap"], self.offsets()["second"])
+
+    def test_fragmentation_counts_orphaned_headers(self):
+        with ZipFileExtended(TESTFN, mode="a") as zip:
+            zip.remove("second")
+
+        with ZipFileExtended(TESTFN, mode="r") as zip:
+            report = zip.fragmentation()
+            self.assertEqual(report["removed_entries"], 0)
+            self.assertEqual(report["orphaned_headers"], 1)
+            self.assertEqual(report["hidden_files"], 0)
+            self.assertGreater(report["orphaned_bytes"], len(b"second file contents"))
+            self.assertEqual(zip.wasted_bytes(), report["orphaned_bytes"])
+
+    def test_compact_moves_only_the_tail(self):
+        before = self.offsets()
+        with ZipFileExtended(TESTFN, mode="a") as zip:
+            zip.remove("second")
+            wasted = zip.wasted_bytes()
+            self.assertEqual(zip.compact(), wasted)
+            self.assertEqual(zip.wasted_bytes(), 0)
+
+        after = self.offsets()
+        self.assertEqual(after["first"], before["first"])
+        self.assertEqual(after["third"], before["second"])
+        with stdzipfile.ZipFile(TESTFN) as zip:
+            self.assertIsNone(zip.testzip())
+            self.assertEqual(zip.read("third"), b"third file contents" * 10)
+
+    def test_compact_keeps_hidden_files(self):
+        with ZipFileExtended(TESTFN, mode="a") as zip:
+            zip._write_hidden(b"hidden data")
+            zip.writestr("fourth", b"fourth file contents")
+            zip.remove("second")
+            zip.compact()
+            report = zip.fragmentation()
+            self.assertEqual(report["hidden_bytes"], len(b"hidden data"))
+            self.assertEqual(report["wasted_bytes"], len(b"hidden data"))
+            zip.compact(ignore_hidden_files=True)
+            self.assertEqual(zip.wasted_bytes(), 0)
+
+        with stdzipfile.ZipFile(TESTFN) as zip:
+            self.assertIsNone(zip.testzip())
+            self.assertEqual(zip.namelist(), ["first", "third", "fourth"])
+
+    def test_clone_streams_compressed_bytes(self):
+        random = os.urandom(10000)
+        with ZipFileExtended(TESTFN, mode="a", compression=zipfile.ZIP_DEFLATED) as zip:
+            # Incompressible data is larger once compressed
+            zip.writestr("random", random)
+            offset = zip.getinfo("random").header_offset
+            zip.remove("first")
+            with zip.clone(TESTFN2, buffer_size=7) as clone:
+                self.assertEqual(clone.namelist(), ["second", "third", "random"])
+            self.assertEqual(zip.getinfo("random").header_offset, offset)
+
+        with stdzipfile.ZipFile(TESTFN2) as zip:
+            self.assertIsNone(zip.testzip())
+            self.assertEqual(zip.read("random"), random)
+
+    def test_clone_without_changes_copies_bytes(self):
+        with open(TESTFN, "rb") as fp:
+            original = fp.read()
+        with ZipFileExtended(TESTFN, mode="r") as zip:
+            zip.clone(TESTFN2).close()
+            stream = io.BytesIO()
+            zip.clone(stream).close()
+
+        with open(TESTFN2, "rb") as fp:
+            self.assertEqual(fp.read(), original)
+        self.assertEqual(stream.getvalue(), original)
+
+    def test_clone_verify_levels(self):
+        with ZipFileExtended(TESTFN, mode="a") as zip:
+            zip.remove("second")
+            for verify in ("none", "structure", "full"):
+                with zip.clone(TESTFN2, verify=verify) as clone:
+                    self.assertEqual(clone.namelist(), ["first", "third"])
+            self.assertRaises(ValueError, zip.clone, TESTFN2, verify="quick")
+            self.assertRaises(ValueError, zip.commit, verify="quick")
+
+    def test_structure_check_detects_mismatch(self):
+        with ZipFileExtended(TESTFN, mode="r") as zip:
+            written = list(zip.infolist())
+            self.assertIsNone(zip._check_structure(written))
+            self.assertEqual(zip._check_structure(written[:-1]), "third")
+            with ZipFileExtended(TESTFN, mode="r") as other:
+                other.getinfo("second").compress_size += 1
+                self.assertEqual(zip._check_structure(other.infolist()), "second")
+                self.assertRaises(zipfile.BadZipFile, zip._verify, other.infolist())
+
+
+class LazyZipFileExtendedTestCase(unittest.TestCase):
+
+    def setUp(self):
+        with ZipFileExtended(TESTFN, mode="w") as zip:
+            for i in range(50):
+                zip.writestr("dir/file{:02d}".format(i), "contents {}".format(i))
+            zip.writestr("café", b"utf-8 name")
+
+    def tearDown(self):
+        unlink(TESTFN)
+        unlink(TESTFN + ".index")
+
+    def test_lazy_lookup_matches_eager(self):
+        with ZipFileExtended(TESTFN, mode="r") as eager, \
+             ZipFileExtended(TESTFN, mode="r", lazy=True) as lazy:
+            self.assertEqual(len(lazy._lazy_infos), 0)
+            self.assertEqual(lazy.read("dir/file07"), b"contents 7")
+            self.assertEqual(lazy.read("café"), b"utf-8 name")
+            self.assertEqual(len(lazy._lazy_infos), 2)
+            self.assertIs(lazy.getinfo("dir/file07"), lazy.getinfo("dir/file07"))
+            self.assertNotIn("missing", lazy.NameToInfo)
+            self.assertRaises(KeyError, lazy.getinfo, "missing")
+            self.assertEqual(lazy.namelist(), eager.namelist())
+            self.assertEqual(lazy.infolist()[-1].filename, "café")
+            self.assertIsNone(lazy.testzip())
+
+    def test_sidecar_is_reused_until_archive_changes(self):
+        with ZipFileExtended(TESTFN, mode="r", lazy=True):
+            pass
+        self.assertTrue(os.path.exists(TESTFN + ".index"))
+        with open(TESTFN + ".index", "rb") as fp:
+            index = fp.read()
+        mtime = os.stat(TESTFN + ".index").st_mtime_ns
+
+        with ZipFileExtended(TESTFN, mode="r", lazy=True) as zip:
+            self.assertEqual(zip.read("dir/file00"), b"contents 0")
+        self.assertEqual(os.stat(TESTFN + ".index").st_mtime_ns, mtime)
+
+        with ZipFileExtended(TESTFN, mode="a") as zip:
+            zip.writestr("new", b"new member")
+        with ZipFileExtended(TESTFN, mode="r", lazy=True) as zip:
+            self.assertEqual(zip.read("new"), b"new member")
+        with open(TESTFN + ".index", "rb") as fp:
+            self.assertNotEqual(fp.read(), index)
+
+
+class PreadZipFileExtendedTestCase(unittest.TestCase):
+
+    def setUp(self):
+        with ZipFileExtended(TESTFN, mode="w", compression=zipfile.ZIP_DEFLATED) as zip:
+            for i in range(20):
+                zip.writestr("file{:02d}".format(i), os.urandom(1000) * (i + 1))
+
+    def tearDown(self):
+        unlink(TESTFN)
+        unlink(TESTFN2)
+
+    def test_pread_used_when_possible(self):
+        with ZipFileExtended(TESTFN, mode="r") as zip:
+            self.assertTrue(zip._pread)
+        with ZipFileExtended(TESTFN, mode="a") as zip:
+            self.assertFalse(zip._pread)
+        with open(TESTFN, "rb") as fp:
+            with ZipFileExtended(io.BytesIO(fp.read()), mode="r") as zip:
+                self.assertFalse(zip._pread)
+        self.assertRaises(ValueError, ZipFileExtended, TESTFN2, mode="w", pread=True)
+
+    def test_concurrent_reads(self):
+        with ZipFileExtended(TESTFN, mode="r", pread=False) as zip:
+            expected = {name: zip.read(name) for name in zip.namelist()}
+        with ZipFileExtended(TESTFN, mode="r") as zip:
+            position = zip.fp.tell()
+            with ThreadPoolExecutor(4) as pool:
+                names = zip.namelist() * 5
+                for name, data in zip_longest(names, pool.map(zip.read, names)):
+                    self.assertEqual(data, expected[name])
+            # Members are read without moving the file's position
+            self.assertEqual(zip.fp.tell(), position)
+            member = zip.open("file03")
+        # The member holds the file open after the archive is closed
+        self.assertEqual(member.read(), expected["file03"])
+        member.close()
+        self.assertTrue(zip.fp is None)
+
+
+class CompactZipFileExtendedTestCase(unittest.TestCase):
+
+    def setUp(self):
+        with ZipFileExtended(TESTFN, mode="w", compact_info=True) as zip:
+            zip.writestr("first", b"first file contents")
+            zip.writestr("second", b"second file contents")
+            zip.writestr("third", b"third file contents")
+
+    def tearDown(self):
+        unlink(TESTFN)
+        unlink(TESTFN2)
+
+    def test_compact_info_matches_zipinfo(self):
+        with ZipFileExtended(TESTFN, mode="r") as eager, \
+             ZipFileExtended(TESTFN, mode="r", compact_info=True) as compact:
+            self.assertEqual(compact.namelist(), eager.namelist())
+            for expected, actual in zip_longest(eager.infolist(), compact.infolist()):
+                self.assertIsInstance(actual, zipfile.ZipInfo)
+                for name in zipfile.ZipInfo.__slots__:
+                    self.assertEqual(getattr(actual, name), getattr(expected, name), name)
+            self.assertEqual(compact.getinfo("second"), compact.infolist()[1])
+            self.assertEqual(compact.read("second"), b"second file contents")
+            self.assertIsNone(compact.testzip())
+
+    def test_compact_info_remove_and_rename(self):
+        with ZipFileExtended(TESTFN, mode="a", compact_info=True) as zip:
+            zip.remove("first")
+            zip.rename("second", "a/longer/name")
+            self.assertEqual(zip.getinfo("a/longer/name").orig_filename, "second")
+            self.assertEqual(zip.namelist(), ["a/longer/name", "third"])
+            detached = copy.copy(zip.getinfo("third"))
+            detached.header_offset = 0
+            self.assertNotEqual(zip.getinfo("third").header_offset, 0)
+
+        with stdzipfile.ZipFile(TESTFN) as zip:
+            self.assertIsNone(zip.testzip())
+            self.assertEqual(sorted(zip.namelist()), ["a/longer/name", "third"])
+            self.assertEqual(zip.read("a/longer/name"), b"second file contents")
+
+
+class WriteManyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.filenames = []
+        for i in range(5):
+            filename = "{}-{}".format(TESTFN, i)
+            with open(filename, "wb") as fp:
+                fp.write("contents of file {}\n".format(i).encode() * 100 * i)
+            self.filenames.append(filename)
+
+    def tearDown(self):
+        for filename in self.filenames:
+            unlink(filename)
+        unlink(TESTFN)
+        unlink(TESTFN2)
+
+    def test_write_many_matches_write(self):
+        with ZipFileExtended(TESTFN, mode="w", compression=zipfile.ZIP_DEFLATED) as zip:
+            for filename in self.filenames:
+                zip.write(filename)
+        for workers in (1, 2):
+            with ZipFileExtended(TESTFN2, mode="w", compression=zipfile.ZIP_DEFLATED) as zip:
+                zip.write_many(self.filenames, workers=workers)
+            with open(TESTFN, "rb") as expected, open(TESTFN2, "rb") as actual:
+                self.assertEqual(actual.read(), expected.read())
+
+    def test_write_many_arcnames(self):
+        arcnames = ["member{}".format(i) for i in range(len(self.filenames))]
+        with ZipFileExtended(TESTFN, mode="w") as zip:
+            zip.write_many(self.filenames, arcnames, compress_type=zipfile.ZIP_DEFLATED,
+                           workers=2)
+
+        with stdzipfile.ZipFile(TESTFN) as zip:
+            self.assertIsNone(zip.testzip())
+            self.assertEqual(zip.namelist(), arcnames)
+            with open(self.filenames[3], "rb") as fp:
+                self.assertEqual(zip.read("member3"), fp.read())
+
+    def test_write_blocks(self):
+        data = os.urandom(5000) + b"repeated block contents" * 2000
+        with open(self.filenames[1], "wb") as fp:
+            fp.write(data)
+        for workers in (1, 2):
+            with ZipFileExtended(TESTFN, mode="w") as zip:
+                zip.write_blocks(self.filenames[1], "large", workers=workers,
+                                 block_size=4096)
+                zip.write_blocks(self.filenames[0], "empty", workers=workers)
+                self.assertEqual(zip.getinfo("large").CRC, zlib.crc32(data))
+
+            with stdzipfile.ZipFile(TESTFN) as zip:
+                self.assertIsNone(zip.testzip())
+                self.assertEqual(zip.read("large"), data)
+                self.assertEqual(zip.read("empty"), b"")
+                self.assertLess(zip.getinfo("large").compress_size, len(data) // 2)
+
+    def test_digests(self):
+        expected = []
+        for filename in self.filenames:
+            with open(filename, "rb") as fp:
+                expected.append({"sha256": hashlib.sha256(fp.read()).hexdigest()})
+        with ZipFileExtended(TESTFN, mode="w", compression=zipfile.ZIP_DEFLATED) as zip:
+            for filename in self.filenames:
+                zip.write(filename)
+        with ZipFileExtended(TESTFN2, mode="w", compression=zipfile.ZIP_DEFLATED) as zip:
+            self.assertEqual([zip.write(filename, digests=("sha256",))
+                              for filename in self.filenames], expected)
+        with open(TESTFN, "rb") as plain, open(TESTFN2, "rb") as digested:
+            self.assertEqual(digested.read(), plain.read())
+        for workers in (1, 2):
+            with ZipFileExtended(TESTFN, mode="w") as zip:
+                self.assertEqual(zip.write_many(self.filenames, workers=workers,
+                                                digests=("sha256",)), expected)
+                self.assertEqual(zip.write_blocks(self.filenames[4], "large", workers=workers,
+                                                  block_size=1000, digests=("sha256",)),
+                                 expected[4])
+                self.assertEqual(zip.write(self.filenames[1], "plain"), {})
+            with stdzipfile.ZipFile(TESTFN) as zip:
+                self.assertIsNone(zip.testzip())
+
+    def test_open_for_writing(self):
+        data = b"streamed contents " * 5000
+        for file in (TESTFN, io.BytesIO()):
+            with ZipFileExtended(file, mode="w", compression=zipfile.ZIP_DEFLATED) as zip:
+                zip.writestr("first", b"first file contents")
+                with zip.open("streamed", "w") as fp:
+                    for i in range(0, len(data), 1000):
+                        fp.write(data[i:i + 1000])
+                    self.assertRaises(ValueError, zip.writestr, "other", b"")
+                    self.assertRaises(ValueError, zip.open, "other", "w")
+                zip.writestr("last", b"last file contents")
+                self.assertEqual(zip.read("streamed"), data)
+
+            if isinstance(file, io.BytesIO):
+                file.seek(0)
+            with stdzipfile.ZipFile(file) as zip:
+                self.assertIsNone(zip.testzip())
+                self.assertEqual(zip.namelist(), ["first", "streamed", "last"])
+                self.assertEqual(zip.read("streamed"), data)
+                self.assertLess(zip.getinfo("streamed").compress_size, len(data))
+
+    def test_crc32_combine(self):
+        for first, second in ((b"", b"x"), (b"first", b""), (b"first", b"second" * 1000)):
+            self.assertEqual(_crc32_combine(zlib.crc32(first), zlib.crc32(second), len(second)),
+                             zlib.crc32(first + second))